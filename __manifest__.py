@@ -8,12 +8,21 @@
     "data": ["report/report_sale_purchase.xml", 
              "wizard/select_report_sale_purchase_view.xml",
              "security/ir.model.access.csv",
+             "security/journal_security.xml",
+             "views/account_report_journal_snapshot_view.xml",
+             "views/account_report_journal_job_view.xml",
+             "views/account_report_journal_batch_view.xml",
+             "views/account_report_journal_render_cache_view.xml",
+             "views/journal_lazy_view.xml",
+             "data/ir_cron.xml",
              ],
     "license": "AGPL-3",
     "version": "1.0",
     "author": "OdooERP Romania, Odoo Community Association (OCA)",
     "website": "https://github.com/OCA/l10n-romania",
     "installable": True,
+    "pre_init_hook": "pre_init_hook",
+    "uninstall_hook": "uninstall_hook",
     "development_status": "Mature",
     "maintainers": ["feketemihai"],
 }
@@ -0,0 +1,148 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+
+from odoo import _, fields, http
+from odoo.exceptions import AccessError, UserError
+from odoo.http import request
+
+from ..report.journal_export import INVOICE_COLUMNS, PAYMENT_COLUMNS
+
+MAX_PAGE_SIZE = 1000
+
+
+class SalePurchaseJournalController(http.Controller):
+
+    # the journal lines are served by pages from the stored snapshot, the
+    # lazy HTML view asks the next page when the user scrolls to its end.
+    # The snapshot is validated once, when the view is opened; the pages are
+    # read from it while its lines are not changed (the same fingerprint).
+    # If it is not valid, the view is returned at once and a background job
+    # computes it, the view asks its status until it is ready
+
+    def _check_company(self, company_id):
+        user = request.env.user
+        if company_id not in user.company_ids.ids or not user.has_group(
+            "account.group_account_user"
+        ):
+            raise AccessError(_("You can not see the journal of this company."))
+
+    def _get_data(self, company_id, journal_type, date_from, date_to, show_warnings):
+        company_id = int(company_id)
+        self._check_company(company_id)
+        if journal_type not in ("sale", "purchase"):
+            raise AccessError(_("Unknown journal type %s") % journal_type)
+        form = {
+            "company_id": (company_id, ""),
+            "journal_type": journal_type,
+            "date_from": fields.Date.to_string(fields.Date.to_date(date_from)),
+            "date_to": fields.Date.to_string(fields.Date.to_date(date_to)),
+            "show_warnings": show_warnings in (True, "1", "True", "true"),
+            "use_snapshot": True,
+        }
+        return {"ids": [], "model": "l10n_ro_account_report_journal", "form": form}
+
+    def _get_snapshot_status(self, data, job_id=None):
+        """the valid snapshot of data, or the background job computing it"""
+        company_id = data["form"]["company_id"][0]
+        snapshot = (
+            request.env["l10n.ro.account.report.journal.snapshot"]
+            .with_context(allowed_company_ids=[company_id])
+            ._get_current_snapshot(data)
+        )
+        if snapshot:
+            return {"snapshot_id": snapshot.id, "fingerprint": snapshot.fingerprint}
+        job_obj = request.env["l10n.ro.account.report.journal.job"].with_context(
+            allowed_company_ids=[company_id]
+        )
+        job = job_obj.browse(int(job_id)).exists() if job_id else job_obj
+        if job.state == "failed":
+            raise UserError(_("The journal could not be computed:\n%s") % job.error)
+        if job.state not in ("pending", "running"):
+            # not started yet, or done but changed since then
+            job = job_obj._get_snapshot_job(data["form"])
+        return {"job_id": job.id, "progress": job.progress}
+
+    def _get_view_snapshot(self, snapshot_id, fingerprint):
+        """the snapshot validated by the view, if its lines were not changed
+        since then"""
+        snapshot = (
+            request.env["l10n.ro.account.report.journal.snapshot"]
+            .sudo()
+            .browse(int(snapshot_id))
+            .exists()
+        )
+        if not snapshot or snapshot.fingerprint != fingerprint:
+            raise UserError(_("The journal was changed, reload the page."))
+        company_id = snapshot.company_id.id
+        self._check_company(company_id)
+        snapshot = snapshot.with_user(request.env.user).with_context(
+            allowed_company_ids=[company_id]
+        )
+        snapshot.check_access_rule("read")
+        return snapshot
+
+    @http.route(
+        "/l10n_ro_account_report_journal/lines", type="json", auth="user"
+    )
+    def journal_lines(self, snapshot_id, fingerprint, after=-1, limit=200):
+        """returns a page of lines after the cursor after, and the cursor
+        of the next page (None at the end)"""
+        snapshot = self._get_view_snapshot(snapshot_id, fingerprint)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        page = snapshot._read_page(int(after), limit)
+        return {
+            "lines": [dict(json.loads(line), sequence=sequence) for sequence, line in page],
+            "next": page[-1][0] if len(page) == limit else None,
+            "count": snapshot.line_count,
+        }
+
+    @http.route(
+        "/l10n_ro_account_report_journal/totals", type="json", auth="user"
+    )
+    def journal_totals(self, snapshot_id, fingerprint):
+        snapshot = self._get_view_snapshot(snapshot_id, fingerprint)
+        return {"totals": json.loads(snapshot.totals or "{}"), "count": snapshot.line_count}
+
+    @http.route(
+        "/l10n_ro_account_report_journal/status", type="json", auth="user"
+    )
+    def journal_status(
+        self, company_id, journal_type, date_from, date_to, show_warnings="1", job_id=None
+    ):
+        """the snapshot to read the lines from, once it is computed by the job
+        job_id, or the progress of the job"""
+        data = self._get_data(company_id, journal_type, date_from, date_to, show_warnings)
+        return self._get_snapshot_status(data, job_id)
+
+    @http.route(
+        "/l10n_ro_account_report_journal/view", type="http", auth="user"
+    )
+    def journal_view(self, company_id, journal_type, date_from, date_to, show_warnings="1"):
+        """the page with the table header only, the lines are loaded by
+        javascript"""
+        data = self._get_data(company_id, journal_type, date_from, date_to, show_warnings)
+        options = self._get_snapshot_status(data)
+        return request.render(
+            "l10n_ro_account_report_journal.journal_lazy_view",
+            {
+                "company": request.env["res.company"].browse(data["form"]["company_id"][0]),
+                "form": data["form"],
+                "options": json.dumps(
+                    dict(
+                        options,
+                        form={
+                            "company_id": company_id,
+                            "journal_type": journal_type,
+                            "date_from": date_from,
+                            "date_to": date_to,
+                            "show_warnings": show_warnings,
+                        },
+                        invoice_columns=[key for key, _label in INVOICE_COLUMNS],
+                        payment_columns=[key for key, _label in PAYMENT_COLUMNS],
+                    )
+                ),
+                "invoice_columns": INVOICE_COLUMNS,
+            },
+        )
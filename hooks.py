@@ -0,0 +1,35 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+from .report.journal_engine import drop_journal_indexes
+
+_logger = logging.getLogger(__name__)
+
+
+def pre_init_hook(cr):
+    """the VAT of the invoice partners is filled with one UPDATE, the column
+    being created before the module is installed, Odoo does not compute it
+    record by record"""
+    cr.execute(
+        """
+        ALTER TABLE account_move
+        ADD COLUMN IF NOT EXISTS invoice_partner_display_vat VARCHAR
+        """
+    )
+    cr.execute(
+        """
+        UPDATE account_move m
+           SET invoice_partner_display_vat = COALESCE(
+                   (SELECT p.vat FROM res_partner p WHERE p.id = m.partner_id), ''
+               )
+         WHERE m.invoice_partner_display_vat IS NULL
+        """
+    )
+    _logger.info("Filled invoice_partner_display_vat of %s moves", cr.rowcount)
+
+
+def uninstall_hook(cr, registry):
+    """the journal indexes are not known by the ORM, they are dropped here"""
+    drop_journal_indexes(cr)
@@ -1 +1,8 @@
 from . import account_move
+from . import account_move_line
+from . import account_report_journal_snapshot
+from . import account_partial_reconcile
+from . import account_report_journal_job
+from . import ir_actions_report
+from . import account_report_journal_batch
+from . import account_report_journal_render_cache
@@ -1,19 +1,83 @@
 # Copyright (C) 2020 OdooERP Romania
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
+from odoo import fields, models
+
+from ..report.journal_engine import create_journal_indexes
+
+# the fields of the invoices and tax cash basis moves read by the journal,
+# the stored lines are computed again only if one of them is written
+JOURNAL_REPORT_FIELDS = {
+    "state",
+    "name",
+    "ref",
+    "date",
+    "invoice_date",
+    "move_type",
+    "company_id",
+    "journal_id",
+    "currency_id",
+    "partner_id",
+    "commercial_partner_id",
+    "invoice_partner_display_vat",
+    "line_ids",
+    "invoice_line_ids",
+    "tax_cash_basis_rec_id",
+}
 
 
 class AccountMove(models.Model):
     _inherit = "account.move"
 
     # store partner data in case of some future partner modification
-    # for reports to have the values form invoice time
-    invoice_partner_display_vat = fields.Char(
-        "VAT Number", compute="_compute_vat_store", store=True
-    )
-
-    @api.depends("partner_id")
-    def _compute_vat_store(self):
-        for record in self:
-            record.invoice_partner_display_vat = record.partner_id.vat or ""
+    # for reports to have the values form invoice time. The value is set
+    # when the invoice is posted, not at every partner change
+    invoice_partner_display_vat = fields.Char("VAT Number", readonly=True, copy=False)
+
+    def init(self):
+        super().init()
+        create_journal_indexes(self.env.cr, "account_move")
+
+    def _post(self, soft=True):
+        posted = super()._post(soft=soft)
+        posted._store_partner_display_vat()
+        return posted
+
+    def _store_partner_display_vat(self):
+        """freezes the VAT of the partner of the invoices, with one UPDATE"""
+        if not self:
+            return
+        self.flush(["partner_id"])
+        self.env["res.partner"].flush(["vat"])
+        self.env.cr.execute(
+            """
+            UPDATE account_move m
+               SET invoice_partner_display_vat = COALESCE(
+                       (SELECT p.vat FROM res_partner p WHERE p.id = m.partner_id), ''
+                   )
+             WHERE m.id IN %s
+            """,
+            (tuple(self.ids),),
+        )
+        self.invalidate_cache(["invoice_partner_display_vat"], self.ids)
+
+    def write(self, vals):
+        res = super().write(vals)
+        if JOURNAL_REPORT_FIELDS.intersection(vals):
+            self.filtered(
+                lambda m: m.is_invoice(include_receipts=True) or m.tax_cash_basis_rec_id
+            )._mark_journal_report_dirty()
+        return res
+
+    def _mark_journal_report_dirty(self):
+        """the stored journal lines of these invoices (or of the invoices
+        reconciled by these tax cash basis moves) must be computed again"""
+        if not self:
+            return
+        invoice_ids = set(self.ids)
+        partials = self.mapped("tax_cash_basis_rec_id")
+        invoice_ids.update(partials.mapped("debit_move_id.move_id").ids)
+        invoice_ids.update(partials.mapped("credit_move_id.move_id").ids)
+        self.env["l10n.ro.account.report.journal.snapshot.line"]._mark_dirty(
+            invoice_ids
+        )
@@ -0,0 +1,14 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import models
+
+from ..report.journal_engine import create_journal_indexes
+
+
+class AccountMoveLine(models.Model):
+    _inherit = "account.move.line"
+
+    def init(self):
+        super().init()
+        create_journal_indexes(self.env.cr, "account_move_line")
@@ -0,0 +1,35 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+from ..report.journal_engine import create_journal_indexes
+
+
+class AccountPartialReconcile(models.Model):
+    _inherit = "account.partial.reconcile"
+
+    # a new or removed reconciliation changes the payments and the not
+    # exigible values of the VAT on payment invoices in the journal report
+
+    def init(self):
+        super().init()
+        create_journal_indexes(self.env.cr, "account_partial_reconcile")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partials = super().create(vals_list)
+        partials._mark_journal_report_dirty()
+        return partials
+
+    def unlink(self):
+        self._mark_journal_report_dirty()
+        return super().unlink()
+
+    def _mark_journal_report_dirty(self):
+        moves = self.mapped("debit_move_id.move_id") | self.mapped(
+            "credit_move_id.move_id"
+        )
+        self.env["l10n.ro.account.report.journal.snapshot.line"]._mark_dirty(
+            moves.ids
+        )
@@ -0,0 +1,217 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import csv
+import io
+import json
+import logging
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+SUMMARY_COLUMNS = [
+    "total",
+    "total_base",
+    "total_vat",
+    "base_19",
+    "tva_19",
+    "base_9",
+    "tva_9",
+    "base_5",
+    "tva_5",
+    "base_0",
+    "invers",
+    "base_neex",
+    "tva_neex",
+    "base_exig",
+    "tva_exig",
+    "scutit1",
+    "scutit2",
+]
+
+
+class AccountReportJournalBatch(models.Model):
+    _name = "l10n.ro.account.report.journal.batch"
+    _description = "Sale Purchase Journal Batch"
+    _order = "id desc"
+
+    # the journals of many companies are computed by background jobs, one
+    # PDF for each company and journal type, and a summary CSV when all the
+    # jobs are finished
+
+    name = fields.Char(compute="_compute_name", store=True)
+    company_ids = fields.Many2many(
+        "res.company",
+        string="Companies",
+        required=True,
+        default=lambda self: self._default_company_ids(),
+    )
+    journal_type = fields.Selection(
+        selection=[
+            ("purchase", "Purchase = In invoices"),
+            ("sale", "Sale = Out invoices"),
+            ("both", "Sale and Purchase"),
+        ],
+        default="sale",
+        required=True,
+    )
+    date_range_id = fields.Many2one(comodel_name="date.range", string="Date range")
+    date_from = fields.Date("Start Date", required=True)
+    date_to = fields.Date("End Date", required=True)
+    show_warnings = fields.Boolean(default=True)
+    state = fields.Selection(
+        [("draft", "Draft"), ("running", "Running"), ("done", "Done")],
+        default="draft",
+        readonly=True,
+    )
+    line_ids = fields.One2many(
+        "l10n.ro.account.report.journal.batch.line", "batch_id", readonly=True
+    )
+    summary_attachment_id = fields.Many2one("ir.attachment", readonly=True)
+
+    @api.model
+    def _default_company_ids(self):
+        romania = self.env.ref("base.ro")
+        return self.env["res.company"].search([("country_id", "=", romania.id)])
+
+    @api.depends("journal_type", "date_from", "date_to")
+    def _compute_name(self):
+        for batch in self:
+            batch.name = "%s %s - %s" % (
+                batch.journal_type or "",
+                batch.date_from or "",
+                batch.date_to or "",
+            )
+
+    @api.onchange("date_range_id")
+    def onchange_date_range_id(self):
+        if self.date_range_id:
+            self.date_from = self.date_range_id.date_start
+            self.date_to = self.date_range_id.date_end
+
+    def _get_forms(self):
+        self.ensure_one()
+        journal_types = (
+            ["sale", "purchase"] if self.journal_type == "both" else [self.journal_type]
+        )
+        return [
+            {
+                "company_id": (company.id, company.name),
+                "journal_type": journal_type,
+                "date_from": fields.Date.to_string(self.date_from),
+                "date_to": fields.Date.to_string(self.date_to),
+                "show_warnings": self.show_warnings,
+                "use_snapshot": True,
+                "engine": "sql",
+            }
+            for company in self.company_ids
+            for journal_type in journal_types
+        ]
+
+    def action_run(self):
+        """queues a background job for every company and journal type, the
+        batch is done when all of them are finished"""
+        self.ensure_one()
+        if not self.company_ids:
+            raise UserError(_("Select at least one company."))
+        self.line_ids.unlink()
+        job_obj = self.env["l10n.ro.account.report.journal.job"]
+        for form in self._get_forms():
+            self.env["l10n.ro.account.report.journal.batch.line"].create(
+                {
+                    "batch_id": self.id,
+                    "company_id": form["company_id"][0],
+                    "journal_type": form["journal_type"],
+                    "job_id": job_obj._create_from_form(form).id,
+                }
+            )
+        self.write({"state": "running", "summary_attachment_id": False})
+        return True
+
+    def _check_jobs_finished(self):
+        """completes the running batches whose jobs are all finished with
+        the results of the jobs and the summary CSV"""
+        for batch in self.filtered(lambda b: b.state == "running"):
+            if any(
+                line.job_id.state not in ("done", "failed") for line in batch.line_ids
+            ):
+                continue
+            for line in batch.line_ids:
+                line._update_from_job()
+            batch.summary_attachment_id = self.env["ir.attachment"].create(
+                {
+                    "name": "summary_%s.csv" % batch.name.replace(" ", "_"),
+                    "raw": batch._get_summary_csv(),
+                    "res_model": batch._name,
+                    "res_id": batch.id,
+                    "mimetype": "text/csv",
+                }
+            )
+            batch.state = "done"
+
+    def _get_summary_csv(self):
+        stream = io.StringIO()
+        writer = csv.writer(stream)
+        writer.writerow(["Company", "VAT", "Journal", "Invoices"] + SUMMARY_COLUMNS)
+        for line in self.line_ids:
+            totals = json.loads(line.job_id.totals or "{}")
+            writer.writerow(
+                [
+                    line.company_id.name,
+                    line.company_id.vat or "",
+                    line.journal_type,
+                    line.line_count,
+                ]
+                + [
+                    "ERROR" if line.error else totals.get(key, 0.0)
+                    for key in SUMMARY_COLUMNS
+                ]
+            )
+        return stream.getvalue().encode("utf-8")
+
+
+class AccountReportJournalBatchLine(models.Model):
+    _name = "l10n.ro.account.report.journal.batch.line"
+    _description = "Sale Purchase Journal Batch Company Result"
+
+    batch_id = fields.Many2one(
+        "l10n.ro.account.report.journal.batch", required=True, ondelete="cascade"
+    )
+    company_id = fields.Many2one("res.company", required=True)
+    journal_type = fields.Selection(
+        selection=[("purchase", "Purchase"), ("sale", "Sale")]
+    )
+    job_id = fields.Many2one("l10n.ro.account.report.journal.job", readonly=True)
+    line_count = fields.Integer("Invoices")
+    total = fields.Float()
+    total_base = fields.Float()
+    total_vat = fields.Float()
+    attachment_id = fields.Many2one("ir.attachment")
+    error = fields.Text()
+
+    def _update_from_job(self):
+        for line in self:
+            job = line.job_id
+            totals = json.loads(job.totals or "{}")
+            line.write(
+                {
+                    "line_count": job.line_count,
+                    "total": totals.get("total", 0.0),
+                    "total_base": totals.get("total_base", 0.0),
+                    "total_vat": totals.get("total_vat", 0.0),
+                    "attachment_id": job.attachment_id.id,
+                    "error": job.error if job.state == "failed" else False,
+                }
+            )
+
+    def action_download(self):
+        self.ensure_one()
+        if not self.attachment_id:
+            return False
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % self.attachment_id.id,
+            "target": "self",
+        }
@@ -0,0 +1,430 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+import logging
+import threading
+import traceback
+from datetime import timedelta
+
+from psycopg2.extensions import TransactionRollbackError
+
+import odoo
+from odoo import _, api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+def _run_pending_jobs(dbname, uid, context):
+    """the loop of a job worker thread: claims and runs the pending jobs
+    one by one, with its own cursor, until there is none"""
+    with api.Environment.manage(), odoo.registry(dbname).cursor() as cr:
+        job_obj = api.Environment(cr, uid, context)["l10n.ro.account.report.journal.job"]
+        while True:
+            job = job_obj._claim_pending()
+            if not job:
+                break
+            job._run_claimed()
+
+
+class AccountReportJournalJob(models.Model):
+    _name = "l10n.ro.account.report.journal.job"
+    _description = "Sale Purchase Journal Background Job"
+    _order = "id desc"
+
+    # big journals are computed and rendered by the cron, the result is
+    # stored as attachment and the user downloads it when is done
+
+    name = fields.Char(required=True, readonly=True)
+    company_id = fields.Many2one("res.company", required=True, readonly=True)
+    user_id = fields.Many2one(
+        "res.users", readonly=True, default=lambda self: self.env.user
+    )
+    form_data = fields.Text(readonly=True, help="The wizard options as JSON")
+    periods = fields.Text(
+        readonly=True,
+        help="The (date_from, date_to) periods as JSON: the journals of all "
+        "the periods are computed together and a job renders every period",
+    )
+    parent_id = fields.Many2one(
+        "l10n.ro.account.report.journal.job", readonly=True, ondelete="cascade"
+    )
+    report_format = fields.Selection(
+        [("pdf", "PDF"), ("html", "HTML"), ("snapshot", "Snapshot only")],
+        default="pdf",
+        required=True,
+        help="Snapshot only: the journal is computed and stored, not rendered "
+        "(for the view of the journal in the browser)",
+    )
+    state = fields.Selection(
+        [
+            ("pending", "Pending"),
+            ("running", "Running"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+    )
+    progress_done = fields.Integer("Invoices processed", compute="_compute_progress_counts")
+    progress_total = fields.Integer("Invoices", compute="_compute_progress_counts")
+    progress = fields.Float(compute="_compute_progress")
+    date_started = fields.Datetime("Started", readonly=True)
+    attachment_id = fields.Many2one("ir.attachment", readonly=True)
+    line_count = fields.Integer("Lines", readonly=True)
+    totals = fields.Text(readonly=True, help="The journal totals as JSON")
+    error = fields.Text(readonly=True)
+
+    @api.depends("state")
+    def _compute_progress_counts(self):
+        progress = {
+            row["job_id"]: row
+            for row in self.env["l10n.ro.account.report.journal.job.progress"]
+            .sudo()
+            .search_read([("job_id", "in", self.ids)], ["job_id", "done", "total"])
+        }
+        for job in self:
+            row = progress.get(job.id, {})
+            job.progress_done = row.get("done", 0)
+            job.progress_total = row.get("total", 0)
+
+    @api.depends("progress_done", "progress_total", "state")
+    def _compute_progress(self):
+        for job in self:
+            if job.state == "done":
+                job.progress = 100.0
+            elif job.progress_total:
+                job.progress = 100.0 * job.progress_done / job.progress_total
+            else:
+                job.progress = 0.0
+
+    @api.model
+    def _create_from_form(self, form, report_format="pdf"):
+        job = self.create(
+            {
+                "name": "%s %s - %s"
+                % (form["journal_type"], form["date_from"], form["date_to"]),
+                "company_id": form["company_id"][0],
+                "form_data": json.dumps(form, default=str),
+                "report_format": report_format,
+            }
+        )
+        self.env.ref(
+            "l10n_ro_account_report_journal.ir_cron_journal_report_job"
+        )._trigger()
+        return job
+
+    @api.model
+    def _create_from_periods(self, form, periods, report_format="pdf"):
+        """the job computing the journals of all the periods, it queues a
+        job rendering each one"""
+        job = self.create(
+            {
+                "name": "%s %s - %s (%s periods)"
+                % (form["journal_type"], form["date_from"], form["date_to"], len(periods)),
+                "company_id": form["company_id"][0],
+                "form_data": json.dumps(form, default=str),
+                "periods": json.dumps(periods, default=str),
+                "report_format": report_format,
+            }
+        )
+        self.env.ref(
+            "l10n_ro_account_report_journal.ir_cron_journal_report_job"
+        )._trigger()
+        return job
+
+    @api.model
+    def _get_snapshot_job(self, form):
+        """the pending or running job computing the snapshot of form, or a
+        new one if there is none"""
+        job = self.search(
+            [
+                ("company_id", "=", form["company_id"][0]),
+                ("report_format", "=", "snapshot"),
+                ("form_data", "=", json.dumps(form, default=str)),
+                ("state", "in", ("pending", "running")),
+            ],
+            limit=1,
+        )
+        return job or self._create_from_form(form, "snapshot")
+
+    @api.model
+    def _cron_run_jobs(self):
+        """the pending jobs are run in parallel by job_workers threads, each
+        claiming the next pending job that is not claimed by another worker
+        (of this cron or of another server). The batches are checked when
+        all the workers are finished: while its transaction is running, a
+        worker does not see the jobs finished by the others"""
+        self._recover_stale_jobs()
+        self.env.cr.commit()
+        workers = min(
+            self._get_job_workers(), self.search_count([("state", "=", "pending")])
+        )
+        threads = [
+            threading.Thread(
+                target=_run_pending_jobs,
+                args=(self.env.cr.dbname, self.env.uid, dict(self.env.context)),
+                name="journal_job_worker_%s" % index,
+            )
+            for index in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # a new transaction, that sees the jobs committed by the workers
+        self.env.cr.commit()
+        self.invalidate_cache()
+        self.env["l10n.ro.account.report.journal.batch"].search(
+            [("state", "=", "running")]
+        )._check_jobs_finished()
+
+    @api.model
+    def _get_job_workers(self):
+        workers = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ro_account_report_journal.job_workers", 2)
+            or 0
+        )
+        return max(workers, 1)
+
+    @api.model
+    def _claim_pending(self):
+        """marks as running and returns the oldest pending job, or an empty
+        recordset if there is none. The job row stays locked until the
+        commit, the other workers skip it"""
+        while True:
+            try:
+                self.env.cr.execute(
+                    """
+                    SELECT id FROM l10n_ro_account_report_journal_job
+                    WHERE state = 'pending'
+                    ORDER BY id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                    """
+                )
+                row = self.env.cr.fetchone()
+                if not row:
+                    self.env.cr.rollback()
+                    return self.browse()
+                job = self.browse(row[0])
+                job.write({"state": "running", "date_started": fields.Datetime.now()})
+                self.env.cr.commit()
+                return job
+            except TransactionRollbackError:
+                # claimed and committed by another worker after the start
+                # of this transaction: the next one sees it
+                self.env.cr.rollback()
+
+    def _run_claimed(self):
+        """runs the claimed job and commits its result or its failure"""
+        self.ensure_one()
+        try:
+            self._run()
+            self.env.cr.commit()
+        except Exception:
+            self.env.cr.rollback()
+            _logger.exception("Sale/purchase journal job %s failed", self.id)
+            self.write({"state": "failed", "error": traceback.format_exc()})
+            self.env.cr.commit()
+
+    @api.model
+    def _recover_stale_jobs(self):
+        """the running jobs without sign of life (start or progress) for
+        job_stale_minutes were interrupted (the worker was killed or the
+        server restarted), they are marked as failed to be retried"""
+        minutes = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("l10n_ro_account_report_journal.job_stale_minutes", 60)
+            or 0
+        )
+        if minutes <= 0:
+            return
+        limit = fields.Datetime.now() - timedelta(minutes=minutes)
+        running = self.search([("state", "=", "running")])
+        heartbeats = {
+            row["job_id"]: row["heartbeat"]
+            for row in self.env["l10n.ro.account.report.journal.job.progress"]
+            .sudo()
+            .search_read([("job_id", "in", running.ids)], ["job_id", "heartbeat"])
+        }
+        stale = running.filtered(
+            lambda job: max(
+                filter(None, [job.date_started, heartbeats.get(job.id)]),
+                default=fields.Datetime.to_datetime("1970-01-01"),
+            )
+            < limit
+        )
+        if stale:
+            _logger.warning("Sale/purchase journal jobs %s were interrupted", stale.ids)
+            stale.write(
+                {
+                    "state": "failed",
+                    "error": _(
+                        "The job was interrupted, without progress for %s minutes."
+                    )
+                    % minutes,
+                }
+            )
+
+    def _get_user_env(self):
+        """the environment of the user that asked the journal, with its
+        access rights and the company of the job: the cron is run by the
+        superuser"""
+        self.ensure_one()
+        return self.with_user(self.user_id).with_context(
+            allowed_company_ids=[self.company_id.id],
+            lang=self.user_id.lang,
+        ).env
+
+    def _run(self):
+        """computes the journal (stored in snapshot) reporting the progress
+        and renders it as attachment"""
+        self.ensure_one()
+        if self.periods:
+            return self._run_periods()
+        env = self._get_user_env()
+        form = json.loads(self.form_data)
+        form["use_snapshot"] = True
+        data = {"ids": [], "model": "l10n_ro_account_report_journal", "form": form}
+        snapshot_obj = env["l10n.ro.account.report.journal.snapshot"].with_context(
+            journal_report_progress=self._set_progress
+        )
+        if self.report_format == "snapshot":
+            snapshot = snapshot_obj._get_valid_snapshot(data)
+            self.write(
+                {
+                    "state": "done",
+                    "line_count": snapshot.line_count,
+                    "totals": snapshot.totals,
+                }
+            )
+            return
+        lines, totals = snapshot_obj._get_journal_lines(
+            data, force_recompute=form.get("recompute_snapshot")
+        )
+        # the rendering is taking the lines from the snapshot
+        form["recompute_snapshot"] = False
+        report = env.ref(
+            "l10n_ro_account_report_journal.action_report_sale"
+            + ("_html" if self.report_format == "html" else "")
+        )
+        if self.report_format == "html":
+            content, _content_type = report._render_qweb_html([], data=data)
+        else:
+            content, _content_type = report._render_qweb_pdf([], data=data)
+        attachment = self.env["ir.attachment"].create(
+            {
+                "name": "%s.%s" % (self.name, self.report_format),
+                "raw": content,
+                "res_model": self._name,
+                "res_id": self.id,
+                "mimetype": "application/pdf"
+                if self.report_format == "pdf"
+                else "text/html",
+            }
+        )
+        self.write(
+            {
+                "state": "done",
+                "attachment_id": attachment.id,
+                "line_count": len(lines),
+                "totals": json.dumps(totals),
+            }
+        )
+
+    def _run_periods(self):
+        """computes the journals of all the periods with one data fetch,
+        stores them as snapshots and queues a job rendering each one"""
+        env = self._get_user_env()
+        form = json.loads(self.form_data)
+        periods = [
+            (fields.Date.to_date(date_from), fields.Date.to_date(date_to))
+            for date_from, date_to in json.loads(self.periods)
+        ]
+        data = {"ids": [], "model": "l10n_ro_account_report_journal", "form": form}
+        results = env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ].with_context(journal_report_progress=self._set_progress)._compute_journal_periods(
+            data, periods
+        )
+        for date_from, date_to, invoice_ids, report_lines, totals, fingerprint in results:
+            period_form = dict(
+                form,
+                date_from=fields.Date.to_string(date_from),
+                date_to=fields.Date.to_string(date_to),
+                date_range_id=False,
+                use_snapshot=True,
+                recompute_snapshot=False,
+            )
+            env["l10n.ro.account.report.journal.snapshot"]._store_computed(
+                {"form": period_form}, invoice_ids, report_lines, totals, fingerprint
+            )
+            job = self._create_from_form(period_form, self.report_format)
+            job.write({"parent_id": self.id, "user_id": self.user_id.id})
+        self.write({"state": "done"})
+
+    def _set_progress(self, done, total):
+        """the progress is committed with another cursor to be visible while
+        the job transaction is running. It is kept in its own table, that
+        the job transaction never writes, otherwise the final write of the
+        job would be a concurrent update of the same row. The progress time
+        is the heartbeat of the job, see _recover_stale_jobs"""
+        with self.pool.cursor() as cr:
+            cr.execute(
+                """
+                INSERT INTO l10n_ro_account_report_journal_job_progress
+                       (job_id, done, total, heartbeat)
+                VALUES (%s, %s, %s, now() at time zone 'UTC')
+                ON CONFLICT (job_id)
+                DO UPDATE SET done = EXCLUDED.done, total = EXCLUDED.total,
+                              heartbeat = EXCLUDED.heartbeat
+                """,
+                (self.id, done, total),
+            )
+
+    def unlink(self):
+        self.env["l10n.ro.account.report.journal.job.progress"].sudo().search(
+            [("job_id", "in", self.ids)]
+        ).unlink()
+        return super().unlink()
+
+    def action_download(self):
+        self.ensure_one()
+        if not self.attachment_id:
+            return False
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % self.attachment_id.id,
+            "target": "self",
+        }
+
+    def action_retry(self):
+        self.filtered(lambda j: j.state == "failed").write(
+            {"state": "pending", "error": False}
+        )
+        self.env.ref(
+            "l10n_ro_account_report_journal.ir_cron_journal_report_job"
+        )._trigger()
+        return True
+
+
+class AccountReportJournalJobProgress(models.Model):
+    _name = "l10n.ro.account.report.journal.job.progress"
+    _description = "Sale Purchase Journal Background Job Progress"
+    _log_access = False
+
+    # written only by _set_progress, with its own cursor; there is no
+    # foreign key, the job row is not locked by the progress updates
+    job_id = fields.Integer(required=True, index=True)
+    done = fields.Integer()
+    total = fields.Integer()
+    heartbeat = fields.Datetime(help="The time of the last progress")
+
+    _sql_constraints = [
+        ("job_uniq", "unique(job_id)", "There is one progress for every job.")
+    ]
@@ -0,0 +1,192 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountReportJournalRenderCache(models.Model):
+    _name = "l10n.ro.account.report.journal.render.cache"
+    _description = "Sale Purchase Journal Rendered Report Cache"
+    _order = "last_used desc"
+
+    # the rendered PDF/HTML of a journal is kept as attachment and returned
+    # again while the fingerprint of the data (the same as for snapshots)
+    # is not changed. The report header has the user and the language of the
+    # print, they are in the key; its print time is the one of the rendering,
+    # of the same data as now. The least recently used are removed when
+    # the cache is bigger or older than the limits from system parameters
+
+    company_id = fields.Many2one(
+        "res.company", required=True, readonly=True, ondelete="cascade"
+    )
+    journal_type = fields.Selection(
+        selection=[("purchase", "Purchase"), ("sale", "Sale")],
+        required=True,
+        readonly=True,
+    )
+    date_from = fields.Date("Start Date", required=True, readonly=True)
+    date_to = fields.Date("End Date", required=True, readonly=True)
+    show_warnings = fields.Boolean(readonly=True)
+    report_format = fields.Selection(
+        [("pdf", "PDF"), ("html", "HTML")], required=True, readonly=True
+    )
+    user_id = fields.Many2one("res.users", readonly=True, ondelete="cascade")
+    lang = fields.Char(readonly=True)
+    fingerprint = fields.Char(readonly=True)
+    attachment_id = fields.Many2one("ir.attachment", readonly=True)
+    size = fields.Integer("Size (bytes)", readonly=True)
+    hits = fields.Integer(readonly=True)
+    last_used = fields.Datetime(readonly=True, index=True)
+
+    @api.model
+    def _is_cacheable(self, form):
+        # the timings are different at every print
+        return bool(
+            form
+            and form.get("company_id")
+            and not form.get("show_profile")
+            and not form.get("recompute_snapshot")
+        )
+
+    @api.model
+    def _get_key_domain(self, form, report_format):
+        return [
+            ("company_id", "=", form["company_id"][0]),
+            ("journal_type", "=", form["journal_type"]),
+            ("date_from", "=", form["date_from"]),
+            ("date_to", "=", form["date_to"]),
+            ("show_warnings", "=", bool(form["show_warnings"])),
+            ("report_format", "=", report_format),
+            ("user_id", "=", self.env.uid),
+            ("lang", "=", self.env.context.get("lang") or False),
+        ]
+
+    @api.model
+    def _get_fingerprint(self, form):
+        return self.env["l10n.ro.account.report.journal.snapshot"]._get_fingerprint(
+            self.env["res.company"].browse(form["company_id"][0]),
+            form["journal_type"],
+            form["date_from"],
+            form["date_to"],
+        )
+
+    @api.model
+    def _get_content(self, form, report_format, fingerprint=None):
+        """returns the cached rendered report or None. The fingerprint of the
+        data can be given if it is already computed"""
+        if not self._is_cacheable(form):
+            return None
+        entry = self.sudo().search(self._get_key_domain(form, report_format), limit=1)
+        if not entry:
+            return None
+        if fingerprint is None:
+            fingerprint = self._get_fingerprint(form)
+        if entry.fingerprint != fingerprint or not entry.attachment_id:
+            entry._purge()
+            return None
+        # the hit is written with SQL, it is not an user change
+        self.env.cr.execute(
+            """
+            UPDATE l10n_ro_account_report_journal_render_cache
+               SET hits = hits + 1, last_used = now() at time zone 'UTC'
+             WHERE id = %s
+            """,
+            (entry.id,),
+        )
+        entry.invalidate_cache(["hits", "last_used"], entry.ids)
+        return entry.attachment_id.raw
+
+    @api.model
+    def _store_content(self, form, report_format, content, fingerprint=None):
+        """caches the rendered report. The fingerprint must be the one of
+        the data before the rendering, computed again if not given"""
+        if not self._is_cacheable(form) or not content:
+            return self.browse()
+        if fingerprint is None:
+            fingerprint = self._get_fingerprint(form)
+        if isinstance(content, str):
+            content = content.encode()
+        self.sudo().search(self._get_key_domain(form, report_format))._purge()
+        attachment = (
+            self.env["ir.attachment"]
+            .sudo()
+            .create(
+                {
+                    "name": "journal_%s_%s_%s.%s"
+                    % (
+                        form["journal_type"],
+                        form["date_from"],
+                        form["date_to"],
+                        report_format,
+                    ),
+                    "raw": content,
+                    "res_model": self._name,
+                    "mimetype": "application/pdf"
+                    if report_format == "pdf"
+                    else "text/html",
+                }
+            )
+        )
+        entry = self.sudo().create(
+            {
+                "company_id": form["company_id"][0],
+                "journal_type": form["journal_type"],
+                "date_from": form["date_from"],
+                "date_to": form["date_to"],
+                "show_warnings": bool(form["show_warnings"]),
+                "report_format": report_format,
+                "user_id": self.env.uid,
+                "lang": self.env.context.get("lang") or False,
+                "fingerprint": fingerprint,
+                "attachment_id": attachment.id,
+                "size": len(content),
+                "last_used": fields.Datetime.now(),
+            }
+        )
+        attachment.res_id = entry.id
+        self._evict()
+        return entry
+
+    @api.model
+    def _evict(self):
+        """removes the entries not used for more than render_cache_max_days
+        and the least recently used ones over render_cache_max_mb"""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        max_days = int(
+            get_param("l10n_ro_account_report_journal.render_cache_max_days", 30)
+        )
+        max_bytes = (
+            int(get_param("l10n_ro_account_report_journal.render_cache_max_mb", 500))
+            * 1024
+            * 1024
+        )
+        cache = self.sudo()
+        to_purge = cache.browse()
+        if max_days > 0:
+            to_purge |= cache.search(
+                [("last_used", "<", fields.Datetime.now() - timedelta(days=max_days))]
+            )
+        if max_bytes > 0:
+            used = 0
+            for entry in cache.search_read([("id", "not in", to_purge.ids)], ["size"]):
+                used += entry["size"]
+                if used > max_bytes:
+                    to_purge |= cache.browse(entry["id"])
+        if to_purge:
+            _logger.info("Journal render cache: removing %s entries", len(to_purge))
+            to_purge._purge()
+
+    def _purge(self):
+        attachments = self.mapped("attachment_id")
+        self.unlink()
+        attachments.unlink()
+
+    @api.model
+    def action_purge_all(self):
+        self.sudo().search([])._purge()
+        return True
@@ -0,0 +1,516 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+
+from psycopg2.extras import execute_values
+
+from odoo import api, fields, models, tools
+from odoo.tools.misc import split_every
+
+from ..report.journal_engine import IN_CHUNK_SIZE, JOURNAL_MOVE_TYPES
+
+
+class AccountReportJournalSnapshot(models.Model):
+    _name = "l10n.ro.account.report.journal.snapshot"
+    _description = "Sale Purchase Journal Snapshot"
+    _order = "date_from desc, id desc"
+
+    # the computed report lines of a period are stored here, so a closed
+    # month can be printed again without computing it. A snapshot is valid
+    # as long as its fingerprint is the same as the one of the database.
+    # If it is not, only the lines of the invoices that were marked as dirty
+    # (posted, reset, modified, reconciled) or are new in the period are
+    # computed again
+
+    company_id = fields.Many2one(
+        "res.company", required=True, readonly=True, ondelete="cascade"
+    )
+    journal_type = fields.Selection(
+        selection=[("purchase", "Purchase"), ("sale", "Sale")],
+        required=True,
+        readonly=True,
+    )
+    date_from = fields.Date("Start Date", required=True, readonly=True)
+    date_to = fields.Date("End Date", required=True, readonly=True)
+    show_warnings = fields.Boolean(readonly=True)
+    fingerprint = fields.Char(
+        readonly=True,
+        help="Counts and last write dates of the invoices, tax cash basis "
+        "moves and tags of the period at the moment of computation.",
+    )
+    computed_on = fields.Datetime(readonly=True)
+    totals = fields.Text(readonly=True)
+    line_count = fields.Integer(readonly=True)
+    line_ids = fields.One2many(
+        "l10n.ro.account.report.journal.snapshot.line", "snapshot_id", readonly=True
+    )
+
+    _sql_constraints = [
+        (
+            "period_uniq",
+            "unique(company_id, journal_type, date_from, date_to, show_warnings)",
+            "There is already a snapshot for this journal and period.",
+        )
+    ]
+
+    @api.model
+    def _get_fingerprint(self, company, journal_type, date_from, date_to):
+        """Cheap signature of the data that can be in the journal of the
+        period: count and last write date of the posted invoices of the
+        period, of the older not paid ones (VAT on payment candidates, from
+        the look-back limit), of the tax cash basis moves of the period and
+        of the tags. Each count is bounded by one of the journal indexes,
+        the history of the company is not read.
+
+        A reconciliation changes the payment state (and write date) of the
+        invoice and makes a tax cash basis move, so it is seen by the counts
+        of the moves"""
+        self.env["account.move"].flush()
+        cr = self.env.cr
+        report_obj = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]
+        move_types = JOURNAL_MOVE_TYPES[journal_type]
+        cr.execute(
+            """
+            SELECT COUNT(*), MAX(write_date)
+              FROM account_move
+             WHERE state = 'posted'
+               AND company_id = %s
+               AND move_type IN %s
+               AND invoice_date >= %s
+               AND invoice_date <= %s
+            """,
+            (company.id, move_types, date_from, date_to),
+        )
+        moves = cr.fetchone()
+        date_limit = report_obj._get_cash_basis_lookback_limit(date_from)
+        cr.execute(
+            """
+            SELECT COUNT(*), MAX(write_date)
+              FROM account_move
+             WHERE state = 'posted'
+               AND payment_state IN ('partial', 'not_paid')
+               AND company_id = %(company_id)s
+               AND move_type IN %(move_types)s
+               AND invoice_date < %(date_from)s
+               {date_limit}
+            """.format(
+                date_limit="AND invoice_date >= %(date_limit)s" if date_limit else ""
+            ),
+            {
+                "company_id": company.id,
+                "move_types": move_types,
+                "date_from": date_from,
+                "date_limit": date_limit,
+            },
+        )
+        older = cr.fetchone()
+        cr.execute(
+            """
+            SELECT COUNT(*), MAX(write_date)
+              FROM account_move
+             WHERE state = 'posted'
+               AND tax_cash_basis_rec_id IS NOT NULL
+               AND journal_id = %s
+               AND date >= %s
+               AND date <= %s
+            """,
+            (company.tax_cash_basis_journal_id.id or 0, date_from, date_to),
+        )
+        cash_basis = cr.fetchone()
+        cr.execute("SELECT COUNT(*), MAX(write_date) FROM account_account_tag")
+        tags = cr.fetchone()
+        # the lines are classified also by the partner accounts, with the
+        # tags as they are changing all the lines
+        prefixes = ",".join(report_obj._get_partner_account_prefixes())
+        return "moves:%s:%s|older:%s:%s|cash_basis:%s:%s|tags:%s:%s:%s" % (
+            moves + older + cash_basis + tags + (prefixes,)
+        )
+
+    @api.model
+    def _get_snapshot(self, form):
+        return self.search(
+            [
+                ("company_id", "=", form["company_id"][0]),
+                ("journal_type", "=", form["journal_type"]),
+                ("date_from", "=", form["date_from"]),
+                ("date_to", "=", form["date_to"]),
+                ("show_warnings", "=", bool(form["show_warnings"])),
+            ],
+            limit=1,
+        )
+
+    @api.model
+    def _get_journal_lines(self, data, force_recompute=False):
+        """returns the report lines and totals for the period of data, from
+        the stored snapshot if it is still valid, otherwise they are
+        computed and stored. The fingerprint is read on the report cursor
+        the lines are computed from, it is the one of their data"""
+        form = data["form"]
+        company = self.env["res.company"].browse(form["company_id"][0])
+        report_obj = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]
+        with report_obj._report_env() as env:
+            with report_obj._profile_phase("snapshot check"):
+                fingerprint = self.with_env(env)._get_fingerprint(
+                    company, form["journal_type"], form["date_from"], form["date_to"]
+                )
+                snapshot = self._get_snapshot(form)
+            if snapshot and not force_recompute:
+                if snapshot.fingerprint == fingerprint:
+                    with report_obj._profile_phase("snapshot load"):
+                        return snapshot._load_lines()
+                if snapshot._can_update(fingerprint):
+                    with report_obj._profile_phase("snapshot update"):
+                        return snapshot._update_lines(
+                            report_obj.with_env(env), data, fingerprint
+                        )
+            invoices, report_lines, totals = report_obj.with_env(env)._compute_journal(data)
+        with report_obj._profile_phase("snapshot store"):
+            self._store_computed(data, invoices.ids, report_lines, totals, fingerprint)
+        return report_lines, totals
+
+    @api.model
+    def _get_current_snapshot(self, data):
+        """returns the snapshot of the period of data if it is valid, without
+        computing or updating it"""
+        form = data["form"]
+        snapshot = self._get_snapshot(form)
+        if not snapshot:
+            return snapshot
+        report_obj = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]
+        with report_obj._report_env() as env:
+            fingerprint = self.with_env(env)._get_fingerprint(
+                snapshot.company_id, form["journal_type"], form["date_from"], form["date_to"]
+            )
+        return snapshot if snapshot.fingerprint == fingerprint else self.browse()
+
+    @api.model
+    def _get_valid_snapshot(self, data):
+        """returns the snapshot of the period of data, computed or updated
+        if it is not valid anymore, without loading its lines"""
+        form = data["form"]
+        report_obj = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]
+        with report_obj._report_env() as env:
+            fingerprint = self.with_env(env)._get_fingerprint(
+                self.env["res.company"].browse(form["company_id"][0]),
+                form["journal_type"],
+                form["date_from"],
+                form["date_to"],
+            )
+            snapshot = self._get_snapshot(form)
+            if snapshot:
+                if snapshot.fingerprint == fingerprint:
+                    return snapshot
+                if snapshot._can_update(fingerprint):
+                    snapshot._update_lines(report_obj.with_env(env), data, fingerprint)
+                    return snapshot
+            return self._store_stream(report_obj.with_env(env), data, fingerprint)
+
+    @api.model
+    def _store_stream(self, report_obj, data, fingerprint):
+        """computes the lines of the period of data in stream (SQL engine,
+        with report_obj in the report environment) and stores them as
+        snapshot batch by batch, the lines of the period are never all in
+        memory"""
+        snapshot = self._get_or_create_snapshot(data["form"])
+        snapshot._delete_lines()
+        totals = report_obj._new_totals()
+        line_count = 0
+        rows = report_obj._stream_invoice_rows_sql(data, totals)
+        for batch in split_every(IN_CHUNK_SIZE, rows, list):
+            snapshot._insert_lines(
+                [
+                    (line_count + index, invoice_id, vals)
+                    for index, (invoice_id, vals) in enumerate(batch)
+                ]
+            )
+            line_count += len(batch)
+        snapshot.invalidate_cache(["line_ids"], snapshot.ids)
+        snapshot._write_summary(fingerprint, line_count, totals.as_dict())
+        return snapshot
+
+    def _read_page(self, after=-1, limit=200):
+        """returns (sequence, line as JSON text) of the lines after the
+        sequence after, in the report order. The sequence of the last line
+        is the cursor of the next page"""
+        self.ensure_one()
+        self.env.cr.execute(
+            """
+            SELECT sequence, data
+              FROM l10n_ro_account_report_journal_snapshot_line
+             WHERE snapshot_id = %s AND sequence > %s
+             ORDER BY sequence
+             LIMIT %s
+            """,
+            (self.id, after, limit),
+        )
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _store_computed(self, data, invoice_ids, report_lines, totals, fingerprint=None):
+        """stores the lines computed for the period of data as snapshot, the
+        fingerprint is the one read with the lines (by default the current
+        one of the report cursor)"""
+        form = data["form"]
+        company = self.env["res.company"].browse(form["company_id"][0])
+        if fingerprint is None:
+            report_obj = self.env[
+                "report.l10n_ro_account_report_journal.report_sale_purchase"
+            ]
+            with report_obj._report_env() as env:
+                fingerprint = self.with_env(env)._get_fingerprint(
+                    company, form["journal_type"], form["date_from"], form["date_to"]
+                )
+        snapshot = self._get_or_create_snapshot(form)
+        snapshot._store_lines(invoice_ids, report_lines, totals, fingerprint)
+        return snapshot
+
+    @api.model
+    def _get_or_create_snapshot(self, form):
+        return self._get_snapshot(form) or self.create(
+            {
+                "company_id": form["company_id"][0],
+                "journal_type": form["journal_type"],
+                "date_from": form["date_from"],
+                "date_to": form["date_to"],
+                "show_warnings": bool(form["show_warnings"]),
+            }
+        )
+
+    def _can_update(self, fingerprint):
+        """the lines can be updated only for the invoices changes, if the
+        tags were changed all the lines must be computed again"""
+        self.ensure_one()
+        if not self.fingerprint:
+            return False
+        return self.fingerprint.split("|")[-1] == fingerprint.split("|")[-1]
+
+    def _update_lines(self, report_obj, data, fingerprint):
+        """computes again only the dirty lines and the lines of the invoices
+        that are new in the report, removes the lines of the invoices that
+        are not anymore in the report and returns all the lines. The
+        invoices are selected and computed by report_obj, in the report
+        environment"""
+        self.ensure_one()
+        form = data["form"]
+        cr = self.env.cr
+        invoices = report_obj._get_forreport_invoices_payments(
+            data, form["journal_type"]
+        )
+        invoice_ids = invoices.ids
+        cr.execute(
+            """
+            SELECT invoice_id, id
+              FROM l10n_ro_account_report_journal_snapshot_line
+             WHERE snapshot_id = %s
+            """,
+            (self.id,),
+        )
+        stored = dict(cr.fetchall())
+        # the dirty flags are read on the report cursor, with the changes
+        # of the invoices: a change it does not see yet (on a replica) is
+        # still dirty the next time
+        report_obj.env.cr.execute(
+            """
+            SELECT invoice_id
+              FROM l10n_ro_account_report_journal_snapshot_line
+             WHERE snapshot_id = %s AND dirty
+            """,
+            (self.id,),
+        )
+        dirty_ids = {row[0] for row in report_obj.env.cr.fetchall()}
+        in_report = set(invoice_ids)
+        obsolete_line_ids = [
+            line_id
+            for invoice_id, line_id in stored.items()
+            if invoice_id in dirty_ids or invoice_id not in in_report
+        ]
+        if obsolete_line_ids:
+            cr.execute(
+                "DELETE FROM l10n_ro_account_report_journal_snapshot_line"
+                " WHERE id IN %s",
+                (tuple(obsolete_line_ids),),
+            )
+        sequences = {invoice_id: seq for seq, invoice_id in enumerate(invoice_ids)}
+        to_compute = invoices.filtered(
+            lambda inv: inv.id not in stored or inv.id in dirty_ids
+        )
+        if to_compute:
+            new_lines, _totals = report_obj._compute_invoices_lines(to_compute, data)
+            self._insert_lines(
+                [
+                    (sequences[invoice_id], invoice_id, vals)
+                    for invoice_id, vals in zip(to_compute.ids, new_lines)
+                ]
+            )
+        if obsolete_line_ids or to_compute:
+            # the invoices order is invoice_date, name so the new lines can
+            # be anywhere
+            cr.execute(
+                """
+                SELECT id, invoice_id, sequence
+                  FROM l10n_ro_account_report_journal_snapshot_line
+                 WHERE snapshot_id = %s
+                """,
+                (self.id,),
+            )
+            resequence = [
+                (line_id, sequences[invoice_id])
+                for line_id, invoice_id, sequence in cr.fetchall()
+                if sequences[invoice_id] != sequence
+            ]
+            if resequence:
+                execute_values(
+                    cr._obj,
+                    """
+                    UPDATE l10n_ro_account_report_journal_snapshot_line l
+                       SET sequence = v.sequence
+                      FROM (VALUES %s) AS v(id, sequence)
+                     WHERE l.id = v.id
+                    """,
+                    resequence,
+                    page_size=1000,
+                )
+        self.invalidate_cache(["line_ids"], self.ids)
+        report_lines, _totals = self._load_lines()
+        totals = report_obj._compute_totals(report_lines)
+        self._write_summary(fingerprint, len(report_lines), totals)
+        return report_lines, totals
+
+    def _delete_lines(self):
+        self.ensure_one()
+        self.env.cr.execute(
+            "DELETE FROM l10n_ro_account_report_journal_snapshot_line"
+            " WHERE snapshot_id = %s",
+            (self.id,),
+        )
+
+    def _store_lines(self, invoice_ids, report_lines, totals, fingerprint):
+        self._delete_lines()
+        self._insert_lines(
+            [
+                (sequence, invoice_id, vals)
+                for sequence, (invoice_id, vals) in enumerate(
+                    zip(invoice_ids, report_lines)
+                )
+            ]
+        )
+        self.invalidate_cache(["line_ids"], self.ids)
+        self._write_summary(fingerprint, len(report_lines), totals)
+
+    def _write_summary(self, fingerprint, line_count, totals):
+        self.write(
+            {
+                "fingerprint": fingerprint,
+                "computed_on": fields.Datetime.now(),
+                "totals": json.dumps(totals),
+                "line_count": line_count,
+            }
+        )
+
+    def _insert_lines(self, lines):
+        """inserts the (sequence, invoice_id, report line) in the snapshot"""
+        self.ensure_one()
+        now = fields.Datetime.now()
+        execute_values(
+            self.env.cr._obj,
+            """
+            INSERT INTO l10n_ro_account_report_journal_snapshot_line
+                   (snapshot_id, invoice_id, sequence, data, dirty,
+                    create_uid, create_date, write_uid, write_date)
+            VALUES %s
+            """,
+            [
+                (
+                    self.id,
+                    invoice_id,
+                    sequence,
+                    self._dump_row(vals),
+                    False,
+                    self.env.uid,
+                    now,
+                    self.env.uid,
+                    now,
+                )
+                for sequence, invoice_id, vals in lines
+            ],
+            page_size=1000,
+        )
+
+    def _load_lines(self):
+        self.ensure_one()
+        self.env.cr.execute(
+            """
+            SELECT data FROM l10n_ro_account_report_journal_snapshot_line
+             WHERE snapshot_id = %s
+             ORDER BY sequence
+            """,
+            (self.id,),
+        )
+        report_lines = [self._load_row(data) for (data,) in self.env.cr.fetchall()]
+        return report_lines, json.loads(self.totals or "{}")
+
+    @api.model
+    def _dump_row(self, vals):
+        return json.dumps(dict(vals), default=fields.Date.to_string)
+
+    @api.model
+    def _load_row(self, data):
+        vals = json.loads(data)
+        vals["date"] = fields.Date.to_date(vals["date"]) or False
+        for payment in vals.get("payments", []):
+            payment["date"] = fields.Date.to_date(payment["date"]) or False
+        return vals
+
+
+class AccountReportJournalSnapshotLine(models.Model):
+    _name = "l10n.ro.account.report.journal.snapshot.line"
+    _description = "Sale Purchase Journal Snapshot Line"
+    _order = "snapshot_id, sequence"
+
+    snapshot_id = fields.Many2one(
+        "l10n.ro.account.report.journal.snapshot",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    invoice_id = fields.Many2one("account.move", index=True, ondelete="cascade")
+    sequence = fields.Integer()
+    data = fields.Text(help="The report line as JSON")
+    dirty = fields.Boolean(
+        help="The invoice was changed after the line was computed, the line "
+        "will be computed again at the next print."
+    )
+
+    def init(self):
+        # the pages of the lazy view are read by sequence
+        tools.create_index(
+            self.env.cr,
+            "l10n_ro_account_report_journal_snapshot_line_seq_idx",
+            self._table,
+            ["snapshot_id", "sequence"],
+        )
+
+    @api.model
+    def _mark_dirty(self, invoice_ids):
+        """marks the stored report lines of the invoices to be computed again"""
+        invoice_ids = tuple(set(invoice_ids))
+        if not invoice_ids:
+            return
+        self.env.cr.execute(
+            """
+            UPDATE l10n_ro_account_report_journal_snapshot_line
+               SET dirty = TRUE
+             WHERE invoice_id IN %s AND dirty IS NOT TRUE
+            """,
+            (invoice_ids,),
+        )
+        self.invalidate_cache(["dirty"])
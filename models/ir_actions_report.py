@@ -0,0 +1,69 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+import time
+
+from odoo import models, tools
+
+_logger = logging.getLogger(__name__)
+
+JOURNAL_REPORT = "l10n_ro_account_report_journal.report_sale_purchase"
+
+
+class IrActionsReport(models.Model):
+    _inherit = "ir.actions.report"
+
+    def _render_qweb_pdf(self, res_ids=None, data=None):
+        if self.report_name != JOURNAL_REPORT:
+            return super()._render_qweb_pdf(res_ids=res_ids, data=data)
+        return self._render_journal_cached(
+            "pdf", lambda: self._render_journal_pdf(res_ids, data), data
+        )
+
+    def _render_journal_pdf(self, res_ids, data):
+        # big sale/purchase journals are rendered in parallel chunks
+        if (
+            data
+            and data.get("form")
+            and (
+                not tools.config["test_enable"]
+                or self.env.context.get("force_report_rendering")
+            )
+        ):
+            pdf = self.env["report." + JOURNAL_REPORT]._render_pdf_chunked(
+                self, data
+            )
+            if pdf:
+                return pdf, "pdf"
+        return super()._render_qweb_pdf(res_ids=res_ids, data=data)
+
+    def _render_qweb_html(self, docids, data=None):
+        if self.report_name != JOURNAL_REPORT:
+            return super()._render_qweb_html(docids, data=data)
+        return self._render_journal_cached(
+            "html",
+            lambda: super(IrActionsReport, self)._render_qweb_html(docids, data=data),
+            data,
+        )
+
+    def _render_journal_cached(self, report_format, render, data):
+        """returns the journal from the render cache if the data of the
+        period was not changed, otherwise renders and caches it. The
+        fingerprint is computed once, before the rendering"""
+        cache = self.env["l10n.ro.account.report.journal.render.cache"]
+        form = (data or {}).get("form")
+        fingerprint = cache._get_fingerprint(form) if cache._is_cacheable(form) else None
+        content = cache._get_content(form, report_format, fingerprint)
+        if content:
+            _logger.info("Journal %s taken from the render cache", report_format)
+            return content, report_format
+        start = time.perf_counter()
+        content, content_type = render()
+        _logger.info(
+            "Journal %s rendered in %.1fms",
+            report_format,
+            (time.perf_counter() - start) * 1000,
+        )
+        cache._store_content(form, report_format, content, fingerprint)
+        return content, content_type
@@ -0,0 +1,835 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Set based computation of the sale/purchase journal lines.
+
+The engine works only with a database cursor, it does not use the ORM, so
+it can read a whole period with a few grouped queries over
+account_move_line instead of walking every line and tag record.
+"""
+
+import itertools
+
+import psycopg2
+import psycopg2.extensions
+
+from odoo.tools.misc import split_every
+
+IN_CHUNK_SIZE = 5000
+NEEX_COLUMNS = ("base_neex", "tva_neex")
+_stream_names = itertools.count()
+
+JOURNAL_MOVE_TYPES = {
+    "sale": ("out_invoice", "out_refund", "out_receipt"),
+    "purchase": ("in_invoice", "in_refund", "in_receipt"),
+}
+
+# indexes for the predicates of the queries below, table -> [(name, definition)]
+# the partial ones keep only the rows that the report can select
+JOURNAL_INDEXES = {
+    "account_move": [
+        (
+            "l10n_ro_journal_move_invoice_date_idx",
+            "(company_id, move_type, invoice_date) WHERE state = 'posted'",
+        ),
+        (
+            "l10n_ro_journal_move_unpaid_idx",
+            "(company_id, move_type, invoice_date) WHERE state = 'posted'"
+            " AND payment_state IN ('partial', 'not_paid')",
+        ),
+        (
+            "l10n_ro_journal_move_cash_basis_idx",
+            "(journal_id, date) WHERE state = 'posted'"
+            " AND tax_cash_basis_rec_id IS NOT NULL",
+        ),
+        (
+            "l10n_ro_journal_move_cash_basis_rec_idx",
+            "(tax_cash_basis_rec_id) WHERE tax_cash_basis_rec_id IS NOT NULL",
+        ),
+    ],
+    "account_move_line": [
+        (
+            "l10n_ro_journal_line_not_exigible_idx",
+            "(move_id) WHERE tax_exigible IS NOT TRUE",
+        ),
+    ],
+    "account_partial_reconcile": [
+        ("l10n_ro_journal_partial_debit_idx", "(debit_move_id, max_date)"),
+        ("l10n_ro_journal_partial_credit_idx", "(credit_move_id, max_date)"),
+    ],
+}
+
+
+def _index_method_definition(indexdef):
+    """the part of a pg_indexes definition after the index and table names:
+    'btree (columns) WHERE predicate', normalized by PostgreSQL"""
+    return indexdef.split(" USING ", 1)[1]
+
+
+def _normalized_index_definition(cr, table, name, definition):
+    """Return the definition PostgreSQL gives to the index definition of
+    table, without creating it: the index is built on an empty temporary
+    copy of the table, rolled back."""
+    cr.execute("SAVEPOINT l10n_ro_journal_index")
+    try:
+        cr.execute(
+            'CREATE TEMPORARY TABLE l10n_ro_journal_index_model (LIKE "%s")' % table
+        )
+        cr.execute(
+            'CREATE INDEX "%s" ON l10n_ro_journal_index_model %s' % (name, definition)
+        )
+        cr.execute(
+            "SELECT indexdef FROM pg_indexes"
+            " WHERE tablename = 'l10n_ro_journal_index_model' AND indexname = %s",
+            (name,),
+        )
+        return _index_method_definition(cr.fetchone()[0])
+    finally:
+        cr.execute("ROLLBACK TO SAVEPOINT l10n_ro_journal_index")
+
+
+def create_journal_indexes(cr, table):
+    """Create the journal indexes of table, at install and upgrade. An index
+    left invalid by an interrupted build, or with another definition (from
+    a previous version of the module), is created again.
+
+    The index is built in the transaction of the upgrade, CREATE INDEX
+    locks the writes on the table until the end of the upgrade. On a big
+    database used meanwhile, create the indexes before the upgrade with
+    CREATE INDEX CONCURRENTLY and the same definition: they are kept."""
+    for name, definition in JOURNAL_INDEXES[table]:
+        cr.execute(
+            """
+            SELECT i.indisvalid, x.indexdef
+              FROM pg_indexes x
+              JOIN pg_namespace n ON n.nspname = x.schemaname
+              JOIN pg_class c ON c.relname = x.indexname AND c.relnamespace = n.oid
+              JOIN pg_index i ON i.indexrelid = c.oid
+             WHERE x.schemaname = current_schema()
+               AND x.tablename = %s
+               AND x.indexname = %s
+            """,
+            (table, name),
+        )
+        row = cr.fetchone()
+        if row:
+            valid, indexdef = row
+            if valid and _index_method_definition(
+                indexdef
+            ) == _normalized_index_definition(cr, table, name, definition):
+                continue
+            cr.execute('DROP INDEX "%s"' % name)
+        cr.execute('CREATE INDEX "%s" ON "%s" %s' % (name, table, definition))
+
+
+def drop_journal_indexes(cr):
+    """Drop the journal indexes of all the tables, at uninstall."""
+    for indexes in JOURNAL_INDEXES.values():
+        for name, _definition in indexes:
+            cr.execute('DROP INDEX IF EXISTS "%s"' % name)
+
+
+def select_older_unpaid_cash_basis_ids(
+    cr, company_id, journal_type, date_from, date_limit=None
+):
+    """Return the ids of the posted invoices dated before date_from (and
+    from date_limit if given) that are not fully paid and have at least one
+    VAT on payment (not exigible) invoice line."""
+    query = """
+        SELECT m.id
+          FROM account_move m
+         WHERE m.state = 'posted'
+           AND m.company_id = %(company_id)s
+           AND m.move_type IN %(move_types)s
+           AND m.invoice_date < %(date_from)s
+           AND m.payment_state IN ('partial', 'not_paid')
+           {date_limit}
+           AND EXISTS (
+                SELECT 1
+                  FROM account_move_line aml
+                 WHERE aml.move_id = m.id
+                   AND aml.exclude_from_invoice_tab IS NOT TRUE
+                   AND (aml.display_type IS NULL
+                        OR aml.display_type NOT IN ('line_section', 'line_note'))
+                   AND aml.tax_exigible IS NOT TRUE
+           )
+    """.format(
+        date_limit="AND m.invoice_date >= %(date_limit)s" if date_limit else ""
+    )
+    cr.execute(
+        query,
+        {
+            "company_id": company_id,
+            "move_types": JOURNAL_MOVE_TYPES[journal_type],
+            "date_from": date_from,
+            "date_limit": date_limit,
+        },
+    )
+    return [row[0] for row in cr.fetchall()]
+
+
+def select_cash_basis_invoice_ids(
+    cr, company_id, journal_type, cash_basis_journal_id, date_from, date_to
+):
+    """Return the distinct ids of the invoices (moves of a journal with type
+    journal_type) that have tax cash basis moves posted between date_from and
+    date_to, resolved from the partial reconcile of each cash basis move."""
+    return list(
+        {
+            invoice_id
+            for invoice_id, _date in select_cash_basis_invoice_dates(
+                cr, company_id, journal_type, cash_basis_journal_id, date_from, date_to
+            )
+        }
+    )
+
+
+def select_cash_basis_invoice_dates(
+    cr, company_id, journal_type, cash_basis_journal_id, date_from, date_to
+):
+    """Same as select_cash_basis_invoice_ids, but returns the distinct
+    (invoice id, cash basis move date) to split them later by periods."""
+    if not cash_basis_journal_id:
+        return []
+    cr.execute(
+        """
+        SELECT DISTINCT CASE WHEN dj.type = %(journal_type)s THEN dm.id
+                             WHEN cj.type = %(journal_type)s THEN cm.id
+                        END,
+               cb.date
+          FROM account_move cb
+          JOIN account_partial_reconcile apr ON apr.id = cb.tax_cash_basis_rec_id
+          JOIN account_move_line dl ON dl.id = apr.debit_move_id
+          JOIN account_move dm ON dm.id = dl.move_id
+          JOIN account_journal dj ON dj.id = dm.journal_id
+          JOIN account_move_line cl ON cl.id = apr.credit_move_id
+          JOIN account_move cm ON cm.id = cl.move_id
+          JOIN account_journal cj ON cj.id = cm.journal_id
+         WHERE cb.state = 'posted'
+           AND cb.company_id = %(company_id)s
+           AND cb.journal_id = %(journal_id)s
+           AND cb.move_type = 'entry'
+           AND cb.tax_cash_basis_rec_id IS NOT NULL
+           AND cb.date >= %(date_from)s
+           AND cb.date <= %(date_to)s
+           AND (dj.type = %(journal_type)s OR cj.type = %(journal_type)s)
+        """,
+        {
+            "company_id": company_id,
+            "journal_type": journal_type,
+            "journal_id": cash_basis_journal_id,
+            "date_from": date_from,
+            "date_to": date_to,
+        },
+    )
+    return cr.fetchall()
+
+
+def select_invoices_in_period(cr, company_id, journal_type, date_from, date_to):
+    """Return the ids of the posted invoices dated in the period."""
+    cr.execute(
+        """
+        SELECT m.id
+          FROM account_move m
+         WHERE m.state = 'posted'
+           AND m.company_id = %s
+           AND m.move_type IN %s
+           AND m.invoice_date >= %s
+           AND m.invoice_date <= %s
+        """,
+        (company_id, JOURNAL_MOVE_TYPES[journal_type], date_from, date_to),
+    )
+    return [row[0] for row in cr.fetchall()]
+
+
+def _report_invoices_query(company_id, journal_type, date_from, date_to, extra_ids):
+    """WHERE clause and parameters of the report invoices: the posted
+    invoices of the period and the extra ids (VAT on payment invoices of
+    other periods)"""
+    where = """
+         WHERE m.id = ANY(%(extra_ids)s)
+            OR (m.state = 'posted'
+                AND m.company_id = %(company_id)s
+                AND m.move_type IN %(move_types)s
+                AND m.invoice_date >= %(date_from)s
+                AND m.invoice_date <= %(date_to)s)
+    """
+    params = {
+        "extra_ids": list(extra_ids),
+        "company_id": company_id,
+        "move_types": JOURNAL_MOVE_TYPES[journal_type],
+        "date_from": date_from,
+        "date_to": date_to,
+    }
+    return where, params
+
+
+def count_report_invoices(cr, company_id, journal_type, date_from, date_to, extra_ids):
+    where, params = _report_invoices_query(
+        company_id, journal_type, date_from, date_to, extra_ids
+    )
+    cr.execute("SELECT COUNT(*) FROM account_move m" + where, params)
+    return cr.fetchone()[0]
+
+
+def stream_report_invoice_ids(
+    cr, company_id, journal_type, date_from, date_to, extra_ids, batch_size=IN_CHUNK_SIZE
+):
+    """Yield batches of the ids of the report invoices in the report order
+    (invoice_date, name). The ids are read with a named (server side)
+    cursor, so they are never all in memory."""
+    where, params = _report_invoices_query(
+        company_id, journal_type, date_from, date_to, extra_ids
+    )
+    # the named cursor lives in the transaction of cr, the other queries of
+    # the engine can be run on cr between the batches
+    stream = cr._cnx.cursor("l10n_ro_journal_stream_%s" % next(_stream_names))
+    try:
+        stream.itersize = batch_size
+        stream.execute(
+            "SELECT m.id FROM account_move m"
+            + where
+            + " ORDER BY m.invoice_date, m.name, m.id",
+            params,
+        )
+        while True:
+            batch = [row[0] for row in stream.fetchmany(batch_size)]
+            if not batch:
+                break
+            yield batch
+    finally:
+        stream.close()
+
+
+def fetch_invoice_dates_in_order(cr, invoice_ids):
+    """Return [(invoice id, invoice_date)] in the order of the report, sorted
+    by the database like the report queries (collation of the names, the
+    invoices without date last)."""
+    if not invoice_ids:
+        return []
+    cr.execute(
+        "SELECT id, invoice_date FROM account_move WHERE id = ANY(%s)"
+        " ORDER BY invoice_date, name, id",
+        (list(invoice_ids),),
+    )
+    return cr.fetchall()
+
+
+class TagColumnIndex(object):
+    """Account tag id -> report columns, compiled once from the report
+    columns definition so every line is classified with integer lookups.
+
+    :param columns: report columns definition (column -> type, tags)
+    :param known_tags: tag name -> list of report columns
+    :param tags: iterable of (tag id, tag name) to be indexed
+    """
+
+    __slots__ = (
+        "columns",
+        "known_ids",
+        "base_neex_ids",
+        "tva_neex_ids",
+        "tva_ids",
+        "baza_ids",
+    )
+
+    def __init__(self, columns, known_tags, tags):
+        base_neex_tags = set(columns["base_neex"]["tags"])
+        tva_neex_tags = set(columns["tva_neex"]["tags"])
+        tag_columns = {}
+        base_neex_ids, tva_neex_ids, tva_ids, baza_ids = set(), set(), set(), set()
+        for tag_id, name in tags:
+            name = name or ""
+            if name in known_tags:
+                tag_columns[tag_id] = tuple(known_tags[name])
+            if name in base_neex_tags:
+                base_neex_ids.add(tag_id)
+            elif name in tva_neex_tags:
+                tva_neex_ids.add(tag_id)
+            # payment lines are split in base/vat by the tags names
+            if "TVA" in name:
+                tva_ids.add(tag_id)
+            elif "BAZA" in name:
+                baza_ids.add(tag_id)
+        self.columns = tag_columns
+        self.known_ids = frozenset(tag_columns)
+        self.base_neex_ids = frozenset(base_neex_ids)
+        self.tva_neex_ids = frozenset(tva_neex_ids)
+        self.tva_ids = frozenset(tva_ids)
+        self.baza_ids = frozenset(baza_ids)
+
+
+class SqlJournalEngine(object):
+    """Compute the journal rows of some invoices with grouped SQL queries.
+
+    :param cr: database cursor
+    :param tag_index: TagColumnIndex used to classify the lines
+    :param row_layout: RowLayout of the rows made for every invoice
+    :param report_type_sale: True for sale journal, False for purchase
+    :param show_warnings: if False the warnings queries are skipped
+    :param partner_account_ids: ids of the receivable/payable accounts of
+        the company (411/401...), their lines are the invoice counterparts
+    """
+
+    def __init__(
+        self,
+        cr,
+        tag_index,
+        row_layout,
+        report_type_sale=True,
+        show_warnings=True,
+        partner_account_ids=(),
+    ):
+        self.cr = cr
+        self.tag_index = tag_index
+        self.row_layout = row_layout
+        self.sign = 1 if report_type_sale else -1
+        self.show_warnings = show_warnings
+        self.partner_account_ids = frozenset(partner_account_ids)
+        # as query parameter, never empty for IN
+        self.partner_accounts = tuple(self.partner_account_ids) or (0,)
+
+    def compute_rows(self, invoice_ids):
+        """Return a dictionary invoice_id -> row for the given invoices and
+        the set of invoice ids that have VAT on payment lines (for them the
+        payments must be added by the caller)."""
+        rows = {}
+        put_payments_ids = set()
+        for chunk in split_every(IN_CHUNK_SIZE, invoice_ids, tuple):
+            for inv_id, name, inv_date, partner, vat, total in self._fetch_headers(
+                chunk
+            ):
+                vals = self.row_layout.new_row()
+                vals["number"] = name or False
+                vals["date"] = inv_date or False
+                vals["partner"] = partner or False
+                vals["vat"] = vat or False
+                vals["total"] = self.sign * total
+                vals["warnings"] = ""
+                vals["rowspan"] = 1
+                rows[inv_id] = vals
+            for inv_id, exigible, tag_id, amount in self._fetch_line_sums(chunk):
+                self._add_line_sum(rows[inv_id], exigible, tag_id, amount)
+                if not exigible:  # VAT on payment
+                    put_payments_ids.add(inv_id)
+            if self.show_warnings:
+                for inv_id, _line_id, warning in self._fetch_warnings(chunk):
+                    rows[inv_id]["warnings"] += warning
+        return rows, put_payments_ids
+
+    def _add_line_sum(self, vals, exigible, tag_id, amount):
+        """adds to the row columns the credit - debit amount of the lines
+        with a tag (None for the lines without tags)"""
+        tag_index = self.tag_index
+        amount = self.sign * amount
+        if not exigible:  # VAT on payment
+            if tag_id in tag_index.base_neex_ids:
+                vals["base_neex"] += amount
+            elif tag_id in tag_index.tva_neex_ids:
+                vals["tva_neex"] += amount
+        elif tag_id is None:
+            vals["base_0"] += amount
+        else:
+            for column in tag_index.columns.get(tag_id, ()):
+                if column not in NEEX_COLUMNS:
+                    vals[column] += amount
+
+    def compute_partner_summary(self, invoice_ids, company_id, date_from, date_to):
+        """Return a dictionary (commercial partner id, VAT code) -> (row, count
+        of invoices) with the columns of the invoices summed by partner.
+
+        The lines are summed by the database grouped by partner, VAT code,
+        exigibility and tag, so the queries are not returning a row for every
+        invoice; only the VAT on payment invoices are computed one by one as
+        journal rows, for their payments and the rounding of their not
+        exigible columns, the same as in the journal. The rows are not
+        finalized and have no payments."""
+        summary = {}
+        cash_basis = {}
+        for chunk in split_every(IN_CHUNK_SIZE, invoice_ids, tuple):
+            self.cr.execute(
+                """
+                SELECT DISTINCT aml.move_id, m.commercial_partner_id,
+                       m.invoice_partner_display_vat
+                  FROM account_move_line aml
+                  JOIN account_move m ON m.id = aml.move_id
+                 WHERE aml.move_id IN %s
+                   AND aml.tax_exigible IS NOT TRUE
+                   AND (aml.display_type IS NULL
+                        OR aml.display_type NOT IN ('line_section', 'line_note'))
+                   AND aml.account_id NOT IN %s
+                """,
+                (chunk, self.partner_accounts),
+            )
+            chunk_cash_basis = {
+                inv_id: (partner_id, vat or False)
+                for inv_id, partner_id, vat in self.cr.fetchall()
+            }
+            cash_basis.update(chunk_cash_basis)
+            self.cr.execute(
+                """
+                SELECT m.commercial_partner_id, m.invoice_partner_display_vat,
+                       MIN(p.name), COUNT(*), SUM(m.amount_total_signed)
+                  FROM account_move m
+                  LEFT JOIN res_partner p ON p.id = m.commercial_partner_id
+                 WHERE m.id IN %s
+                 GROUP BY m.commercial_partner_id, m.invoice_partner_display_vat
+                """,
+                (chunk,),
+            )
+            for partner_id, vat, partner, count, total in self.cr.fetchall():
+                key = (partner_id, vat or False)
+                if key not in summary:
+                    vals = self.row_layout.new_row()
+                    vals["partner"] = partner or False
+                    vals["vat"] = vat or False
+                    vals["warnings"] = ""
+                    vals["rowspan"] = 1
+                    summary[key] = (vals, 0)
+                vals, invoices_count = summary[key]
+                vals["total"] += self.sign * float(total or 0.0)
+                summary[key] = (vals, invoices_count + count)
+            self.cr.execute(
+                """
+                SELECT m.commercial_partner_id, m.invoice_partner_display_vat,
+                       COALESCE(aml.tax_exigible, FALSE),
+                       rel.account_account_tag_id, SUM(aml.credit - aml.debit)
+                  FROM account_move_line aml
+                  JOIN account_move m ON m.id = aml.move_id
+                  LEFT JOIN account_account_tag_account_move_line_rel rel
+                         ON rel.account_move_line_id = aml.id
+                 WHERE aml.move_id IN %s
+                   AND (aml.display_type IS NULL
+                        OR aml.display_type NOT IN ('line_section', 'line_note'))
+                   AND aml.account_id NOT IN %s
+                   AND aml.move_id NOT IN %s
+                 GROUP BY m.commercial_partner_id, m.invoice_partner_display_vat,
+                          COALESCE(aml.tax_exigible, FALSE),
+                          rel.account_account_tag_id
+                """,
+                (chunk, self.partner_accounts, tuple(chunk_cash_basis) or (0,)),
+            )
+            for partner_id, vat, exigible, tag_id, amount in self.cr.fetchall():
+                vals = summary[(partner_id, vat or False)][0]
+                self._add_line_sum(vals, exigible, tag_id, float(amount or 0.0))
+        # the total and the invoices count are already in the summary rows
+        positions = [
+            position
+            for position in self.row_layout.numeric_positions
+            if self.row_layout.keys[position] not in ("total", "rowspan")
+        ]
+        for chunk in split_every(IN_CHUNK_SIZE, cash_basis, list):
+            rows, _put_payments_ids = self.compute_rows(chunk)
+            payments = self.fetch_payments(chunk, company_id, date_to)
+            for inv_id in chunk:
+                row = rows[inv_id]
+                self.apply_payments(row, payments.get(inv_id, []), date_from)
+                for column in NEEX_COLUMNS:
+                    row[column] = round(row[column], 2)
+                sums = summary[cash_basis[inv_id]][0]._values
+                for position in positions:
+                    sums[position] += row._values[position]
+        for vals, _count in summary.values():
+            # the payments are shown only in the journal
+            vals["payments"] = []
+            vals["rowspan"] = 1
+        return summary
+
+    def fetch_counterpart_lines(self, invoice_ids):
+        """Return a dictionary invoice_id -> id of its first receivable/payable
+        line, the line reconciled with the payments"""
+        counterparts = {}
+        for chunk in split_every(IN_CHUNK_SIZE, invoice_ids, tuple):
+            self.cr.execute(
+                """
+                SELECT DISTINCT ON (aml.move_id) aml.move_id, aml.id
+                  FROM account_move_line aml
+                 WHERE aml.move_id IN %s AND aml.account_id IN %s
+                 ORDER BY aml.move_id, aml.id
+                """,
+                (chunk, self.partner_accounts),
+            )
+            counterparts.update(self.cr.fetchall())
+        return counterparts
+
+    def fetch_payments(self, invoice_ids, company_id, date_to):
+        """Return a dictionary invoice_id -> list of payments, where a payment
+        is the tax cash basis move of a partial reconcile (till date_to) of
+        the invoice receivable/payable line, with its lines amounts and tags.
+
+        All the invoices are resolved with two queries: one for the partial
+        reconciles and their cash basis moves and one for the lines of
+        those moves."""
+        payments = {}
+        moves = {}
+        for chunk in split_every(IN_CHUNK_SIZE, invoice_ids, tuple):
+            self.cr.execute(
+                """
+                WITH counterpart AS (
+                    SELECT DISTINCT ON (aml.move_id) aml.move_id, aml.id
+                      FROM account_move_line aml
+                     WHERE aml.move_id IN %s AND aml.account_id IN %s
+                     ORDER BY aml.move_id, aml.id
+                )
+                SELECT cp.move_id, cb.id, cb.ref, cb.date, cb.amount_total,
+                       apr.max_date
+                  FROM counterpart cp
+                  JOIN account_partial_reconcile apr
+                    ON apr.debit_move_id = cp.id OR apr.credit_move_id = cp.id
+                  JOIN account_move cb ON cb.tax_cash_basis_rec_id = apr.id
+                 WHERE apr.company_id = %s AND apr.max_date <= %s
+                 ORDER BY cb.date DESC, cb.name DESC, cb.id DESC
+                """,
+                (chunk, self.partner_accounts, company_id, date_to),
+            )
+            for inv_id, move_id, ref, date, amount, max_date in self.cr.fetchall():
+                move = moves.setdefault(
+                    move_id,
+                    {
+                        "ref": ref or False,
+                        "date": date,
+                        "amount": float(amount or 0.0),
+                        "max_date": max_date,
+                        "lines": [],
+                    },
+                )
+                payments.setdefault(inv_id, []).append(move)
+        for chunk in split_every(IN_CHUNK_SIZE, list(moves), tuple):
+            self.cr.execute(
+                """
+                SELECT aml.move_id, aml.credit - aml.debit,
+                       array_remove(array_agg(rel.account_account_tag_id), NULL)
+                  FROM account_move_line aml
+                  LEFT JOIN account_account_tag_account_move_line_rel rel
+                         ON rel.account_move_line_id = aml.id
+                 WHERE aml.move_id IN %s
+                 GROUP BY aml.move_id, aml.id
+                 ORDER BY aml.move_id, aml.id
+                """,
+                (chunk,),
+            )
+            for move_id, amount, tag_ids in self.cr.fetchall():
+                moves[move_id]["lines"].append((float(amount or 0.0), tag_ids))
+        return payments
+
+    def apply_payments(self, vals, payments, date_from):
+        """Add to the invoice row the payments done in period and subtract
+        from the not exigible columns all the payments till date_to."""
+        tag_index = self.tag_index
+        for move in payments:
+            if move["date"] < date_from:
+                # this payment is in a period before and we will just substract it
+                for amount, tag_ids in move["lines"]:
+                    amount = self.sign * amount
+                    for tag_id in tag_ids:
+                        if tag_id in tag_index.base_neex_ids:
+                            vals["base_neex"] -= amount
+                        elif tag_id in tag_index.tva_neex_ids:
+                            vals["tva_neex"] -= amount
+                continue
+            # is payment in period and we are going also to show it, and also substract it
+            vals["rowspan"] += 1
+            payment = {
+                "number": move["ref"],
+                "date": move["date"],
+                "amount": move["amount"],
+                "base_exig": 0,
+                "tva_exig": 0,
+            }
+            vals["payments"] += [payment]
+            for amount, tag_ids in move["lines"]:
+                amount = self.sign * amount
+                if tag_index.tva_ids.intersection(tag_ids):
+                    payment["tva_exig"] += amount
+                elif tag_index.baza_ids.intersection(tag_ids):
+                    payment["base_exig"] += amount
+                for tag_id in tag_ids:
+                    for column in tag_index.columns.get(tag_id, ()):
+                        if column in NEEX_COLUMNS:
+                            vals[column] -= amount
+                        else:
+                            vals[column] += amount
+
+    def _fetch_headers(self, invoice_ids):
+        self.cr.execute(
+            """
+            SELECT m.id, m.name, m.invoice_date, p.name,
+                   m.invoice_partner_display_vat, m.amount_total_signed
+              FROM account_move m
+              LEFT JOIN res_partner p ON p.id = m.commercial_partner_id
+             WHERE m.id IN %s
+            """,
+            (invoice_ids,),
+        )
+        return [
+            (inv_id, name, inv_date, partner, vat, float(total or 0.0))
+            for inv_id, name, inv_date, partner, vat, total in self.cr.fetchall()
+        ]
+
+    def _fetch_line_sums(self, invoice_ids):
+        """Sum of credit - debit grouped by invoice, exigibility and tag id.
+        A line with several tags is counted once for each tag, lines without
+        tags come with a None tag id."""
+        self.cr.execute(
+            """
+            SELECT aml.move_id, COALESCE(aml.tax_exigible, FALSE),
+                   rel.account_account_tag_id, SUM(aml.credit - aml.debit)
+              FROM account_move_line aml
+              LEFT JOIN account_account_tag_account_move_line_rel rel
+                     ON rel.account_move_line_id = aml.id
+             WHERE aml.move_id IN %s
+               AND (aml.display_type IS NULL
+                    OR aml.display_type NOT IN ('line_section', 'line_note'))
+               AND aml.account_id NOT IN %s
+             GROUP BY aml.move_id, COALESCE(aml.tax_exigible, FALSE),
+                      rel.account_account_tag_id
+            """,
+            (invoice_ids, self.partner_accounts),
+        )
+        return [
+            (inv_id, exigible, tag_id, float(amount or 0.0))
+            for inv_id, exigible, tag_id, amount in self.cr.fetchall()
+        ]
+
+    def validate(self, invoice_ids):
+        """Yield (invoice_id, line_id, reason) of the inconsistencies of the
+        invoices, without computing their rows: the warnings of the report
+        and the invoices without receivable/payable (partner account) line,
+        for which the payments can not be found."""
+        for chunk in split_every(IN_CHUNK_SIZE, invoice_ids, tuple):
+            for warning in self._fetch_warnings(chunk):
+                yield warning
+            self.cr.execute(
+                """
+                SELECT m.id
+                  FROM account_move m
+                 WHERE m.id IN %s
+                   AND NOT EXISTS (
+                        SELECT 1
+                          FROM account_move_line aml
+                         WHERE aml.move_id = m.id AND aml.account_id IN %s
+                   )
+                """,
+                (chunk, self.partner_accounts),
+            )
+            for (inv_id,) in self.cr.fetchall():
+                yield inv_id, None, "the invoice has no partner account line"
+
+    def _fetch_warnings(self, invoice_ids):
+        """Return (invoice_id, line_id, warning) sorted as the invoice lines:
+        partner account lines that do not match the invoice total and exigible lines
+        that have only tags unknown to the report."""
+        self.cr.execute(
+            """
+            SELECT aml.move_id, aml.id, acc.code, aml.debit, aml.credit,
+                   m.amount_total_signed
+              FROM account_move_line aml
+              JOIN account_account acc ON acc.id = aml.account_id
+              JOIN account_move m ON m.id = aml.move_id
+             WHERE aml.move_id IN %s
+               AND (aml.display_type IS NULL
+                    OR aml.display_type NOT IN ('line_section', 'line_note'))
+               AND aml.account_id IN %s
+               AND aml.debit - aml.credit <> m.amount_total_signed
+            """,
+            (invoice_ids, self.partner_accounts),
+        )
+        warnings = []
+        for inv_id, line_id, code, debit, credit, total in self.cr.fetchall():
+            value = self.sign * (-float(credit) + float(debit))
+            warnings.append(
+                (
+                    inv_id,
+                    line_id,
+                    f"The value of invoice is {self.sign * float(total)} but "
+                    f"accounting account {code} has "
+                    f"a value of  {value}",
+                )
+            )
+        self.cr.execute(
+            """
+            SELECT aml.move_id, aml.id, aml.name, aml.debit, aml.credit,
+                   array_agg(tag.name ORDER BY tag.id)
+              FROM account_move_line aml
+              JOIN account_account_tag_account_move_line_rel rel
+                ON rel.account_move_line_id = aml.id
+              JOIN account_account_tag tag
+                ON tag.id = rel.account_account_tag_id
+             WHERE aml.move_id IN %s
+               AND aml.tax_exigible IS TRUE
+               AND (aml.display_type IS NULL
+                    OR aml.display_type NOT IN ('line_section', 'line_note'))
+               AND aml.account_id NOT IN %s
+             GROUP BY aml.id
+            HAVING NOT bool_or(tag.id IN %s)
+            """,
+            (
+                invoice_ids,
+                self.partner_accounts,
+                tuple(self.tag_index.known_ids) or (0,),
+            ),
+        )
+        for inv_id, line_id, name, debit, credit, tag_names in self.cr.fetchall():
+            warnings.append(
+                (
+                    inv_id,
+                    line_id,
+                    f"unknown report column for line {name} debit={float(debit)} "
+                    f"credit={float(credit)} TAGS{tag_names};",
+                )
+            )
+        return sorted(warnings, key=lambda w: (w[0], w[1]))
+
+
+def compute_shard(args):
+    """Compute the rows of a shard of invoices in a worker process, with a
+    new connection that reads the exported snapshot of the main transaction,
+    so all the shards see the same data.
+
+    :param args: tuple (connection_info, snapshot id, tag_index, row_layout,
+        report_type_sale, show_warnings, partner_account_ids, company_id,
+        date_from, date_to, invoice_ids)
+    :return: list of (invoice_id, row values) in the order of invoice_ids,
+        the rows are not finalized
+    """
+    connection_info, snapshot = args[:2]
+    cnx = psycopg2.connect(**connection_info)
+    try:
+        cnx.set_session(
+            isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+            readonly=True,
+        )
+        cr = cnx.cursor()
+        cr.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        return compute_shard_rows(cr, args)
+    finally:
+        cnx.close()
+
+
+def compute_shard_rows(cr, args):
+    """The computation of compute_shard with the cursor cr"""
+    (
+        _connection_info,
+        _snapshot,
+        tag_index,
+        row_layout,
+        report_type_sale,
+        show_warnings,
+        partner_account_ids,
+        company_id,
+        date_from,
+        date_to,
+        invoice_ids,
+    ) = args
+    engine = SqlJournalEngine(
+        cr,
+        tag_index,
+        row_layout,
+        report_type_sale,
+        show_warnings,
+        partner_account_ids,
+    )
+    rows, put_payments_ids = engine.compute_rows(invoice_ids)
+    payments = engine.fetch_payments(list(put_payments_ids), company_id, date_to)
+    for inv_id in put_payments_ids:
+        engine.apply_payments(rows[inv_id], payments.get(inv_id, []), date_from)
+    return [(inv_id, rows[inv_id]._values) for inv_id in invoice_ids]
@@ -0,0 +1,173 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Tabular (CSV/XLSX) writers for the sale/purchase journal.
+
+The rows are written one by one as the engine yields them, every payment of
+a VAT on payment invoice is a separate row under its invoice. The partner
+summary has a row for every partner and VAT code, without payments.
+"""
+
+import csv
+import io
+import logging
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import xlsxwriter
+except ImportError:
+    _logger.debug("Can not import xlsxwriter.")
+    xlsxwriter = None
+
+INVOICE_COLUMNS = [
+    ("number", "Number"),
+    ("date", "Date"),
+    ("partner", "Partner"),
+    ("vat", "VAT"),
+    ("total", "Total"),
+    ("total_base", "Total Base"),
+    ("total_vat", "Total VAT"),
+    ("base_19", "Base 19%"),
+    ("tva_19", "VAT 19%"),
+    ("base_9", "Base 9%"),
+    ("tva_9", "VAT 9%"),
+    ("base_5", "Base 5%"),
+    ("tva_5", "VAT 5%"),
+    ("base_0", "Base 0%"),
+    ("invers", "Inverse Taxation"),
+    ("base_neex", "Not Exigible Base"),
+    ("tva_neex", "Not Exigible VAT"),
+    ("base_exig", "Exigible Base"),
+    ("tva_exig", "Exigible VAT"),
+    ("base_ded1", "Intracom. Services Base"),
+    ("base_ded2", "Intracom. Goods Base"),
+    ("tva_serv", "Intracom. Services VAT"),
+    ("tva_bun", "Intracom. Goods VAT"),
+    ("scutit1", "Exempt with deduction"),
+    ("scutit2", "Exempt without deduction"),
+    ("neimp", "Not taxable"),
+    ("others", "Others"),
+    ("base_col", "Base Collected"),
+    ("tva_col", "VAT Collected"),
+    ("warnings", "Warnings"),
+]
+PAYMENT_COLUMNS = [
+    ("number", "Payment Number"),
+    ("date", "Payment Date"),
+    ("amount", "Payment Amount"),
+    ("base_exig", "Payment Base"),
+    ("tva_exig", "Payment VAT"),
+]
+
+# the journal columns summed by partner, without the invoice ones
+PARTNER_SUMMARY_COLUMNS = [("partner", "Partner"), ("vat", "VAT")] + [
+    (key, label)
+    for key, label in INVOICE_COLUMNS
+    if key not in ("number", "date", "partner", "vat", "warnings")
+]
+
+
+def header_row():
+    return (
+        ["Type"]
+        + [label for _key, label in INVOICE_COLUMNS]
+        + [label for _key, label in PAYMENT_COLUMNS]
+    )
+
+
+def flatten_row(vals):
+    """yields the invoice row and one row for each of its payments"""
+    yield (
+        ["invoice"]
+        + [vals.get(key, "") for key, _label in INVOICE_COLUMNS]
+        + ["" for _column in PAYMENT_COLUMNS]
+    )
+    for payment in vals.get("payments") or []:
+        invoice_part = ["" for _column in INVOICE_COLUMNS]
+        invoice_part[0] = vals.get("number", "")
+        invoice_part[1] = vals.get("date", "")
+        yield (
+            ["payment"]
+            + invoice_part
+            + [payment.get(key, "") for key, _label in PAYMENT_COLUMNS]
+        )
+
+
+def totals_row(totals):
+    return (
+        ["totals"]
+        + [
+            totals.get(key, "") if key not in ("number", "date") else ""
+            for key, _label in INVOICE_COLUMNS
+        ]
+        + ["" for _column in PAYMENT_COLUMNS]
+    )
+
+
+def partner_summary_header_row():
+    return (
+        [label for key, label in PARTNER_SUMMARY_COLUMNS[:2]]
+        + ["Invoices"]
+        + [label for key, label in PARTNER_SUMMARY_COLUMNS[2:]]
+    )
+
+
+def partner_summary_row(vals, count):
+    return (
+        [vals.get(key, "") for key, _label in PARTNER_SUMMARY_COLUMNS[:2]]
+        + [count]
+        + [vals.get(key, "") for key, _label in PARTNER_SUMMARY_COLUMNS[2:]]
+    )
+
+
+class CsvJournalWriter(object):
+    """Writes the journal rows as CSV into a binary file object"""
+
+    extension = "csv"
+    mimetype = "text/csv"
+
+    def __init__(self, fileobj):
+        self.stream = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.stream)
+
+    def write(self, values):
+        self.writer.writerow(
+            ["" if value is False or value is None else value for value in values]
+        )
+
+    def close(self):
+        self.stream.flush()
+        self.stream.detach()
+
+
+class XlsxJournalWriter(object):
+    """Writes the journal rows in a XLSX sheet, in constant memory mode the
+    rows are flushed to disk as soon as they are written"""
+
+    extension = "xlsx"
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    def __init__(self, fileobj):
+        self.workbook = xlsxwriter.Workbook(fileobj, {"constant_memory": True})
+        self.sheet = self.workbook.add_worksheet("Journal")
+        self.date_format = self.workbook.add_format({"num_format": "yyyy-mm-dd"})
+        self.row = 0
+
+    def write(self, values):
+        for col, value in enumerate(values):
+            if value is False or value is None:
+                continue
+            if hasattr(value, "isoformat"):
+                self.sheet.write_datetime(self.row, col, value, self.date_format)
+            else:
+                self.sheet.write(self.row, col, value)
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+JOURNAL_WRITERS = {
+    "csv": CsvJournalWriter,
+    "xlsx": XlsxJournalWriter,
+}
@@ -0,0 +1,88 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Parallel wkhtmltopdf rendering of the journal chunks.
+
+The HTML of every chunk is prepared by the caller (with the ORM, in the main
+thread), here only the wkhtmltopdf processes are run, each one in a thread
+that waits for its subprocess, and the resulted PDFs are merged.
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import _
+from odoo.exceptions import UserError
+from odoo.tools.pdf import merge_pdf
+
+from odoo.addons.base.models.ir_actions_report import _get_wkhtmltopdf_bin
+
+_logger = logging.getLogger(__name__)
+
+
+def _write_temp(content, prefix, suffix=".html"):
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    return path
+
+
+def run_wkhtmltopdf(command_args, bodies, header=None, footer=None):
+    """runs one wkhtmltopdf process and returns the PDF content"""
+    paths = []
+    try:
+        files_args = []
+        if header:
+            paths.append(_write_temp(header, "report.header.tmp."))
+            files_args.extend(["--header-html", paths[-1]])
+        if footer:
+            paths.append(_write_temp(footer, "report.footer.tmp."))
+            files_args.extend(["--footer-html", paths[-1]])
+        body_paths = []
+        for index, body in enumerate(bodies):
+            body_paths.append(_write_temp(body, "report.body.tmp.%d." % index))
+        paths.extend(body_paths)
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf", prefix="report.tmp.")
+        os.close(fd)
+        paths.append(pdf_path)
+        process = subprocess.Popen(
+            [_get_wkhtmltopdf_bin()] + command_args + files_args + body_paths + [pdf_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        _out, err = process.communicate()
+        if process.returncode not in [0, 1]:
+            raise UserError(
+                _("Wkhtmltopdf failed (error code: %s). Message: %s")
+                % (process.returncode, err.decode(errors="replace")[-1000:])
+            )
+        with open(pdf_path, "rb") as f:
+            return f.read()
+    finally:
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                _logger.error("Error when trying to remove file %s", path)
+
+
+def render_chunks_parallel(chunks, workers):
+    """renders the chunks, each one is (command_args, bodies, header, footer),
+    with at most workers wkhtmltopdf processes at once and returns the merged
+    PDF in the order of the chunks. The chunks can be a generator, it is
+    consumed in the calling thread while the processes are running and at
+    most 2 * workers prepared chunks are waiting"""
+    workers = max(1, workers)
+    pdfs = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(run_wkhtmltopdf, *chunk))
+            while len(pending) >= 2 * workers:
+                pdfs.append(pending.popleft().result())
+        while pending:
+            pdfs.append(pending.popleft().result())
+    return merge_pdf(pdfs)
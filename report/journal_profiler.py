@@ -0,0 +1,90 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Phase timers and SQL query counters of the journal computation.
+
+The profiler is given in the context (journal_report_profiler) and every
+phase is accumulated over its calls, so a phase run for every invoice
+(like the reconciliation lookups of the ORM engine) has one total. Phases
+can be nested, the outer one includes the time and queries of the inner.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class _NullPhase(object):
+    """used when there is no profiler in context"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class JournalProfiler(object):
+    def __init__(self, cr):
+        # (cursor, its query count when added)
+        self.cursors = [(cr, cr.sql_log_count)]
+        self.phases = {}
+        self.start = time.perf_counter()
+
+    def add_cursor(self, cr):
+        """counts also the queries of cr (the dedicated report cursor) from
+        now on"""
+        self.cursors.append((cr, cr.sql_log_count))
+
+    def queries(self):
+        return sum(cr.sql_log_count - count for cr, count in self.cursors)
+
+    @contextmanager
+    def phase(self, name):
+        entry = self.phases.setdefault(name, {"time": 0.0, "queries": 0, "calls": 0})
+        start, queries = time.perf_counter(), self.queries()
+        try:
+            yield
+        finally:
+            entry["time"] += time.perf_counter() - start
+            entry["queries"] += self.queries() - queries
+            entry["calls"] += 1
+
+    def summary(self):
+        """returns the phases in the order they were started and the total,
+        as dictionaries with name, milliseconds, queries and calls"""
+        rows = [
+            {
+                "name": name,
+                "ms": round(entry["time"] * 1000, 1),
+                "queries": entry["queries"],
+                "calls": entry["calls"],
+            }
+            for name, entry in self.phases.items()
+        ]
+        rows.append(
+            {
+                "name": "total",
+                "ms": round((time.perf_counter() - self.start) * 1000, 1),
+                "queries": self.queries(),
+                "calls": 1,
+            }
+        )
+        return rows
+
+    def log(self, logger, title):
+        logger.info(
+            "%s: %s",
+            title,
+            ", ".join(
+                "%s %sms/%sq%s"
+                % (
+                    row["name"],
+                    row["ms"],
+                    row["queries"],
+                    "/%sx" % row["calls"] if row["calls"] > 1 else "",
+                )
+                for row in self.summary()
+            ),
+        )
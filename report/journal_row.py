@@ -0,0 +1,129 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Compact rows of the sale/purchase journal.
+
+All the rows of a journal have the same columns, so the keys and their
+positions are kept once in a RowLayout and every row is only a list of
+values. A row is a mapping (row["base_19"], row.get(), items()), so the
+QWeb templates and the exports are using it as the old dictionaries.
+"""
+
+from collections.abc import MutableMapping
+
+
+class RowLayout(object):
+    """The columns of the journal rows.
+
+    :param defaults: ordered dictionary column -> value of a new row, the
+        list values are created again for every row
+    :param numeric_keys: the columns that are summed in the totals
+    """
+
+    __slots__ = ("keys", "index", "defaults", "list_positions", "numeric_positions")
+
+    def __init__(self, defaults, numeric_keys):
+        self.keys = tuple(defaults)
+        self.index = {key: position for position, key in enumerate(self.keys)}
+        self.defaults = tuple(defaults[key] for key in self.keys)
+        self.list_positions = tuple(
+            position
+            for position, value in enumerate(self.defaults)
+            if isinstance(value, list)
+        )
+        self.numeric_positions = tuple(self.index[key] for key in numeric_keys)
+
+    def new_row(self):
+        values = list(self.defaults)
+        for position in self.list_positions:
+            values[position] = []
+        return JournalRow(self, values)
+
+
+class JournalRow(MutableMapping):
+    """One line of the journal, with the columns of its layout. A column
+    that is not in the layout can not be set"""
+
+    __slots__ = ("_layout", "_values")
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._layout.index[key]]
+
+    def __setitem__(self, key, value):
+        self._values[self._layout.index[key]] = value
+
+    def __delitem__(self, key):
+        raise TypeError("The columns of a journal row can not be deleted")
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+    def __repr__(self):
+        return "JournalRow(%r)" % self.to_dict()
+
+    def get(self, key, default=None):
+        position = self._layout.index.get(key)
+        return default if position is None else self._values[position]
+
+    def items(self):
+        return zip(self._layout.keys, self._values)
+
+    def to_dict(self):
+        return dict(zip(self._layout.keys, self._values))
+
+    def copy(self):
+        """the lists (payments) are copied, so they can be extended"""
+        values = list(self._values)
+        for position in self._layout.list_positions:
+            values[position] = list(values[position])
+        return JournalRow(self._layout, values)
+
+
+class JournalTotals(object):
+    """Running sums of the numeric columns of the rows, added as the rows
+    are computed. The rows loaded as dictionaries (from a snapshot) are
+    summed by their int/float values"""
+
+    __slots__ = ("_layout", "_sums", "_others", "_count")
+
+    def __init__(self, layout):
+        self._layout = layout
+        self._sums = [0] * len(layout.keys)
+        self._others = {}
+        self._count = 0
+
+    def add(self, row):
+        self._count += 1
+        if isinstance(row, JournalRow) and row._layout is self._layout:
+            sums, values = self._sums, row._values
+            for position in self._layout.numeric_positions:
+                sums[position] += values[position]
+            return
+        index = self._layout.index
+        for key, value in row.items():
+            if (type(value) is int) or (type(value) is float):
+                if key in index:
+                    self._sums[index[key]] += value
+                else:
+                    self._others[key] = self._others.get(key, 0) + value
+
+    def as_dict(self):
+        """the rounded totals; empty if no row was added"""
+        if not self._count:
+            return {}
+        totals = {
+            self._layout.keys[position]: round(self._sums[position], 2)
+            for position in self._layout.numeric_positions
+        }
+        totals.update({key: round(value, 2) for key, value in self._others.items()})
+        totals["payments"] = []
+        return totals
@@ -1,13 +1,50 @@
 # Copyright (C) 2020 OdooERP Romania
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
-from copy import deepcopy
-from odoo.exceptions import ValidationError
+import odoo
+from odoo import _, api, fields, models, sql_db, tools
+from odoo.exceptions import UserError, ValidationError
+from odoo.osv import expression
 import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import tempfile
+from contextlib import contextmanager
 _logger = logging.getLogger(__name__)
 from datetime  import datetime
+from dateutil.relativedelta import relativedelta
 from odoo.tools import DEFAULT_SERVER_DATE_FORMAT
+from odoo.tools.misc import split_every
+
+from .journal_pdf import render_chunks_parallel
+from .journal_profiler import NULL_PHASE, JournalProfiler
+from .journal_row import JournalRow, JournalTotals, RowLayout
+from .journal_export import (
+    JOURNAL_WRITERS,
+    flatten_row,
+    header_row,
+    partner_summary_header_row,
+    partner_summary_row,
+    totals_row,
+    xlsxwriter,
+)
+from .journal_engine import (
+    IN_CHUNK_SIZE,
+    SqlJournalEngine,
+    TagColumnIndex,
+    compute_shard,
+    count_report_invoices,
+    fetch_invoice_dates_in_order,
+    select_cash_basis_invoice_dates,
+    select_cash_basis_invoice_ids,
+    select_invoices_in_period,
+    select_older_unpaid_cash_basis_ids,
+    stream_report_invoice_ids,
+)
+
 
 class SaleJournalReport(models.TransientModel):
     _name = "report.l10n_ro_account_report_journal.report_sale_purchase"
@@ -30,45 +67,230 @@ class SaleJournalReport(models.TransientModel):
             ("company_id", "=", company_id.id),]
         invoices_in_period_domain = general_domain + sale_purchase_domain + [("invoice_date", ">=", date_from), ("invoice_date", "<=", date_to)]
 
-        invoices_with_tax_cash_basis_ids = []  # id's to take also the invoices that are not in selected period
+        account_move_obj.flush()
+        invoices_with_tax_cash_basis_ids = self._get_cash_basis_invoice_ids(data, journal_type)
+
+        final_domain = ['|',('id','in',list(set(invoices_with_tax_cash_basis_ids))),'&','&','&','&'] + invoices_in_period_domain  
+        invoices_for_report = self.env["account.move"].search(final_domain, order="invoice_date, name")
+        return invoices_for_report
+
+    @api.model
+    def _profile_phase(self, name):
+        """timer and query counter of a phase, if there is a profiler in context"""
+        profiler = self.env.context.get("journal_report_profiler")
+        return profiler.phase(name) if profiler else NULL_PHASE
 
+    @api.model
+    def _get_cash_basis_invoice_ids(self, data, journal_type):
+        """id's to take also the invoices that are not in selected period"""
+        date_from = data["form"]["date_from"]
+        date_to = data["form"]["date_to"]
+        company_id = self.env['res.company'].browse(data["form"]["company_id"][0])
+        invoices_with_tax_cash_basis_ids = []
 # invoices that are older than the start date and not paid if they have vat on payment must appear into this report
-        older_unpaid_invoices =  account_move_obj.search (sale_purchase_domain+[
-            ("state", "=", "posted"),
-            ("company_id", "=", company_id.id),
-            ("invoice_date", "<", date_from),
-            ('payment_state','in',['partial','not_paid']),])
-        for upaid_invoice in older_unpaid_invoices:
-            for line_id in upaid_invoice.invoice_line_ids:
-                if line_id.display_type in ['line_section', 'line_note']:
-                    continue
-                if not line_id.tax_exigible:
-                    invoices_with_tax_cash_basis_ids.append( upaid_invoice.id)
-                    break 
+        invoices_with_tax_cash_basis_ids += select_older_unpaid_cash_basis_ids(
+            self.env.cr, company_id.id, journal_type, date_from,
+            self._get_cash_basis_lookback_limit(date_from))
 
 #reconciled payments for vat_on_payment that exist in this period, and we must put them into report.
 # this payments can be for some in invoices that are not in 
 #line.tax_exigible=False   means  tax.tax_exigibility == 'on_payment'
-        all_tax_cash_basis_journal_move_ids = account_move_obj.search( general_domain + [
-            ('journal_id','=',company_id.tax_cash_basis_journal_id.id ),
-            ("move_type", "in", ["entry"]) ,
-            ("date", ">=", date_from), 
-            ("date", "<=", date_to),  ])
-        for all_tax_cash_basis_journal_move_id in all_tax_cash_basis_journal_move_ids:
-            partial_reconcile = all_tax_cash_basis_journal_move_id.tax_cash_basis_rec_id
-            debit_move_id = partial_reconcile.debit_move_id.move_id 
-            credit_move_id = partial_reconcile.credit_move_id.move_id
-            debit_journal_type = debit_move_id.journal_id.type
-            credit_journal_type = credit_move_id.journal_id.type
-            if debit_journal_type == journal_type:
-                invoices_with_tax_cash_basis_ids.append(debit_move_id.id )
-            elif credit_journal_type==journal_type:
-                invoices_with_tax_cash_basis_ids.append(credit_move_id.id )
-                
-
-        final_domain = ['|',('id','in',invoices_with_tax_cash_basis_ids),'&','&','&','&'] + invoices_in_period_domain  
-        invoices_for_report = self.env["account.move"].search(final_domain, order="invoice_date, name")
-        return invoices_for_report
+        invoices_with_tax_cash_basis_ids += select_cash_basis_invoice_ids(
+            self.env.cr, company_id.id, journal_type,
+            company_id.tax_cash_basis_journal_id.id, date_from, date_to)
+        return list(set(invoices_with_tax_cash_basis_ids))
+
+    @api.model
+    def _get_cash_basis_lookback_limit(self, date_from):
+        """returns the oldest invoice date for which not paid vat on payment
+        invoices are searched, or None if there is no limit. The limit is the
+        number of months from system parameter
+        l10n_ro_account_report_journal.cash_basis_lookback_months"""
+        months = int(self.env["ir.config_parameter"].sudo().get_param(
+            "l10n_ro_account_report_journal.cash_basis_lookback_months", 0) or 0)
+        if months <= 0:
+            return None
+        return fields.Date.to_date(date_from) - relativedelta(months=months)
+
+    @api.model
+    def _compute_journal(self, data):
+        """computes the journal for the options in data and returns the
+        invoices of the report, the report lines and the totals"""
+        with self._report_env() as env:
+            report = self.with_env(env)
+            with report._profile_phase("selection"):
+                invoices = report._get_forreport_invoices_payments(data, data["form"]["journal_type"])
+            report_lines, totals = report._compute_invoices_lines(invoices, data)
+        return invoices.with_env(self.env), report_lines, totals
+
+    @api.model
+    @contextmanager
+    def _report_env(self):
+        """environment of the journal computation, on a dedicated read-only
+        REPEATABLE READ cursor with its own statement timeout: the selection
+        and the reconciliations lookups see the same snapshot, whatever is
+        posted or reconciled meanwhile, and the long reads do not hold a
+        read-write transaction. The cursor is on the report_dsn database
+        (a replica) if configured.
+
+        The dedicated cursor sees only the committed data, the pending
+        changes are flushed but not visible. Inside another report
+        environment, or with journal_report_cursor in context (the tests,
+        whose data is not committed), the current cursor is used"""
+        if self.env.context.get("journal_report_cursor"):
+            yield self.env(context=dict(self.env.context, journal_report_cursor=True))
+            return
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        dsn = get_param("l10n_ro_account_report_journal.report_dsn")
+        timeout = int(get_param("l10n_ro_account_report_journal.report_statement_timeout", 3600) or 0)
+        self.env["base"].flush()
+        target = dsn or self.env.cr.dbname
+        _dbname, connection_info = sql_db.connection_info_for(target)
+        cr = sql_db.db_connect(target, allow_uri=True).cursor()
+        try:
+            cr.execute("SET TRANSACTION READ ONLY")
+            if timeout > 0:
+                cr.execute("SET LOCAL statement_timeout = %s", (timeout * 1000,))
+            profiler = self.env.context.get("journal_report_profiler")
+            if profiler:
+                profiler.add_cursor(cr)
+            # the connection is given to the worker processes of the shards
+            yield self.env(cr=cr, context=dict(
+                self.env.context, journal_report_cursor=True,
+                journal_report_connection_info=connection_info))
+        finally:
+            cr.close()
+            # the records read on the dedicated cursor are not kept
+            self.env["base"].invalidate_cache()
+
+    @api.model
+    def _compute_invoices_lines(self, invoices, data):
+        """computes the report lines of the given invoices with the engine
+        selected in data"""
+        show_warnings = data["form"]["show_warnings"]
+        report_type_sale = data["form"]["journal_type"] == "sale"
+        if data["form"].get("engine", "sql") == "orm":
+            return self.compute_report_lines(  invoices,data, show_warnings, report_type_sale)
+        if data["form"].get("engine") == "parallel":
+            return self.compute_report_lines_parallel(invoices, data, show_warnings, report_type_sale)
+        return self.compute_report_lines_sql(invoices, data, show_warnings, report_type_sale)
+
+    @api.model
+    def _compute_journal_periods(self, data, periods):
+        """computes the journals of consecutive periods [(date_from, date_to)]
+        with one fetch of the invoices, lines, tags and reconciliations for
+        the whole span, that is split after by periods. The not exigible
+        values carried from a period to another (base_neex/tva_neex) are
+        computed from the same payments.
+        Returns a list of (date_from, date_to, invoice_ids, lines, totals,
+        fingerprint), the fingerprint of the snapshot of the period being
+        read on the cursor of the lines"""
+        form = data["form"]
+        company = self.env["res.company"].browse(form["company_id"][0])
+        with self._report_env() as env:
+            snapshot_obj = env["l10n.ro.account.report.journal.snapshot"]
+            return [
+                result + (snapshot_obj._get_fingerprint(
+                    company, form["journal_type"], result[0], result[1]),)
+                for result in self.with_env(env)._compute_periods_lines(data, periods)
+            ]
+
+    @api.model
+    def _compute_periods_lines(self, data, periods):
+        form = data["form"]
+        cr = self.env.cr
+        company = self.env["res.company"].browse(form["company_id"][0])
+        journal_type = form["journal_type"]
+        periods = sorted((fields.Date.to_date(date_from), fields.Date.to_date(date_to))
+                         for date_from, date_to in periods)
+        span_from, span_to = periods[0][0], periods[-1][1]
+        self.env["account.move"].flush()
+
+        in_span_ids = select_invoices_in_period(cr, company.id, journal_type, span_from, span_to)
+        # invoices older than the start of any of the periods and not paid
+        older_unpaid_ids = select_older_unpaid_cash_basis_ids(
+            cr, company.id, journal_type, periods[-1][0],
+            self._get_cash_basis_lookback_limit(span_from))
+        cash_basis_dates = select_cash_basis_invoice_dates(
+            cr, company.id, journal_type, company.tax_cash_basis_journal_id.id, span_from, span_to)
+        all_ids = set(in_span_ids) | set(older_unpaid_ids) | {x[0] for x in cash_basis_dates}
+        ordered = fetch_invoice_dates_in_order(cr, all_ids)
+        invoice_dates = dict(ordered)
+
+        _columns, sumed_columns = self._get_report_columns()
+        engine = self._get_sql_engine(data, form["show_warnings"], journal_type == "sale")
+        progress = self.env.context.get("journal_report_progress")
+        base_rows, put_payments_ids, payments = {}, set(), {}
+        for chunk in split_every(IN_CHUNK_SIZE, list(all_ids)):
+            rows, chunk_put_payments_ids = engine.compute_rows(chunk)
+            base_rows.update(rows)
+            put_payments_ids |= chunk_put_payments_ids
+            payments.update(
+                engine.fetch_payments(list(chunk_put_payments_ids), company.id, span_to)
+            )
+            if progress:
+                progress(len(base_rows), len(all_ids))
+
+        results = []
+        for date_from, date_to in periods:
+            limit = self._get_cash_basis_lookback_limit(date_from)
+            ids = {x for x in in_span_ids if date_from <= invoice_dates[x] <= date_to}
+            ids |= {x for x in older_unpaid_ids
+                    if invoice_dates[x] < date_from and (not limit or invoice_dates[x] >= limit)}
+            ids |= {x for x, cash_basis_date in cash_basis_dates if date_from <= cash_basis_date <= date_to}
+            invoice_ids = [x for x, _invoice_date in ordered if x in ids]
+            report_lines = []
+            totals = self._new_totals()
+            for inv_id in invoice_ids:
+                vals = base_rows[inv_id].copy()
+                if inv_id in put_payments_ids:
+                    # the reconciliations done after this period are not known at its end
+                    period_payments = [p for p in payments.get(inv_id, []) if p["max_date"] <= date_to]
+                    engine.apply_payments(vals, period_payments, date_from)
+                self._finalize_row(vals, sumed_columns)
+                with self._profile_phase("totals"):
+                    totals.add(vals)
+                report_lines.append(vals)
+            results.append((date_from, date_to, invoice_ids, report_lines, totals.as_dict()))
+        return results
+
+    @api.model
+    def _validate_journal(self, data):
+        """returns [(invoice_id, reason)] of the invoices of the report that
+        have inconsistencies, checked with grouped queries and without
+        computing the report lines"""
+        form = data["form"]
+        with self._report_env() as env:
+            report = self.with_env(env)
+            invoices = report._get_forreport_invoices_payments(data, form["journal_type"])
+            engine = report._get_sql_engine(data, report_type_sale=form["journal_type"] == "sale")
+            return [(inv_id, reason) for inv_id, _line_id, reason in engine.validate(invoices.ids)]
+
+    @api.model
+    def _get_journal_lines(self, data):
+        """returns the report lines and totals, from the stored snapshot of
+        the period if the form asks for it"""
+        if data["form"].get("use_snapshot"):
+            return self.env["l10n.ro.account.report.journal.snapshot"]._get_journal_lines(
+                data, force_recompute=data["form"].get("recompute_snapshot"))
+        _invoices, report_lines, totals = self._compute_journal(data)
+        return report_lines, totals
+
+    @api.model
+    def _get_report_header_values(self, data):
+        """the values of the report, without the lines and totals"""
+        company_id = data["form"]["company_id"]
+        return {
+            "print_datetime": fields.datetime.now(),
+            "date_from": data["form"]["date_from"],
+            "date_to": data["form"]["date_to"],
+            "show_warnings": data["form"]["show_warnings"],
+            "user": self.env.user.name,
+            "company": self.env["res.company"].browse(company_id[0]),
+            "report_type_sale": data["form"]["journal_type"] == "sale",
+            "line_offset": 0,
+            "profile": [],
+        }
 
     @api.model
     def _get_report_values(self, docids, data=None):
@@ -76,42 +298,188 @@ class SaleJournalReport(models.TransientModel):
         date_from = data["form"]["date_from"]
         date_to = data["form"]["date_to"]
         journal_type = data["form"]["journal_type"]
-        invoices = self._get_forreport_invoices_payments(data, journal_type)
-#        invoices = self.env["account.move"].search(domain, order="invoice_date, name")
-        
-        
-        show_warnings = data["form"]["show_warnings"]
-        report_type_sale = journal_type == "sale"
 
-        report_lines, totals = self.compute_report_lines(  invoices,data, show_warnings, report_type_sale)
+        profiler = JournalProfiler(self.env.cr)
+        report_lines, totals = self.with_context(
+            journal_report_profiler=profiler)._get_journal_lines(data)
+        profiler.log(_logger, "Journal %s %s - %s of company %s, %s lines" % (
+            journal_type, date_from, date_to, company_id[0], len(report_lines)))
 
-        docargs = {
-            "print_datetime": fields.datetime.now(),
-            "date_from": date_from,
-            "date_to": date_to,
-            "show_warnings": show_warnings,
-            "user": self.env.user.name,
-            "company": self.env["res.company"].browse(company_id[0]),
+        docargs = self._get_report_header_values(data)
+        docargs.update({
             "lines": report_lines,
             "totals": totals,
-            "report_type_sale": report_type_sale,
-        }
+            # debug footer of the HTML report
+            "profile": profiler.summary() if data["form"].get("show_profile") else [],
+        })
         return docargs
 
-    def compute_report_lines( self, invoices, data, show_warnings=False, report_type_sale=True ):
-        """input:
-        invoices = account.move list of invoices to be showed in report
-        payments = account.move list of payments done on vat_on_payment invoices
-        vat_on_payment_reconcile = partial.reconcile  list of efective accounting moves that are telling what taxes are to be paid 
-        data = dictionary with selected options like date_from, date_to, company...
-        
-        returns a list of a dictionary for table with the key as column
-        and total dictionary with the sums of columns """
+    @api.model
+    def _render_pdf_chunked(self, report, data):
+        """renders big journals as page sized chunks of lines in parallel
+        wkhtmltopdf processes and merges them. Every chunk has the table
+        header, the row numbers are continued and only the last chunk has
+        the totals. The lines are streamed, only the chunks being rendered
+        are in memory. Returns None if the journal is not big enough"""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        chunk_size = int(get_param("l10n_ro_account_report_journal.pdf_chunk_size", 2000))
+        workers = int(get_param("l10n_ro_account_report_journal.pdf_workers", 0)) or os.cpu_count() or 1
+        if chunk_size <= 0 or self._count_journal_lines(data) <= chunk_size:
+            # a small journal, rendered as usual
+            return None
 
-        if not invoices:
-            return [],{}
-        account_partial_reconcile_obj = self.env['account.partial.reconcile']
-        
+        values = dict(data, report_type="pdf")
+        values.update(self._get_report_header_values(data))
+        report = report.with_context(debug=False)
+        paperformat = report.get_paperformat()
+        command_args = report._build_wkhtmltopdf_args(
+            paperformat,
+            report._context.get("landscape"),
+            specific_paperformat_args=None,
+            set_viewport_size=report._context.get("set_viewport_size"),
+        )
+
+        totals = self._new_totals()
+        lines = self._stream_journal(data, totals)
+
+        def prepare_chunks():
+            offset = 0
+            chunk = list(islice(lines, chunk_size))
+            while chunk:
+                next_chunk = list(islice(lines, chunk_size))
+                chunk_values = dict(
+                    values,
+                    lines=chunk,
+                    line_offset=offset,
+                    # the stream is consumed when there is no next chunk
+                    totals=totals.as_dict() if not next_chunk else {},
+                )
+                html = report._render_template(report.report_name, chunk_values)
+                bodies, _html_ids, header, footer, specific_args = report._prepare_html(html)
+                args = command_args
+                if specific_args:
+                    args = report._build_wkhtmltopdf_args(
+                        paperformat,
+                        report._context.get("landscape"),
+                        specific_paperformat_args=specific_args,
+                        set_viewport_size=report._context.get("set_viewport_size"),
+                    )
+                yield args, bodies, header, footer
+                offset += len(chunk)
+                chunk = next_chunk
+
+        _logger.info("Rendering journal in chunks of %s lines with %s workers",
+                     chunk_size, workers)
+        return render_chunks_parallel(prepare_chunks(), workers)
+
+    @api.model
+    def _count_journal_lines(self, data):
+        """returns the number of lines of the journal without computing
+        them: the lines of the valid snapshot, or the report invoices"""
+        form = data["form"]
+        if form.get("use_snapshot"):
+            return self.env["l10n.ro.account.report.journal.snapshot"]._get_valid_snapshot(data).line_count
+        with self._report_env() as env:
+            report = self.with_env(env)
+            extra_ids = report._get_cash_basis_invoice_ids(data, form["journal_type"])
+            return count_report_invoices(
+                env.cr, form["company_id"][0], form["journal_type"],
+                form["date_from"], form["date_to"], extra_ids)
+
+    @api.model
+    def _export_journal(self, data, export_format="csv"):
+        """writes the journal rows into a CSV/XLSX attachment as they are
+        streamed (SQL engine or stored snapshot), the payments being
+        flattened in rows under the invoice"""
+        form = data["form"]
+        writer_class = JOURNAL_WRITERS[export_format]
+        if export_format == "xlsx" and not xlsxwriter:
+            raise UserError(_("The python library xlsxwriter is not installed."))
+        totals = self._new_totals()
+        with tempfile.TemporaryFile() as fileobj:
+            writer = writer_class(fileobj)
+            writer.write(header_row())
+            for vals in self._stream_journal(data, totals):
+                for row in flatten_row(vals):
+                    writer.write(row)
+            writer.write(totals_row(totals.as_dict()))
+            writer.close()
+            return self._create_export_attachment(fileobj, {
+                "name": "%s_journal_%s_%s.%s" % (
+                    form["journal_type"], form["date_from"], form["date_to"], writer_class.extension),
+                "mimetype": writer_class.mimetype,
+            })
+
+    @api.model
+    def _create_export_attachment(self, fileobj, vals):
+        """creates the attachment of an export from its temporary file. The
+        rows are generated into the file, only the finished export is read
+        in memory: ir.attachment (and its _file_write) takes the content as
+        bytes"""
+        fileobj.seek(0)
+        return self.env["ir.attachment"].create(dict(vals, raw=fileobj.read()))
+
+    @api.model
+    def _compute_partner_summary(self, data):
+        """returns the journal columns of the invoices of data summed by
+        commercial partner and VAT code, as a list of (row, invoices count)
+        sorted by partner, and the totals (the same as the journal totals,
+        without the rows count of the payments). The sums are made by the
+        database, only the rows of the VAT on payment invoices are
+        computed"""
+        form = data["form"]
+        company_id = form["company_id"][0]
+        with self._report_env() as env:
+            report = self.with_env(env)
+            with report._profile_phase("selection"):
+                invoices = report._get_forreport_invoices_payments(data, form["journal_type"])
+            engine = report._get_sql_engine(data, report_type_sale=form["journal_type"] == "sale")
+            with report._profile_phase("partner summary"):
+                summary = engine.compute_partner_summary(
+                    invoices.ids, company_id, fields.Date.to_date(form["date_from"]), form["date_to"])
+        _columns, sumed_columns = self._get_report_columns()
+        totals = self._new_totals()
+        lines = []
+        for key in sorted(summary, key=lambda k: (summary[k][0]["partner"] or "", k[1] or "", k[0] or 0)):
+            vals, count = summary[key]
+            self._finalize_row(vals, sumed_columns)
+            totals.add(vals)
+            lines.append((vals, count))
+        totals = totals.as_dict()
+        # the number of table rows of the journal, not of the summary
+        totals.pop("rowspan", None)
+        return lines, totals
+
+    @api.model
+    def _export_partner_summary(self, data, export_format="csv"):
+        """writes the partner summary of the journal into a CSV/XLSX
+        attachment, with a totals row"""
+        form = data["form"]
+        writer_class = JOURNAL_WRITERS[export_format]
+        if export_format == "xlsx" and not xlsxwriter:
+            raise UserError(_("The python library xlsxwriter is not installed."))
+        lines, totals = self._compute_partner_summary(data)
+        with tempfile.TemporaryFile() as fileobj:
+            writer = writer_class(fileobj)
+            writer.write(partner_summary_header_row())
+            for vals, count in lines:
+                writer.write(partner_summary_row(vals, count))
+            writer.write(partner_summary_row(
+                dict(totals, partner="totals", vat=""), sum(count for _vals, count in lines)))
+            writer.close()
+            fileobj.seek(0)
+            content = fileobj.read()
+        return self.env["ir.attachment"].create({
+            "name": "%s_partner_summary_%s_%s.%s" % (
+                form["journal_type"], form["date_from"], form["date_to"], writer_class.extension),
+            "raw": content,
+            "mimetype": writer_class.mimetype,
+        })
+
+    @api.model
+    def _get_report_columns(self):
+        """returns the report columns with the tax tags names that are summed
+        into them and the columns that are sums of other columns"""
         sale_and_purchase_comun_columns = { 'base_neex':{'type':'int','tags':['-09_1 - BAZA','+09_1 - BAZA', '-10_1 - BAZA','+10_1 - BAZA', '-11_1 - BAZA','+11_1 - BAZA' ]}, # vat on payment
                                            'tva_neex':{'type':'int','tags':[ '-09_1 - TVA','+09_1 - TVA', '-10_1 - TVA','+10_1 - TVA', '-11_1 - TVA','+11_1 - TVA']}, 
 
@@ -151,6 +519,11 @@ class SaleJournalReport(models.TransientModel):
                         "total_base": ['base_19','base_9','base_5','base_0','base_exig'],
                         "total_vat": ['tva_19', 'tva_9', 'tva_5', 'tva_bun','tva_serv','tva_exig'],
                         }  # must be int
+        return sale_and_purchase_comun_columns, sumed_columns
+
+    @api.model
+    def _get_known_tags(self, sale_and_purchase_comun_columns):
+        """returns a dictionary tag name -> list of columns"""
         all_known_tags = {}
         for k,v in sale_and_purchase_comun_columns.items():
             for tag in v['tags']:
@@ -161,17 +534,111 @@ class SaleJournalReport(models.TransientModel):
                     #raise ValidationError(warn )
                 else:
                     all_known_tags[tag] = [k]
+        return all_known_tags
 
+    @api.model
+    def _get_tag_index(self, company_id):
+        """returns the TagColumnIndex (tag id -> report columns) of company.
+        Only the tags of the company country and the ones without country
+        are classified, the tags of other charts can have the same names.
+        The count and the last write date of the tags are in the cache key,
+        a change of the tags (or of the company country) is seen by all the
+        workers without clearing the caches of the registry"""
+        self.env["account.account.tag"].flush()
+        self.env.cr.execute("SELECT COUNT(*), MAX(write_date) FROM account_account_tag")
+        tags_count, tags_write_date = self.env.cr.fetchone()
+        country_id = self.env["res.company"].browse(company_id).country_id.id
+        return self._compile_tag_index(country_id or False, tags_count, tags_write_date)
+
+    @api.model
+    @tools.ormcache("country_id", "tags_count", "tags_write_date")
+    def _compile_tag_index(self, country_id, tags_count, tags_write_date):
+        columns, _sumed_columns = self._get_report_columns()
+        known_tags = self._get_known_tags(columns)
+        domain = []
+        if country_id:
+            domain = [("country_id", "in", [country_id, False])]
+        tags = self.env["account.account.tag"].with_context(active_test=False).search_read(domain, ["name"])
+        return TagColumnIndex(columns, known_tags, [(x["id"], x["name"]) for x in tags])
+
+    @api.model
+    def _get_partner_account_prefixes(self):
+        """the code prefixes of the receivable/payable accounts, whose lines
+        are the counterpart of the invoice (not in the report columns)"""
+        prefixes = self.env["ir.config_parameter"].sudo().get_param(
+            "l10n_ro_account_report_journal.partner_account_prefixes", "411,401")
+        return [prefix.strip() for prefix in prefixes.split(",") if prefix.strip()]
+
+    @api.model
+    def _get_partner_account_ids(self, company_id):
+        """ids of the accounts of company with a partner account prefix,
+        searched once for a report so the lines are classified by their
+        account id"""
+        prefixes = self._get_partner_account_prefixes()
+        if not prefixes:
+            return frozenset()
+        domain = expression.AND([
+            [("company_id", "=", company_id)],
+            expression.OR([[("code", "=like", prefix + "%")] for prefix in prefixes]),
+        ])
+        return frozenset(self.env["account.account"].with_context(active_test=False).search(domain).ids)
+
+    @api.model
+    def _get_empty_row(self, sale_and_purchase_comun_columns, sumed_columns):
         empty_row = {k:0.0 for k in sumed_columns}
         empty_row.update( {k:0.0 for k,v in sale_and_purchase_comun_columns.items() if v['type']=='int' }) 
         empty_row.update( {k:'' for k,v in sale_and_purchase_comun_columns.items() if v['type']=='char' }) 
-        empty_row.update( {k:[] for k,v in sale_and_purchase_comun_columns.items() if v['type']=='list' }) 
+        empty_row.update( {k:[] for k,v in sale_and_purchase_comun_columns.items() if v['type']=='list' })
+        return empty_row
+
+    @api.model
+    @tools.ormcache()
+    def _get_row_layout(self):
+        """the fixed columns of the report lines: the empty row columns and
+        the invoice columns. The summed ones are the numeric columns"""
+        sale_and_purchase_comun_columns, sumed_columns = self._get_report_columns()
+        defaults = self._get_empty_row(sale_and_purchase_comun_columns, sumed_columns)
+        defaults.update({"number": False, "date": False, "partner": False,
+                         "vat": False, "total": 0.0, "warnings": "", "rowspan": 1})
+        numeric_keys = [k for k, v in defaults.items()
+                        if type(v) in (int, float)]
+        return RowLayout(defaults, numeric_keys)
+
+    @api.model
+    def _new_totals(self):
+        return JournalTotals(self._get_row_layout())
+
+    def compute_report_lines( self, invoices, data, show_warnings=False, report_type_sale=True ):
+        """input:
+        invoices = account.move list of invoices to be showed in report
+        payments = account.move list of payments done on vat_on_payment invoices
+        vat_on_payment_reconcile = partial.reconcile  list of efective accounting moves that are telling what taxes are to be paid 
+        data = dictionary with selected options like date_from, date_to, company...
         
+        returns a list of a dictionary for table with the key as column
+        and total dictionary with the sums of columns """
+
+        if not invoices:
+            return [],{}
+
+        _columns, sumed_columns = self._get_report_columns()
+        tag_index = self._get_tag_index(data["form"]["company_id"][0])
+        row_layout = self._get_row_layout()
+        totals = self._new_totals()
+        engine = self._get_sql_engine(data, show_warnings, report_type_sale)
+        partner_account_ids = engine.partner_account_ids
+        # the line reconciled with the payments, of every invoice
+        self.env["account.move"].flush()
+        counterparts = engine.fetch_counterpart_lines(invoices.ids)
+        with self._profile_phase("reconciliations"):
+            invoices_payments = self._get_invoices_payments(
+                invoices, data, counterparts, partner_account_ids)
 
         sign = 1 if report_type_sale else -1
+        progress = self.env.context.get("journal_report_progress")
         report_lines = []
         for inv1 in invoices:
-            vals = deepcopy(empty_row)
+            vals = row_layout.new_row()
             vals["number"] = inv1.name
             vals["date"] = inv1.invoice_date
             vals["partner"] = inv1.commercial_partner_id.name #invoice_partner_display_name
@@ -182,116 +649,335 @@ class SaleJournalReport(models.TransientModel):
 
             put_payments = False # after parsing the invoice lines, if is vat on payment, to put also the payments
 # take all the lines from this invoice and put them into dictionary            
-            for line in inv1.line_ids:
-                if line.display_type in ['line_section', 'line_note']:
-                    continue
-                if line.account_id.code.startswith(
-                    "411"
-                ) or line.account_id.code.startswith("401"):
-                    if vals["total"] != sign*(-line.credit + line.debit):
-                        vals["warnings"] += (
-                            f"The value of invoice is {vals['total']} but "
-                            f"accounting account {line.account_id.code} has "
-                            f"a value of  {sign*(-line.credit+line.debit)}"
-                        )
-                else:
-                    unknown_line = True
-                    if not line.tax_exigible:  # VAT on payment
-                        put_payments = True
-                        for tag in line.tax_tag_ids:  
-                        # adding the base and vat from original invoice
-                            if tag.name in sale_and_purchase_comun_columns['base_neex']['tags']:
-                                vals['base_neex'] += sign*(line.credit - line.debit)
-                                unknown_line = False
-                            elif tag.name in sale_and_purchase_comun_columns['tva_neex']['tags']:
-                                vals['tva_neex'] += sign*(line.credit - line.debit)
-                                unknown_line = False
-
-                    else: # NOT VAT on payment
-                        if not line.tax_tag_ids:
-                            vals['base_0'] += sign*(line.credit - line.debit)
-                            unknown_line = False
-                        else:
-                            for tag in line.tax_tag_ids:
-                                if tag.name in all_known_tags.keys():
-                                    for tagx in all_known_tags[tag.name]:
-                                        if tagx not in ['tva_neex','base_neex',]:
-                                            vals[tagx] +=  sign*(line.credit - line.debit)
+            with self._profile_phase("classification"):
+                for line in inv1.line_ids:
+                    if line.display_type in ['line_section', 'line_note']:
+                        continue
+                    if line.account_id.id in partner_account_ids:
+                        if vals["total"] != sign*(-line.credit + line.debit):
+                            vals["warnings"] += (
+                                f"The value of invoice is {vals['total']} but "
+                                f"accounting account {line.account_id.code} has "
+                                f"a value of  {sign*(-line.credit+line.debit)}"
+                            )
+                    else:
+                        unknown_line = True
+                        if not line.tax_exigible:  # VAT on payment
+                            put_payments = True
+                            for tag in line.tax_tag_ids:  
+                            # adding the base and vat from original invoice
+                                if tag.id in tag_index.base_neex_ids:
+                                    vals['base_neex'] += sign*(line.credit - line.debit)
+                                    unknown_line = False
+                                elif tag.id in tag_index.tva_neex_ids:
+                                    vals['tva_neex'] += sign*(line.credit - line.debit)
                                     unknown_line = False
-                        if  unknown_line:
-                            vals['warnings'] += f"unknown report column for line {line.name} debit={line.debit} credit={line.credit} TAGS{[x.name for x in line.tax_tag_ids]};" 
+
+                        else: # NOT VAT on payment
+                            if not line.tax_tag_ids:
+                                vals['base_0'] += sign*(line.credit - line.debit)
+                                unknown_line = False
+                            else:
+                                for tag in line.tax_tag_ids:
+                                    if tag.id in tag_index.known_ids:
+                                        for tagx in tag_index.columns[tag.id]:
+                                            if tagx not in ['tva_neex','base_neex',]:
+                                                vals[tagx] +=  sign*(line.credit - line.debit)
+                                        unknown_line = False
+                            if  unknown_line:
+                                vals['warnings'] += f"unknown report column for line {line.name} debit={line.debit} credit={line.credit} TAGS{[x.name for x in line.tax_tag_ids]};" 
 
             if put_payments:
-            # This invoice is vat on payment and we are going to put the payments
-# search the reconcile line
-                reconcile_account_move_line_id = False
-                for line in inv1.line_ids:
-                    if line.account_id.code.startswith("411") or line.account_id.code.startswith("401"):
-                        reconcile_account_move_line_id = line.id
-                        break
+                with self._profile_phase("reconciliations"):
+                    self._add_invoice_payments(
+                        vals, invoices_payments.get(inv1.id, []), data, sign, tag_index)
+            self._finalize_row(vals, sumed_columns)
+            with self._profile_phase("totals"):
+                totals.add(vals)
+            report_lines += [vals]  # we added another line to the table
+            if progress and not len(report_lines) % 1000:
+                progress(len(report_lines), len(invoices))
+
+        return report_lines, totals.as_dict()
+
+    def compute_report_lines_sql(self, invoices, data, show_warnings=False, report_type_sale=True):
+        """same result as compute_report_lines, but the invoice lines are
+        read with grouped queries by SqlJournalEngine instead of walking
+        every line and tag through the ORM"""
+        totals = self._new_totals()
+        report_lines = []
+        for vals in self._iter_report_lines_sql(invoices, data, show_warnings, report_type_sale):
+            with self._profile_phase("totals"):
+                totals.add(vals)
+            report_lines.append(vals)
+        return report_lines, totals.as_dict()
+
+    @api.model
+    def _get_compute_workers(self):
+        workers = int(self.env["ir.config_parameter"].sudo().get_param(
+            "l10n_ro_account_report_journal.compute_workers", 0) or 0)
+        return workers if workers > 0 else (os.cpu_count() or 1)
+
+    @api.model
+    def _can_fork(self):
+        """the compute processes are forked, that is safe only from a
+        process with one thread: the prefork workers and cron workers, not
+        the threaded or gevent servers (a lock held by another thread would
+        stay locked in the child)"""
+        return not odoo.evented and threading.active_count() == 1
+
+    @api.model
+    def _map_shards(self, shards, workers):
+        """yields the rows of every shard, in the shards order, computed by
+        a pool of forked processes (they are not importing the addons
+        again, they are not using the connections of the server)"""
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(shards)),
+            mp_context=multiprocessing.get_context("fork"),
+        ) as executor:
+            yield from executor.map(compute_shard, shards)
+
+    def compute_report_lines_parallel(self, invoices, data, show_warnings=False, report_type_sale=True):
+        """same result as compute_report_lines_sql, but the invoices are split
+        in shards computed by a pool of processes. Every process has its own
+        connection on the snapshot exported by this transaction, so all see
+        the same data; the shards are consecutive slices of the invoices and
+        are merged in their order (invoice_date, name).
+
+        The workers see only the committed data: the changes not committed
+        by this transaction are not in the exported snapshot. In a threaded
+        server the lines are computed by compute_report_lines_sql"""
+        workers = self._get_compute_workers()
+        shard_size = max(IN_CHUNK_SIZE, -(-len(invoices) // (workers * 4)))
+        if workers <= 1 or len(invoices) <= shard_size:
+            return self.compute_report_lines_sql(invoices, data, show_warnings, report_type_sale)
+        if not self._can_fork():
+            _logger.info("Journal computed without worker processes, the server has threads")
+            return self.compute_report_lines_sql(invoices, data, show_warnings, report_type_sale)
+
+        form = data["form"]
+        self.env["account.move"].flush()
+        self.env.cr.execute("SELECT pg_export_snapshot()")
+        snapshot = self.env.cr.fetchone()[0]
+        # the database of the report cursor (a replica), otherwise the cursor
+        # is one of the server database
+        connection_info = self.env.context.get(
+            "journal_report_connection_info"
+        ) or sql_db.connection_info_for(self.env.cr.dbname)[1]
+        row_layout = self._get_row_layout()
+        common = (
+            connection_info,
+            snapshot,
+            self._get_tag_index(form["company_id"][0]),
+            row_layout,
+            report_type_sale,
+            show_warnings,
+            self._get_partner_account_ids(form["company_id"][0]),
+            form["company_id"][0],
+            fields.Date.to_date(form["date_from"]),
+            form["date_to"],
+        )
+        shards = [common + (list(ids),) for ids in split_every(shard_size, invoices.ids)]
+
+        _columns, sumed_columns = self._get_report_columns()
+        progress = self.env.context.get("journal_report_progress")
+        totals = self._new_totals()
+        report_lines = []
+        with self._profile_phase("parallel"):
+            for shard_rows in self._map_shards(shards, workers):
+                for _inv_id, values in shard_rows:
+                    vals = JournalRow(row_layout, values)
+                    self._finalize_row(vals, sumed_columns)
+                    with self._profile_phase("totals"):
+                        totals.add(vals)
+                    report_lines.append(vals)
+                if progress:
+                    progress(len(report_lines), len(invoices))
+        return report_lines, totals.as_dict()
+
+    def _iter_report_lines_sql(self, invoices, data, show_warnings=False, report_type_sale=True):
+        """yields the report lines of the invoices in their order. The lines
+        are computed in chunks, so a consumer that does not keep them (like
+        the exports) has a bounded memory usage"""
+        if not invoices:
+            return
+        self.env["account.move"].flush()
+        engine = self._get_sql_engine(data, show_warnings, report_type_sale)
+        progress = self.env.context.get("journal_report_progress")
+
+        done = 0
+        for chunk in split_every(IN_CHUNK_SIZE, invoices.ids):
+            yield from self._compute_rows_batch(engine, chunk, data)
+            done += len(chunk)
+            if progress:
+                progress(done, len(invoices))
+
+    def _stream_report_lines_sql(self, data, totals=None):
+        """yields the report lines of the period of data as they are
+        computed. The invoices are read in the report order with a server
+        side cursor, batch by batch, so only the rows and the ORM cache of
+        one batch are in memory whatever the size of the period. The lines
+        are added to totals (JournalTotals) if given"""
+        for _invoice_id, vals in self._stream_invoice_rows_sql(data, totals):
+            yield vals
+
+    @api.model
+    def _stream_invoice_rows_sql(self, data, totals=None):
+        """same as _stream_report_lines_sql, yields (invoice id, line)"""
+        form = data["form"]
+        company_id = form["company_id"][0]
+        journal_type = form["journal_type"]
+        self.env["account.move"].flush()
+        extra_ids = self._get_cash_basis_invoice_ids(data, journal_type)
+        progress = self.env.context.get("journal_report_progress")
+        count = progress and count_report_invoices(
+            self.env.cr, company_id, journal_type, form["date_from"], form["date_to"], extra_ids)
+        engine = self._get_sql_engine(data, form["show_warnings"], journal_type == "sale")
+
+        done = 0
+        for batch in stream_report_invoice_ids(
+                self.env.cr, company_id, journal_type, form["date_from"], form["date_to"], extra_ids):
+            for invoice_id, vals in zip(batch, self._compute_rows_batch(engine, batch, data)):
+                if totals is not None:
+                    with self._profile_phase("totals"):
+                        totals.add(vals)
+                yield invoice_id, vals
+            done += len(batch)
+            if progress:
+                progress(done, count)
+            # the records read for the previous batch (by the consumer also)
+            self.env["base"].invalidate_cache()
+
+    @api.model
+    def _stream_journal(self, data, totals):
+        """yields the report lines of data, from the stored snapshot (by
+        pages) if the form asks for it, otherwise computed in stream; the
+        lines are added to totals"""
+        if not data["form"].get("use_snapshot"):
+            with self._report_env() as env:
+                yield from self.with_env(env)._stream_report_lines_sql(data, totals)
+            return
+        snapshot = self.env["l10n.ro.account.report.journal.snapshot"]._get_valid_snapshot(data)
+        after = -1
+        while True:
+            page = snapshot._read_page(after, IN_CHUNK_SIZE)
+            for _sequence, line in page:
+                vals = snapshot._load_row(line)
+                totals.add(vals)
+                yield vals
+            if len(page) < IN_CHUNK_SIZE:
+                break
+            after = page[-1][0]
+
+    @api.model
+    def _get_sql_engine(self, data, show_warnings=False, report_type_sale=True):
+        return SqlJournalEngine(
+            self.env.cr,
+            self._get_tag_index(data["form"]["company_id"][0]),
+            self._get_row_layout(),
+            report_type_sale=report_type_sale,
+            show_warnings=show_warnings,
+            partner_account_ids=self._get_partner_account_ids(data["form"]["company_id"][0]),
+        )
+
+    def _compute_rows_batch(self, engine, invoice_ids, data):
+        """yields the finished rows of invoice_ids, in their order"""
+        _columns, sumed_columns = self._get_report_columns()
+        company_id = data["form"]["company_id"][0]
+        date_from = fields.Date.to_date(data["form"]["date_from"])
+        with self._profile_phase("classification"):
+            rows, put_payments_ids = engine.compute_rows(invoice_ids)
+        with self._profile_phase("reconciliations"):
+            # all the payments of vat on payment invoices are taken in one pass
+            payments = engine.fetch_payments(
+                list(put_payments_ids), company_id, data["form"]["date_to"]
+            )
+            for inv_id in put_payments_ids:
+                engine.apply_payments(rows[inv_id], payments.get(inv_id, []), date_from)
+        for inv_id in invoice_ids:
+            vals = rows.pop(inv_id)
+            self._finalize_row(vals, sumed_columns)
+            yield vals
+
+    def _get_invoices_payments(self, invoices, data, counterparts, partner_account_ids):
+        """returns invoice id -> list of the tax cash basis moves (payments)
+        till date_to of the VAT on payment invoices. They are read for all
+        the invoices with one search of the reconciliations of their
+        receivable/payable lines (counterparts) and one of the moves, in
+        the order of the account.move search"""
+        cash_basis_invoices = self.env["account.move.line"].search([
+            ("move_id", "in", invoices.ids),
+            ("tax_exigible", "=", False),
+            ("account_id", "not in", list(partner_account_ids)),
+            "|", ("display_type", "=", False), ("display_type", "not in", ["line_section", "line_note"]),
+        ]).mapped("move_id")
+        line_invoices = {}
+        for invoice in cash_basis_invoices:
+            if counterparts.get(invoice.id):
+                line_invoices.setdefault(counterparts[invoice.id], []).append(invoice.id)
+        if not line_invoices:
+            return {}
 # find all the reconciliation till date to
-                all_reconcile = account_partial_reconcile_obj.search([
-                    '|',('debit_move_id','=',reconcile_account_move_line_id) ,('credit_move_id','=',reconcile_account_move_line_id),
-                    ('company_id','=',data["form"]["company_id"][0]),
-                    ('max_date','<=',data["form"]["date_to"]),  ])
-                all_reconcile_ids = [x.id for x in all_reconcile]
-             
-                for move in self.env['account.move'].search([('tax_cash_basis_rec_id', 'in', all_reconcile_ids)]):
-                    if move.date < datetime.strptime(data["form"]["date_from"], DEFAULT_SERVER_DATE_FORMAT).date() :  
-                    # this payment is in a period before and we will just substract it
-                        for move_line in move.line_ids:
-                            for tag in move_line.tax_tag_ids:
-                                if tag.name in sale_and_purchase_comun_columns['base_neex']['tags']:
-                                    vals['base_neex'] -= sign*(move_line.credit - move_line.debit)
-                                elif tag.name in sale_and_purchase_comun_columns['tva_neex']['tags']:
-                                    vals['tva_neex'] -= sign*(move_line.credit - move_line.debit)
-                    else:  
-                    # is payment in period and we are going also to show it, and also substract it
-                        vals["rowspan"] += 1
-                        vals['payments'] += [{'number':move.ref ,'date': move.date,'amount':move.amount_total,'base_exig':0,'tva_exig':0}]
-                        for move_line in move.line_ids:
-                            if 'TVA' in ''.join([x.name for x in move_line.tax_tag_ids]):
-                                vals['payments'][-1]['tva_exig'] += sign*(move_line.credit - move_line.debit)
-                            elif 'BAZA' in ''.join([x.name for x in move_line.tax_tag_ids]):
-                                vals['payments'][-1]['base_exig'] +=sign*(move_line.credit - move_line.debit)
-                            for tag in move_line.tax_tag_ids:
-                                if tag.name in all_known_tags.keys()  :
-                                    for tagx in all_known_tags[tag.name]:
-                                        if tagx in ['base_neex', 'tva_neex']:
-                                            vals[tagx] -=  sign*(move_line.credit - move_line.debit) # we substract neexigible because is exigible
-                                        else:
-                                            vals[tagx] +=  sign*(move_line.credit - move_line.debit)
-            if vals["rowspan"]>1:
-                vals["rowspan"] -= 1
-            
-            vals['base_neex'],vals['tva_neex']=round(vals['base_neex'],2),round(vals['tva_neex'],2)
-            
-            for key, value in sumed_columns.items():
-            # put the aggregated values ( summed columns)
-                vals[key] = sum([vals[x] for x in value])
+        all_reconcile = self.env['account.partial.reconcile'].search([
+            '|',('debit_move_id','in',list(line_invoices)) ,('credit_move_id','in',list(line_invoices)),
+            ('company_id','=',data["form"]["company_id"][0]),
+            ('max_date','<=',data["form"]["date_to"]),  ])
+        reconcile_invoices = {}
+        for reconcile in all_reconcile:
+            reconcile_invoices[reconcile.id] = [
+                invoice_id
+                for line_id in {reconcile.debit_move_id.id, reconcile.credit_move_id.id}
+                for invoice_id in line_invoices.get(line_id, [])
+            ]
+        invoices_payments = {}
+        for move in self.env['account.move'].search([('tax_cash_basis_rec_id', 'in', all_reconcile.ids)]):
+            for invoice_id in reconcile_invoices[move.tax_cash_basis_rec_id.id]:
+                invoices_payments.setdefault(invoice_id, []).append(move)
+        return invoices_payments
 
-            report_lines += [vals]  # we added another line to the table
-            
-# # print extracted               for testing
-#             text=text_antet=''
-#             for key,value in vals.items():
-#                 if key in ['date','partner','total']:
-#                     text_antet += key+':'+str(value)+','
-#                 elif (type(value) is float) and value!=0:
-#                     text += f"{key}:{value};"
-#                 else:
-#                     continue
-#             print(text_antet+text)
-
-
-# make the totals dictionary for total line of table as sum of all the integer/float values of vals
-        int_float_keys = []
-        for key, value in report_lines[0].items():
-            if (type(value) is int) or (type(value) is float):
-                int_float_keys.append(key)
-        totals = {}
-        for key in int_float_keys:
-            totals[key] = round(sum([x[key] for x in report_lines]),2)
-        totals['payments'] =[]
+    def _add_invoice_payments(self, vals, payments, data, sign, tag_index):
+        """This invoice is vat on payment and we are going to put its
+        payments (tax cash basis moves, from _get_invoices_payments)"""
+        for move in payments:
+            if move.date < datetime.strptime(data["form"]["date_from"], DEFAULT_SERVER_DATE_FORMAT).date() :  
+            # this payment is in a period before and we will just substract it
+                for move_line in move.line_ids:
+                    for tag in move_line.tax_tag_ids:
+                        if tag.id in tag_index.base_neex_ids:
+                            vals['base_neex'] -= sign*(move_line.credit - move_line.debit)
+                        elif tag.id in tag_index.tva_neex_ids:
+                            vals['tva_neex'] -= sign*(move_line.credit - move_line.debit)
+            else:  
+            # is payment in period and we are going also to show it, and also substract it
+                vals["rowspan"] += 1
+                vals['payments'] += [{'number':move.ref ,'date': move.date,'amount':move.amount_total,'base_exig':0,'tva_exig':0}]
+                for move_line in move.line_ids:
+                    if tag_index.tva_ids.intersection(move_line.tax_tag_ids.ids):
+                        vals['payments'][-1]['tva_exig'] += sign*(move_line.credit - move_line.debit)
+                    elif tag_index.baza_ids.intersection(move_line.tax_tag_ids.ids):
+                        vals['payments'][-1]['base_exig'] +=sign*(move_line.credit - move_line.debit)
+                    for tag in move_line.tax_tag_ids:
+                        if tag.id in tag_index.known_ids:
+                            for tagx in tag_index.columns[tag.id]:
+                                if tagx in ['base_neex', 'tva_neex']:
+                                    vals[tagx] -=  sign*(move_line.credit - move_line.debit) # we substract neexigible because is exigible
+                                else:
+                                    vals[tagx] +=  sign*(move_line.credit - move_line.debit)
 
-        return report_lines, totals
+    def _finalize_row(self, vals, sumed_columns):
+        if vals["rowspan"]>1:
+            vals["rowspan"] -= 1
+
+        vals['base_neex'],vals['tva_neex']=round(vals['base_neex'],2),round(vals['tva_neex'],2)
+
+        for key, value in sumed_columns.items():
+        # put the aggregated values ( summed columns)
+            vals[key] = sum([vals[x] for x in value])
+
+    def _compute_totals(self, report_lines):
+        """make the totals dictionary for total line of table as sum of all the integer/float values of vals"""
+        totals = self._new_totals()
+        with self._profile_phase("totals"):
+            for vals in report_lines:
+                totals.add(vals)
+        return totals.as_dict()
@@ -0,0 +1,149 @@
+/* Copyright (C) 2020 OdooERP Romania
+ * License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html). */
+
+/* Loads the lines of the journal page by page, when the end of the table
+ * becomes visible, and the totals once all the lines are shown. A journal
+ * not computed yet is computed by a background job, its status is asked
+ * until the lines can be loaded. */
+(function () {
+    "use strict";
+
+    var PAGE_SIZE = 200;
+    var STATUS_DELAY = 2000;
+
+    function rpc(url, params) {
+        return fetch(url, {
+            method: "POST",
+            credentials: "same-origin",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({jsonrpc: "2.0", method: "call", params: params}),
+        })
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (result) {
+                if (result.error) {
+                    throw new Error(result.error.data.message || result.error.message);
+                }
+                return result.result;
+            });
+    }
+
+    function cell(row, value) {
+        var td = row.insertCell();
+        if (typeof value === "number") {
+            td.className = "number";
+            td.textContent = value.toFixed(2);
+        } else {
+            td.textContent = value === false || value === null || value === undefined ? "" : value;
+        }
+        return td;
+    }
+
+    function start() {
+        var table = document.getElementById("journal_table");
+        var sentinel = document.getElementById("journal_sentinel");
+        if (!table) {
+            return;
+        }
+        var options = JSON.parse(table.dataset.options);
+        // the snapshot validated when the view was opened, or by the job
+        var query = {
+            snapshot_id: options.snapshot_id,
+            fingerprint: options.fingerprint,
+        };
+        var tbody = table.tBodies[0];
+        var after = -1;
+        var loading = false;
+        var done = false;
+
+        function addLine(line) {
+            var row = tbody.insertRow();
+            cell(row, line.sequence + 1);
+            options.invoice_columns.forEach(function (key) {
+                cell(row, line[key]);
+            });
+            (line.payments || []).forEach(function (payment) {
+                var paymentRow = tbody.insertRow();
+                paymentRow.className = "payment";
+                cell(paymentRow, "");
+                options.payment_columns.forEach(function (key) {
+                    cell(paymentRow, payment[key]);
+                });
+            });
+        }
+
+        function showTotals() {
+            rpc("/l10n_ro_account_report_journal/totals", query).then(function (result) {
+                var row = table.tFoot.insertRow();
+                cell(row, "Totals");
+                options.invoice_columns.forEach(function (key) {
+                    cell(row, typeof result.totals[key] === "number" ? result.totals[key] : "");
+                });
+            });
+        }
+
+        function loadPage() {
+            if (loading || done) {
+                return;
+            }
+            loading = true;
+            rpc(
+                "/l10n_ro_account_report_journal/lines",
+                Object.assign({after: after, limit: PAGE_SIZE}, query)
+            )
+                .then(function (result) {
+                    document.getElementById("journal_count").textContent = result.count;
+                    result.lines.forEach(addLine);
+                    loading = false;
+                    if (result.next === null) {
+                        done = true;
+                        sentinel.textContent = "";
+                        showTotals();
+                    } else {
+                        after = result.next;
+                        // the page may not fill the screen
+                        if (sentinel.getBoundingClientRect().top < window.innerHeight) {
+                            loadPage();
+                        }
+                    }
+                })
+                .catch(function (error) {
+                    loading = false;
+                    sentinel.textContent = error.message;
+                });
+        }
+
+        function observe() {
+            new IntersectionObserver(function (entries) {
+                if (entries[0].isIntersecting) {
+                    loadPage();
+                }
+            }).observe(sentinel);
+        }
+
+        function waitSnapshot(status) {
+            if (status.snapshot_id) {
+                query = {snapshot_id: status.snapshot_id, fingerprint: status.fingerprint};
+                sentinel.textContent = "Loading...";
+                observe();
+                return;
+            }
+            sentinel.textContent = "Computing the journal... " + Math.round(status.progress) + "%";
+            setTimeout(function () {
+                rpc(
+                    "/l10n_ro_account_report_journal/status",
+                    Object.assign({job_id: status.job_id}, options.form)
+                )
+                    .then(waitSnapshot)
+                    .catch(function (error) {
+                        sentinel.textContent = error.message;
+                    });
+            }, STATUS_DELAY);
+        }
+
+        waitSnapshot(options);
+    }
+
+    document.addEventListener("DOMContentLoaded", start);
+})();
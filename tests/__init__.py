@@ -1 +1,2 @@
-from . import test_ro_sale_purchase_journal
\ No newline at end of file
+from . import test_ro_sale_purchase_journal
+from . import test_benchmark_journal
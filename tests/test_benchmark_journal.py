@@ -0,0 +1,325 @@
+# Copyright (C) 2020 OdooERP Romania
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+# -*- coding: utf-8 -*-
+"""Benchmark of the sale/purchase journal on synthetic data.
+
+Is not run with the standard tests, only with the tag:
+
+    odoo-bin -d db -i l10n_ro_account_report_journal \\
+        --test-tags journal_benchmark --stop-after-init
+
+Environment variables:
+
+* JOURNAL_BENCHMARK_VOLUMES: invoice counts to measure (default
+  1000,10000,100000); the invoices are added to the previous volume
+* JOURNAL_BENCHMARK_TOLERANCE: accepted increase against the baseline
+  (default 0.25 = 25%) for the time and memory, the query count must not
+  increase more than 10%
+* JOURNAL_BENCHMARK_UPDATE: if set, the measured values are written as the
+  new baselines in benchmark_baselines.json instead of being checked
+
+The queries added by the invoices of a bigger volume are always checked,
+they do not depend on the machine: the engines read the invoices in
+batches, there must be much less than a query by invoice. The time, memory
+and query count baselines are checked if they are recorded (on the machine
+running the benchmark).
+"""
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import fields
+from odoo.tests import tagged
+from odoo.tools.misc import split_every
+
+from odoo.addons.l10n_ro_account_report_journal.report.journal_engine import (
+    SqlJournalEngine,
+    select_cash_basis_invoice_dates,
+    select_invoices_in_period,
+    select_older_unpaid_cash_basis_ids,
+)
+
+from . import test_ro_sale_purchase_journal as journal_tests
+
+_logger = logging.getLogger(__name__)
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+PERIOD_START = fields.Date.to_date("2021-01-01")
+PERIOD_MONTHS = 12
+CREATE_BATCH = 500
+QUERY_TOLERANCE = 0.10
+MAX_QUERIES_PER_INVOICE = 0.1
+
+
+class ExplainCursor(object):
+    """cursor given to the engine queries, that keeps their JSON plans
+    instead of running them"""
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.plans = []
+
+    def execute(self, query, params=None):
+        self.cr.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        self.plans.append(json.dumps(self.cr.fetchone()[0]))
+
+    def fetchall(self):
+        return []
+
+
+@tagged("journal_benchmark", "-standard", "post_install", "-at_install")
+class TestRoSalePurchaseJournalBenchmark(journal_tests.InvoiceTestCommon):
+
+    # the Romanian chart of accounts company of the functional tests
+    setup_company_data = journal_tests.TestRoSalePurchaseJournal.__dict__[
+        "setup_company_data"
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestRoSalePurchaseJournalBenchmark, cls).setUpClass()
+        # the generated invoices are not committed, they are seen only by
+        # the test cursor
+        cls.env = cls.env(context=dict(cls.env.context, journal_report_cursor=True))
+        company = cls.company_data["company"]
+        cls.volumes = sorted(
+            int(volume)
+            for volume in os.environ.get(
+                "JOURNAL_BENCHMARK_VOLUMES", "1000,10000,100000"
+            ).split(",")
+        )
+        cls.tolerance = float(os.environ.get("JOURNAL_BENCHMARK_TOLERANCE", 0.25))
+        # all the taxes of the chart: 19/9/5/0, reverse charge, exempt and
+        # VAT on payment ones, so every tag column is filled
+        cls.taxes = {
+            journal_type: cls.env["account.tax"].search(
+                [
+                    ("company_id", "=", company.id),
+                    ("type_tax_use", "=", journal_type),
+                    ("amount_type", "=", "percent"),
+                ]
+            )
+            for journal_type in ("sale", "purchase")
+        }
+        cls.partners = cls.env["res.partner"].create(
+            [
+                {"name": "benchmark partner %d" % index, "vat": "RO%d" % (1000 + index)}
+                for index in range(50)
+            ]
+        )
+        cls.generated = 0
+
+    @classmethod
+    def _generate_invoices(cls, count):
+        """creates and posts count sale and purchase invoices and refunds
+        spread over the benchmark year. A part of the VAT on payment ones
+        are paid partially in the next month"""
+        move_types = ["out_invoice", "out_invoice", "out_refund", "in_invoice", "in_refund"]
+        to_create = []
+        for index in range(cls.generated, cls.generated + count):
+            move_type = move_types[index % len(move_types)]
+            taxes = cls.taxes["sale" if move_type.startswith("out") else "purchase"]
+            line_taxes = [taxes[index % len(taxes)], taxes[(index * 7 + 3) % len(taxes)]]
+            to_create.append(
+                {
+                    "move_type": move_type,
+                    "partner_id": cls.partners[index % len(cls.partners)].id,
+                    "invoice_date": PERIOD_START
+                    + relativedelta(months=index % PERIOD_MONTHS, day=1 + index % 28),
+                    "ref": "benchmark %d" % index,
+                    "invoice_line_ids": [
+                        (
+                            0,
+                            None,
+                            {
+                                "product_id": cls.product_a.id,
+                                "quantity": 1 + index % 5,
+                                "price_unit": 100 + index % 1000,
+                                "tax_ids": [(6, 0, tax.ids)],
+                            },
+                        )
+                        for tax in line_taxes
+                    ],
+                }
+            )
+        for batch in split_every(CREATE_BATCH, to_create):
+            moves = cls.env["account.move"].create(list(batch))
+            moves.action_post()
+            cls._pay_partially(
+                moves.filtered(
+                    lambda m: m.id % 3 == 0
+                    and any(
+                        t.tax_exigibility == "on_payment"
+                        for t in m.invoice_line_ids.tax_ids
+                    )
+                )
+            )
+            moves.invalidate_cache()
+        cls.generated += count
+
+    @classmethod
+    def _pay_partially(cls, moves):
+        for move in moves:
+            cls.env["account.payment.register"].with_context(
+                active_model="account.move", active_ids=move.ids
+            ).create(
+                {
+                    "amount": round(move.amount_residual / 2, 2),
+                    "payment_date": move.invoice_date + relativedelta(months=1),
+                }
+            )._create_payments()
+
+    def _reset_caches(self):
+        self.env["account.move"].flush()
+        self.env["base"].invalidate_cache()
+
+    def _measure(self, function):
+        """returns the result, (seconds, queries, peak memory in KiB). The
+        function is run twice from empty caches: timed, then traced by
+        tracemalloc, that slows down every allocation"""
+        self._reset_caches()
+        queries = self.cr.sql_log_count
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+        queries = self.cr.sql_log_count - queries
+        self._reset_caches()
+        tracemalloc.start()
+        try:
+            function()
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return result, {
+            "time": round(duration, 3),
+            "queries": queries,
+            "memory": peak // 1024,
+        }
+
+    def _measure_journal(self, journal_type):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        company = self.company_data["company"]
+        data = {
+            "ids": [],
+            "model": "l10n_ro_account_report_journal",
+            "form": {
+                "company_id": (company.id, company.name),
+                "date_from": fields.Date.to_string(PERIOD_START),
+                "date_to": fields.Date.to_string(
+                    PERIOD_START + relativedelta(months=PERIOD_MONTHS, days=-1)
+                ),
+                "journal_type": journal_type,
+                "show_warnings": True,
+                "engine": "sql",
+                "use_snapshot": False,
+            },
+        }
+        measures = {}
+        invoices, measures["select"] = self._measure(
+            lambda: report_obj._get_forreport_invoices_payments(data, journal_type)
+        )
+        _lines, measures["compute_sql"] = self._measure(
+            lambda: report_obj.compute_report_lines_sql(
+                invoices, data, True, journal_type == "sale"
+            )
+        )
+        _lines, measures["compute_orm"] = self._measure(
+            lambda: report_obj.compute_report_lines(
+                invoices, data, True, journal_type == "sale"
+            )
+        )
+        report = self.env.ref("l10n_ro_account_report_journal.action_report_sale_html")
+        _html, measures["render"] = self._measure(
+            lambda: report._render_qweb_html([], data=data)
+        )
+        return measures
+
+    def _check_regressions(self, results, baselines):
+        regressions = []
+        for key, measures in results.items():
+            for phase, values in measures.items():
+                baseline = baselines.get(key, {}).get(phase, {})
+                for name, value in values.items():
+                    if name not in baseline:
+                        _logger.warning(
+                            "Journal benchmark: no baseline for %s %s %s", key, phase, name
+                        )
+                        continue
+                    tolerance = QUERY_TOLERANCE if name == "queries" else self.tolerance
+                    if value > baseline[name] * (1 + tolerance):
+                        regressions.append(
+                            "%s %s %s: %s > baseline %s"
+                            % (key, phase, name, value, baseline[name])
+                        )
+        return regressions
+
+    def _check_query_growth(self, results):
+        """the queries added from a volume to the next one, by added invoice"""
+        regressions = []
+        for journal_type in ("sale", "purchase"):
+            for smaller, bigger in zip(self.volumes, self.volumes[1:]):
+                small = results["%s_%s" % (journal_type, smaller)]
+                big = results["%s_%s" % (journal_type, bigger)]
+                for phase, values in big.items():
+                    added = values["queries"] - small[phase]["queries"]
+                    if added > MAX_QUERIES_PER_INVOICE * (bigger - smaller):
+                        regressions.append(
+                            "%s %s queries: %s more for %s more invoices"
+                            % (journal_type, phase, added, bigger - smaller)
+                        )
+        return regressions
+
+    def test_selection_query_plans(self):
+        """the selection queries can use the module indexes, at least one of
+        the expected ones for each query (the sequential scans are disabled,
+        with few rows they would be cheaper)"""
+        company = self.company_data["company"]
+        self.env["account.move"].flush()
+        self.cr.execute("SET LOCAL enable_seqscan = off")
+        cr = ExplainCursor(self.cr)
+        date_to = PERIOD_START + relativedelta(months=1, days=-1)
+        select_invoices_in_period(cr, company.id, "sale", PERIOD_START, date_to)
+        select_older_unpaid_cash_basis_ids(cr, company.id, "sale", PERIOD_START)
+        select_cash_basis_invoice_dates(
+            cr, company.id, "sale", company.tax_cash_basis_journal_id.id or 1,
+            PERIOD_START, date_to,
+        )
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        SqlJournalEngine(
+            cr, None, None, partner_account_ids=report_obj._get_partner_account_ids(company.id)
+        ).fetch_payments([1], company.id, date_to)
+        expected = [
+            ["l10n_ro_journal_move_invoice_date_idx"],
+            ["l10n_ro_journal_move_unpaid_idx", "l10n_ro_journal_line_not_exigible_idx"],
+            ["l10n_ro_journal_move_cash_basis_idx"],
+            ["l10n_ro_journal_partial_debit_idx", "l10n_ro_journal_partial_credit_idx",
+             "l10n_ro_journal_move_cash_basis_rec_idx"],
+        ]
+        for plan, index_names in zip(cr.plans, expected):
+            self.assertTrue(
+                any(index_name in plan for index_name in index_names),
+                "None of %s used in plan %s" % (index_names, plan),
+            )
+
+    def test_benchmark_journal(self):
+        results = {}
+        for volume in self.volumes:
+            self._generate_invoices(volume - self.generated)
+            for journal_type in ("sale", "purchase"):
+                key = "%s_%s" % (journal_type, volume)
+                results[key] = self._measure_journal(journal_type)
+                _logger.info("Journal benchmark %s: %s", key, results[key])
+
+        regressions = self._check_query_growth(results)
+        if os.environ.get("JOURNAL_BENCHMARK_UPDATE"):
+            with open(BASELINES_PATH, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        else:
+            with open(BASELINES_PATH) as f:
+                baselines = json.load(f)
+            regressions += self._check_regressions(results, baselines)
+        self.assertFalse(regressions, "\n".join(regressions))
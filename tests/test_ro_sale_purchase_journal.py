@@ -4,13 +4,18 @@
 from odoo.addons.account.tests.invoice_test_common import InvoiceTestCommon
 from odoo.tests.common import Form
 from odoo.tests import tagged
-from odoo import fields
+from odoo import fields, sql_db
 from datetime import datetime, timedelta
 from odoo.tests.common import TransactionCase
 
 
+import json
 from unittest.mock import patch
 
+from odoo.addons.l10n_ro_account_report_journal.hooks import pre_init_hook
+from odoo.addons.l10n_ro_account_report_journal.report.journal_engine import (
+    JOURNAL_INDEXES, compute_shard_rows, create_journal_indexes)
+
 @tagged('post_install', '-at_install')
 class TestRoSalePurchaseWizard(TransactionCase):
 
@@ -103,6 +108,9 @@ class TestRoSalePurchaseJournal(InvoiceTestCommon):
     @classmethod
     def setUpClass(cls):
         super(TestRoSalePurchaseJournal, cls).setUpClass()
+        # the journals are computed on the test cursor: a dedicated report
+        # cursor would not see the not committed test data
+        cls.env = cls.env(context=dict(cls.env.context, journal_report_cursor=True))
 
         # partner_a,& _b created in odoo.addons.account.tests.invoice_test_common
         cls.partner_c = cls.env['res.partner'].create({
@@ -263,3 +271,542 @@ class TestRoSalePurchaseJournal(InvoiceTestCommon):
             {'no_tag_like_vat0': -12,},
         ],'purchase')
 
+
+
+    def _get_report_data(self, journal_type='sale', **form):
+        """posts the draft test invoices and returns the report data of the
+        test period, with the form options given"""
+        self.env["account.move"].search([('company_id', '=', self.env.user.company_id.id),('state','=','draft')]).post()
+        form = dict({'company_id':(self.env.user.company_id.id,'name'),
+                     'date_from':'2016-01-01','date_to':'2021-01-01',
+                     'journal_type':journal_type,'show_warnings':True}, **form)
+        return {'ids': [], 'model': 'l10n_ro_account_report_journal', 'form': form}
+
+    def _get_engine_report_values(self, journal_type, engine):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        return report_obj._get_report_values([], self._get_report_data(journal_type, engine=engine))
+
+    def _rounded(self, value):
+        """the report lines or totals as dictionaries with the floats rounded:
+        the SQL engine sums NUMERIC values by tag, the ORM engine floats line
+        by line, the last bits can differ"""
+        if isinstance(value, float):
+            return round(value, 2)
+        if isinstance(value, (list, tuple)):
+            return [self._rounded(x) for x in value]
+        if hasattr(value, 'items'):
+            return {key: self._rounded(x) for key, x in value.items()}
+        return value
+
+    def _create_cash_basis_invoice(self, invoice_date, payments):
+        """posts a sale invoice with a VAT on payment tax, paid with the
+        (payment date, amount) payments"""
+        company = self.company_data['company']
+        company.tax_exigibility = True
+        tax = self.env['account.tax'].search([
+            ('company_id', '=', company.id), ('type_tax_use', '=', 'sale'),
+            ('amount_type', '=', 'percent'), ('tax_exigibility', '=', 'on_payment')], limit=1)
+        self.assertTrue(tax, "The chart has no VAT on payment sale tax")
+        invoice = self.env['account.move'].create({
+            'move_type': 'out_invoice',
+            'partner_id': self.partner_a.id,
+            'invoice_date': fields.Date.from_string(invoice_date),
+            'invoice_line_ids': [(0, None, {
+                'product_id': self.product_a.id,
+                'quantity': 1,
+                'price_unit': 1000,
+                'tax_ids': [(6, 0, tax.ids)],
+            })],
+        })
+        invoice.action_post()
+        for payment_date, amount in payments:
+            self.env['account.payment.register'].with_context(
+                active_model='account.move', active_ids=invoice.ids
+            ).create({
+                'amount': amount,
+                'payment_date': fields.Date.from_string(payment_date),
+            })._create_payments()
+        return invoice
+
+    def test_cash_basis_payments_same_as_orm(self):
+        # paid partly before the period (subtracted from the not exigible
+        # VAT) and partly in the period (a payment row)
+        invoice = self._create_cash_basis_invoice(
+            '2016-01-10', [('2016-01-20', 300), ('2016-03-10', 400)])
+        results = {}
+        for engine in ('orm', 'sql'):
+            results[engine] = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]._get_report_values(
+                [], self._get_report_data('sale', engine=engine, date_from='2016-02-01'))
+        [line] = [line for line in results['sql']['lines'] if line['number'] == invoice.name]
+        self.assertEqual(len(line['payments']), 1)
+        self.assertEqual(line['payments'][0]['date'], fields.Date.from_string('2016-03-10'))
+        self.assertTrue(line['base_neex'] and line['tva_neex'])
+        self.assertEqual(self._rounded(results['orm']['lines']), self._rounded(results['sql']['lines']))
+        self.assertEqual(self._rounded(results['orm']['totals']), self._rounded(results['sql']['totals']))
+
+    def test_sql_engine_same_as_orm(self):
+        for journal_type in ['sale','purchase']:
+            orm_result = self._get_engine_report_values(journal_type, 'orm')
+            sql_result = self._get_engine_report_values(journal_type, 'sql')
+            self.assertTrue(sql_result['lines'])
+            self.assertEqual(self._rounded(orm_result['lines']), self._rounded(sql_result['lines']))
+            self.assertEqual(self._rounded(orm_result['totals']), self._rounded(sql_result['totals']))
+
+    def test_parallel_engine_small_journal(self):
+        # the test invoices are not committed, so they are not seen by the
+        # worker processes; a journal smaller than a shard is computed here
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_ro_account_report_journal.compute_workers', 4)
+        sql_result = self._get_engine_report_values('sale', 'sql')
+        parallel_result = self._get_engine_report_values('sale', 'parallel')
+        self.assertEqual(parallel_result['lines'], sql_result['lines'])
+        self.assertEqual(parallel_result['totals'], sql_result['totals'])
+
+    def test_parallel_engine_shards(self):
+        # the shards are computed here with the test cursor, one invoice in
+        # each shard, and merged in the order of the invoices
+        report_class = type(self.env["report.l10n_ro_account_report_journal.report_sale_purchase"])
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_ro_account_report_journal.compute_workers', 2)
+        sql_result = self._get_engine_report_values('sale', 'sql')
+        self.assertTrue(len(sql_result['lines']) > 1)
+        shards_count, connections = [], []
+
+        def _map_shards(report, shards, workers):
+            shards_count.append(len(shards))
+            connections.extend(shard[0] for shard in shards)
+            return (compute_shard_rows(report.env.cr, shard) for shard in shards)
+
+        with patch('odoo.addons.l10n_ro_account_report_journal.report.report_sale_purchase.IN_CHUNK_SIZE', 1), \
+                patch.object(report_class, '_can_fork', lambda report: True), \
+                patch.object(report_class, '_map_shards', _map_shards):
+            parallel_result = self._get_engine_report_values('sale', 'parallel')
+        self.assertEqual(shards_count, [len(sql_result['lines'])])
+        self.assertEqual(parallel_result['lines'], sql_result['lines'])
+        self.assertEqual(parallel_result['totals'], sql_result['totals'])
+        self.assertEqual(connections[0], sql_db.connection_info_for(self.env.cr.dbname)[1])
+        # the shards read the database of the report cursor
+        replica = {'dsn': 'postgresql://replica/%s' % self.env.cr.dbname}
+        connections.clear()
+        with patch('odoo.addons.l10n_ro_account_report_journal.report.report_sale_purchase.IN_CHUNK_SIZE', 1), \
+                patch.object(report_class, '_can_fork', lambda report: True), \
+                patch.object(report_class, '_map_shards', _map_shards):
+            self.env["report.l10n_ro_account_report_journal.report_sale_purchase"].with_context(
+                journal_report_connection_info=replica
+            )._get_report_values([], self._get_report_data('sale', engine='parallel'))
+        self.assertEqual(connections, [replica] * len(connections))
+
+    def test_report_env_in_tests(self):
+        # the dedicated cursor would not see the not committed test data
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        with report_obj._report_env() as env:
+            self.assertIs(env.cr, self.env.cr)
+            self.assertTrue(env.context.get('journal_report_cursor'))
+            with report_obj.with_env(env)._report_env() as inner_env:
+                self.assertIs(inner_env.cr, env.cr)
+
+    def test_report_env_dedicated_cursor(self):
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_ro_account_report_journal.report_statement_timeout', 60)
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"].with_context(
+            journal_report_cursor=False)
+        with report_obj._report_env() as env:
+            self.assertIsNot(env.cr, self.env.cr)
+            self.assertEqual(env.context['journal_report_connection_info'],
+                             sql_db.connection_info_for(self.env.cr.dbname)[1])
+            env.cr.execute("SHOW transaction_read_only")
+            self.assertEqual(env.cr.fetchone()[0], 'on')
+            env.cr.execute("SHOW statement_timeout")
+            self.assertEqual(env.cr.fetchone()[0], '1min')
+            # only the committed data is seen
+            env.cr.execute("SELECT COUNT(*) FROM account_move WHERE id IN %s", (tuple(self.invoices.ids),))
+            self.assertEqual(env.cr.fetchone()[0], 0)
+
+    def test_partner_account_ids(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        company = self.company_data['company']
+        receivable = self.company_data['default_account_receivable']
+        payable = self.company_data['default_account_payable']
+        account_ids = report_obj._get_partner_account_ids(company.id)
+        self.assertIn(receivable.id, account_ids)
+        self.assertIn(payable.id, account_ids)
+        self.env['ir.config_parameter'].sudo().set_param(
+            'l10n_ro_account_report_journal.partner_account_prefixes', ' 411 ')
+        account_ids = report_obj._get_partner_account_ids(company.id)
+        self.assertIn(receivable.id, account_ids)
+        self.assertNotIn(payable.id, account_ids)
+
+    def test_partner_vat_frozen_at_post(self):
+        invoice = self.invoices[0]
+        invoice.partner_id.vat = 'RO1234567897'
+        self.assertFalse(invoice.invoice_partner_display_vat)
+        invoice.action_post()
+        self.assertEqual(invoice.invoice_partner_display_vat, 'RO1234567897')
+        invoice.partner_id.vat = 'RO18547290'
+        self.assertEqual(invoice.invoice_partner_display_vat, 'RO1234567897')
+
+    def test_partner_vat_without_partner(self):
+        # stored as an empty VAT, like the invoices of partners without VAT
+        move = self.env['account.move'].create({
+            'move_type': 'entry',
+            'line_ids': [
+                (0, None, {'account_id': self.company_data['default_account_revenue'].id, 'credit': 100}),
+                (0, None, {'account_id': self.company_data['default_account_receivable'].id, 'debit': 100}),
+            ],
+        })
+        move.action_post()
+        move.invalidate_cache()
+        self.assertEqual(move.invoice_partner_display_vat, '')
+        self.env.cr.execute(
+            "UPDATE account_move SET invoice_partner_display_vat = NULL WHERE id = %s", (move.id,))
+        pre_init_hook(self.env.cr)
+        move.invalidate_cache()
+        self.assertEqual(move.invoice_partner_display_vat, '')
+
+    def test_journal_indexes(self):
+        cr = self.env.cr
+
+        def index_oids():
+            cr.execute("SELECT indexname::regclass::oid FROM pg_indexes WHERE indexname LIKE 'l10n_ro_journal_%'")
+            return {row[0] for row in cr.fetchall()}
+
+        oids = index_oids()
+        self.assertEqual(len(oids), sum(len(indexes) for indexes in JOURNAL_INDEXES.values()))
+        # the indexes with the module definitions are kept
+        for table in JOURNAL_INDEXES:
+            create_journal_indexes(cr, table)
+        self.assertEqual(index_oids(), oids)
+        # another definition is built again
+        cr.execute('DROP INDEX l10n_ro_journal_partial_debit_idx')
+        cr.execute('CREATE INDEX l10n_ro_journal_partial_debit_idx ON account_partial_reconcile (debit_move_id)')
+        create_journal_indexes(cr, 'account_partial_reconcile')
+        cr.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'l10n_ro_journal_partial_debit_idx'")
+        self.assertIn('max_date', cr.fetchone()[0])
+
+    def test_profile(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        data = self._get_report_data(show_profile=True)
+        profile = report_obj._get_report_values([], data)['profile']
+        self.assertEqual([x['name'] for x in profile],
+                         ['selection', 'classification', 'reconciliations', 'totals', 'total'])
+        data['form']['show_profile'] = False
+        self.assertFalse(report_obj._get_report_values([], data)['profile'])
+
+    def test_snapshot(self):
+        snapshot_obj = self.env["l10n.ro.account.report.journal.snapshot"]
+        data = self._get_report_data(use_snapshot=True)
+        lines, totals = snapshot_obj._get_journal_lines(data)
+        snapshot = snapshot_obj._get_snapshot(data['form'])
+        self.assertEqual(snapshot.line_count, len(lines))
+        with patch.object(type(self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]), '_compute_journal') as compute:
+            self.assertEqual(snapshot_obj._get_journal_lines(data), (lines, totals))
+            compute.assert_not_called()
+        fingerprint = snapshot.fingerprint
+        self.invoices[0].button_draft()
+        self.assertNotEqual(
+            snapshot_obj._get_fingerprint(self.env.user.company_id, 'sale', '2016-01-01', '2021-01-01'),
+            fingerprint)
+
+    def test_snapshot_incremental(self):
+        snapshot_obj = self.env["l10n.ro.account.report.journal.snapshot"]
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        data = self._get_report_data(use_snapshot=True)
+        lines, totals = snapshot_obj._get_journal_lines(data)
+        invoice = self.invoices[0]
+        invoice.write({'ref': 'changed'})
+        snapshot = snapshot_obj._get_snapshot(data['form'])
+        self.assertEqual(snapshot.line_ids.filtered('dirty').invoice_id, invoice)
+        computed = []
+        compute_invoices_lines = type(report_obj)._compute_invoices_lines
+        def _compute_invoices_lines(self, invoices, data):
+            computed.append(invoices)
+            return compute_invoices_lines(self, invoices, data)
+        # the fingerprint is changed by the count of posted moves
+        self.invoices[1].button_draft()
+        with patch.object(type(report_obj), '_compute_invoices_lines', _compute_invoices_lines):
+            new_lines, new_totals = snapshot_obj._get_journal_lines(data)
+        self.assertEqual(computed, [invoice])
+        self.assertEqual(len(new_lines), len(lines) - 1)
+        self.assertFalse(snapshot.line_ids.filtered('dirty'))
+
+    def test_multi_period_same_as_single(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        # the sale invoices are of 2016-01-01 to 2016-01-04, both periods have lines
+        periods = [('2016-01-01', '2016-01-02'), ('2016-01-03', '2021-01-01')]
+        form = self._get_report_data(engine='sql')['form']
+        results = report_obj._compute_journal_periods({'form': form}, periods)
+        self.assertEqual(len(results), 2)
+        for (date_from, date_to), result in zip(periods, results):
+            data = {'form': dict(form, date_from=date_from, date_to=date_to)}
+            invoices, lines, totals = report_obj._compute_journal(data)
+            self.assertTrue(lines)
+            self.assertEqual(result[2], invoices.ids)
+            self.assertEqual(result[3], lines)
+            self.assertEqual(result[4], totals)
+            self.assertEqual(result[5], self.env["l10n.ro.account.report.journal.snapshot"]._get_fingerprint(
+                self.env.user.company_id, 'sale', date_from, date_to))
+
+    def test_multi_period_cash_basis_carry_over(self):
+        # the not exigible VAT of the invoice is carried from a month to the
+        # next one, its payments are split by month
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        invoice = self._create_cash_basis_invoice(
+            '2016-01-10', [('2016-01-20', 300), ('2016-03-10', 400)])
+        periods = [('2016-01-01', '2016-01-31'), ('2016-02-01', '2016-02-29'),
+                   ('2016-03-01', '2016-03-31')]
+        form = self._get_report_data(engine='sql')['form']
+        progress = []
+        results = report_obj.with_context(
+            journal_report_progress=lambda done, total: progress.append((done, total))
+        )._compute_journal_periods({'form': form}, periods)
+        self.assertTrue(progress)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        for (date_from, date_to), result in zip(periods, results):
+            data = {'form': dict(form, date_from=date_from, date_to=date_to)}
+            invoices, lines, totals = report_obj._compute_journal(data)
+            self.assertIn(invoice.id, result[2])
+            self.assertEqual(result[2], invoices.ids)
+            self.assertEqual(self._rounded(result[3]), self._rounded(lines))
+            self.assertEqual(self._rounded(result[4]), self._rounded(totals))
+        [february] = [line for line in results[1][3] if line['number'] == invoice.name]
+        self.assertFalse(february['payments'])
+        self.assertTrue(february['base_neex'] and february['tva_neex'])
+        [march] = [line for line in results[2][3] if line['number'] == invoice.name]
+        self.assertEqual([payment['date'] for payment in march['payments']],
+                         [fields.Date.from_string('2016-03-10')])
+
+    def test_render_cache(self):
+        cache_obj = self.env["l10n.ro.account.report.journal.render.cache"]
+        data = self._get_report_data()
+        report = self.env.ref("l10n_ro_account_report_journal.action_report_sale_html")
+        html, _content_type = report._render_qweb_html([], data=data)
+        entry = cache_obj.search(cache_obj._get_key_domain(data['form'], 'html'))
+        self.assertEqual(entry.hits, 0)
+        self.assertEqual(report._render_qweb_html([], data=data)[0], entry.attachment_id.raw)
+        self.assertEqual(entry.hits, 1)
+        self.assertIsNone(cache_obj.with_context(lang='fr_FR')._get_content(data['form'], 'html'))
+        self.invoices[0].button_draft()
+        self.assertIsNone(cache_obj._get_content(data['form'], 'html'))
+        self.assertFalse(entry.exists())
+
+    def test_snapshot_pages(self):
+        snapshot_obj = self.env["l10n.ro.account.report.journal.snapshot"]
+        data = self._get_report_data()
+        lines, _totals = snapshot_obj._get_journal_lines(data)
+        snapshot = snapshot_obj._get_valid_snapshot(data)
+        numbers, after = [], -1
+        while True:
+            page = snapshot._read_page(after, 2)
+            numbers += [json.loads(line)['number'] for _sequence, line in page]
+            if len(page) < 2:
+                break
+            after = page[-1][0]
+        self.assertEqual(numbers, [line['number'] for line in lines])
+
+    def test_snapshot_job(self):
+        snapshot_obj = self.env["l10n.ro.account.report.journal.snapshot"]
+        job_obj = self.env["l10n.ro.account.report.journal.job"]
+        data = self._get_report_data(use_snapshot=True)
+        self.assertFalse(snapshot_obj._get_current_snapshot(data))
+        job = job_obj._get_snapshot_job(data['form'])
+        self.assertEqual(job_obj._get_snapshot_job(data['form']), job)
+        job._run()
+        with self.registry.cursor() as cr:
+            cr.execute(
+                "DELETE FROM l10n_ro_account_report_journal_job_progress WHERE job_id = %s",
+                (job.id,))
+        self.assertEqual(job.state, 'done')
+        self.assertFalse(job.attachment_id)
+        snapshot = snapshot_obj._get_current_snapshot(data)
+        self.assertTrue(snapshot)
+        self.assertEqual(snapshot.line_count, job.line_count)
+
+    def test_validate_only(self):
+        result = self._get_engine_report_values('sale', 'sql')
+        wizard = self.env["l10n.ro.account.report.journal"].create({
+            'journal_type': 'sale',
+            'date_from': '2016-01-01',
+            'date_to': '2021-01-01',
+        })
+        wizard.action_validate()
+        report_warnings = [line['number'] for line in result['lines'] if line['warnings']]
+        self.assertEqual(
+            sorted(set(wizard.issue_ids.filtered(lambda i: 'partner account line' not in i.reason).mapped('invoice_id.name'))),
+            sorted(set(report_warnings)))
+
+    def test_snapshot_from_stream(self):
+        snapshot_obj = self.env["l10n.ro.account.report.journal.snapshot"]
+        result = self._get_engine_report_values('sale', 'sql')
+        data = self._get_report_data()
+        with patch.object(type(self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]), '_compute_journal') as compute:
+            snapshot = snapshot_obj._get_valid_snapshot(data)
+        compute.assert_not_called()
+        self.assertEqual(snapshot.line_count, len(result['lines']))
+        self.assertEqual(snapshot._load_lines(), (result['lines'], result['totals']))
+
+    def test_stream_same_as_sql(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        result = self._get_engine_report_values('sale', 'sql')
+        totals = report_obj._new_totals()
+        lines = list(report_obj._stream_report_lines_sql(self._get_report_data(), totals))
+        self.assertTrue(lines)
+        self.assertEqual(lines, result['lines'])
+        self.assertEqual(totals.as_dict(), result['totals'])
+
+    def test_render_pdf_chunked(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        result = self._get_engine_report_values('sale', 'sql')
+        self.assertTrue(len(result['lines']) > 1)
+        data = self._get_report_data()
+        report = self.env.ref("l10n_ro_account_report_journal.action_report_sale")
+        IrActionsReport = type(report)
+        render_template = IrActionsReport._render_template
+        chunks_values = []
+
+        def _render_template(self, template, values=None):
+            chunks_values.append(values)
+            return render_template(self, template, values)
+
+        def render_chunks_parallel(chunks, workers):
+            return b"%d chunks" % len(list(chunks))
+
+        self.env['ir.config_parameter'].sudo().set_param(
+            "l10n_ro_account_report_journal.pdf_chunk_size", len(result['lines']))
+        self.assertIsNone(report_obj._render_pdf_chunked(report, data))
+        self.env['ir.config_parameter'].sudo().set_param(
+            "l10n_ro_account_report_journal.pdf_chunk_size", 1)
+        with patch.object(IrActionsReport, '_render_template', _render_template), \
+                patch('odoo.addons.l10n_ro_account_report_journal.report.report_sale_purchase.render_chunks_parallel',
+                      render_chunks_parallel):
+            pdf = report_obj._render_pdf_chunked(report, data)
+        self.assertEqual(pdf, b"%d chunks" % len(result['lines']))
+        self.assertEqual(
+            [values['line_offset'] for values in chunks_values], list(range(len(result['lines']))))
+        self.assertEqual(
+            [line for values in chunks_values for line in values['lines']], result['lines'])
+        self.assertFalse(any(values['totals'] for values in chunks_values[:-1]))
+        self.assertEqual(chunks_values[-1]['totals'], result['totals'])
+
+    def test_background_job(self):
+        self._get_report_data()
+        wizard = self.env["l10n.ro.account.report.journal"].create({
+            'journal_type': 'sale',
+            'date_from': '2016-01-01',
+            'date_to': '2021-01-01',
+        })
+        wizard.print_report_background()
+        job = wizard.job_id
+        self.assertEqual(job.state, 'pending')
+        job.report_format = 'html'
+        job._run()
+        self.assertEqual(job.state, 'done')
+        self.assertTrue(job.attachment_id)
+        self.assertEqual(wizard.job_progress, 100.0)
+        # the progress is committed by its own cursor, out of the test
+        # transaction
+        with self.registry.cursor() as cr:
+            cr.execute(
+                "SELECT done, total, heartbeat FROM l10n_ro_account_report_journal_job_progress"
+                " WHERE job_id = %s", (job.id,))
+            done, total, heartbeat = cr.fetchone()
+            cr.execute(
+                "DELETE FROM l10n_ro_account_report_journal_job_progress WHERE job_id = %s",
+                (job.id,))
+        self.assertTrue(total)
+        self.assertEqual(done, total)
+        self.assertTrue(heartbeat)
+
+    def test_recover_stale_jobs(self):
+        job_obj = self.env["l10n.ro.account.report.journal.job"]
+        form = self._get_report_data()['form']
+        stale_job = job_obj._create_from_form(form)
+        running_job = job_obj._create_from_form(form)
+        (stale_job | running_job).write({
+            'state': 'running',
+            'date_started': fields.Datetime.now() - timedelta(hours=2),
+        })
+        self.env["l10n.ro.account.report.journal.job.progress"].create({
+            'job_id': running_job.id,
+            'done': 1,
+            'total': 4,
+            'heartbeat': fields.Datetime.now(),
+        })
+        job_obj._recover_stale_jobs()
+        self.assertEqual(stale_job.state, 'failed')
+        self.assertTrue(stale_job.error)
+        self.assertEqual(running_job.state, 'running')
+        stale_job.action_retry()
+        self.assertEqual(stale_job.state, 'pending')
+
+    def test_periods_job(self):
+        self._get_report_data()
+        wizard = self.env["l10n.ro.account.report.journal"].create({
+            'journal_type': 'sale',
+            'date_from': '2016-01-01',
+            'date_to': '2016-03-31',
+        })
+        job_obj = self.env["l10n.ro.account.report.journal.job"]
+        action = wizard.print_report_periods()
+        job = job_obj.search(action['domain'])
+        self.assertEqual(job.state, 'pending')
+        job._run()
+        self.assertEqual(job.state, 'done')
+        period_jobs = job_obj.search(action['domain']) - job
+        self.assertEqual(len(period_jobs), 3)
+        self.assertEqual(period_jobs.mapped('parent_id'), job)
+        period_job = period_jobs.filtered(lambda j: json.loads(j.form_data)['date_from'] == '2016-01-01')
+        self.assertTrue(self.env["l10n.ro.account.report.journal.snapshot"]._get_valid_snapshot(
+            {'form': json.loads(period_job.form_data)}).line_count)
+        period_job.report_format = 'html'
+        with patch.object(type(self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]), '_compute_journal') as compute:
+            period_job._run()
+        compute.assert_not_called()
+        self.assertEqual(period_job.state, 'done')
+
+    def test_batch_jobs(self):
+        self._get_report_data()
+        batch = self.env["l10n.ro.account.report.journal.batch"].create({
+            'company_ids': [(6, 0, self.env.user.company_id.ids)],
+            'journal_type': 'both',
+            'date_from': '2016-01-01',
+            'date_to': '2021-01-01',
+        })
+        batch.action_run()
+        self.assertEqual(batch.state, 'running')
+        jobs = batch.line_ids.mapped('job_id')
+        self.assertEqual(sorted(jobs.mapped('state')), ['pending', 'pending'])
+        for job in jobs:
+            job.report_format = 'html'
+            job._run()
+        batch._check_jobs_finished()
+        self.assertEqual(batch.state, 'done')
+        self.assertTrue(batch.summary_attachment_id)
+        sale_line = batch.line_ids.filtered(lambda line: line.journal_type == 'sale')
+        self.assertEqual(sale_line.line_count, len(self._get_engine_report_values('sale', 'sql')['lines']))
+        self.assertEqual(sale_line.attachment_id, sale_line.job_id.attachment_id)
+
+    def test_export_csv(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        attachment = report_obj._export_journal(self._get_report_data(), 'csv')
+        rows = attachment.raw.decode('utf-8').splitlines()
+        # header, 4 invoices and totals
+        self.assertEqual(len(rows), 6)
+        self.assertTrue(rows[-1].startswith('totals'))
+
+    def test_partner_summary(self):
+        report_obj = self.env["report.l10n_ro_account_report_journal.report_sale_purchase"]
+        for journal_type in ['sale', 'purchase']:
+            result = self._get_engine_report_values(journal_type, 'sql')
+            data = self._get_report_data(journal_type)
+            lines, totals = report_obj._compute_partner_summary(data)
+            self.assertEqual(sum(count for _vals, count in lines), len(result['lines']))
+            self.assertEqual(
+                len(lines), len({(line['partner'], line['vat']) for line in result['lines']}))
+            self.assertEqual(set(totals), set(result['totals']) - {'rowspan'})
+            for key, value in result['totals'].items():
+                if key not in ('payments', 'rowspan'):
+                    self.assertAlmostEqual(totals[key], value, places=2, msg=key)
+        attachment = report_obj._export_partner_summary(data, 'csv')
+        rows = attachment.raw.decode('utf-8').splitlines()
+        self.assertEqual(len(rows), len(lines) + 2)
+        self.assertTrue(rows[-1].startswith('totals'))
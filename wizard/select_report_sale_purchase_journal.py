@@ -3,6 +3,8 @@
 
 from dateutil.relativedelta import relativedelta
 from datetime import datetime,timedelta
+from werkzeug.urls import url_encode
+
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
 
@@ -50,6 +52,55 @@ class SalePurchaseJournalReport(models.TransientModel):
         help="if you check this, you will have another column that is going "
         "to show you errors/warnings if exist",
     )
+    show_profile = fields.Boolean(
+        "Show timings",
+        help="Adds at the end of the HTML report the time and the number of "
+        "queries of every computation phase.",
+    )
+    engine = fields.Selection(
+        selection=[
+            ("sql", "SQL (grouped queries)"),
+            ("parallel", "SQL in parallel processes"),
+            ("orm", "ORM (line by line)"),
+        ],
+        string="Computation engine",
+        default="sql",
+        required=True,
+        help="SQL is computing the columns with a few grouped queries and is "
+        "much faster for big periods. SQL in parallel processes is splitting "
+        "the invoices of a big journal between several processes. ORM is the "
+        "old line by line computation.",
+    )
+    use_snapshot = fields.Boolean(
+        "Use stored journal",
+        default=True,
+        help="The computed journal is stored and is printed again from there "
+        "while the invoices and reconciliations of the period are not changed.",
+    )
+    recompute_snapshot = fields.Boolean(
+        "Recompute",
+        help="Compute the journal again even if there is a valid stored one.",
+    )
+    export_format = fields.Selection(
+        selection=[("csv", "CSV"), ("xlsx", "XLSX")],
+        default="xlsx",
+        help="Format of the tabular export, where every payment of a VAT on "
+        "payment invoice is a separate row, and of the partner summary.",
+    )
+    period_type_id = fields.Many2one(
+        "date.range.type",
+        string="Split by",
+        help="The journal of every date range of this type between the start "
+        "and end date is generated. Without it the journal is made by months.",
+    )
+    issue_ids = fields.One2many(
+        "l10n.ro.account.report.journal.issue", "wizard_id", readonly=True
+    )
+    job_id = fields.Many2one("l10n.ro.account.report.journal.job", readonly=True)
+    job_state = fields.Selection(related="job_id.state")
+    job_progress = fields.Float(related="job_id.progress")
+    job_progress_done = fields.Integer(related="job_id.progress_done")
+    job_progress_total = fields.Integer(related="job_id.progress_total")
 
     @api.onchange("date_range_id")
     def onchange_date_range_id(self):
@@ -83,6 +134,152 @@ class SalePurchaseJournalReport(models.TransientModel):
         res = self.print_report(html=True)
         return res
 
+    def action_validate(self):
+        """only checks the invoices of the period and shows the ones with
+        problems, to be corrected before generating the journal"""
+        self.ensure_one()
+        [data] = self.read()
+        datas = {"ids": [], "model": "l10n_ro_account_report_journal", "form": data}
+        issues = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]._validate_journal(datas)
+        self.issue_ids.unlink()
+        self.env["l10n.ro.account.report.journal.issue"].create(
+            [
+                {"wizard_id": self.id, "invoice_id": invoice_id, "reason": reason}
+                for invoice_id, reason in issues
+            ]
+        )
+        if not issues:
+            return {
+                "type": "ir.actions.client",
+                "tag": "display_notification",
+                "params": {
+                    "title": _("Journal validation"),
+                    "message": _("No problems found in the invoices of the period."),
+                    "sticky": False,
+                },
+            }
+        return {
+            "name": _("Journal Problems"),
+            "type": "ir.actions.act_window",
+            "res_model": "l10n.ro.account.report.journal.issue",
+            "view_mode": "tree",
+            "domain": [("wizard_id", "=", self.id)],
+        }
+
+    def print_report_lazy(self):
+        """opens the HTML journal that loads its lines while scrolling"""
+        self.ensure_one()
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/l10n_ro_account_report_journal/view?%s"
+            % url_encode(
+                {
+                    "company_id": self.company_id.id,
+                    "journal_type": self.journal_type,
+                    "date_from": fields.Date.to_string(self.date_from),
+                    "date_to": fields.Date.to_string(self.date_to),
+                    "show_warnings": int(self.show_warnings),
+                }
+            ),
+            "target": "new",
+        }
+
+    def print_report_background(self):
+        """the journal is generated by a background job, the wizard is shown
+        again with the progress of the job"""
+        self.ensure_one()
+        [data] = self.read()
+        self.job_id = self.env["l10n.ro.account.report.journal.job"]._create_from_form(data)
+        return self._reopen_wizard()
+
+    def _get_periods(self):
+        """the (date_from, date_to) periods between the wizard dates, from
+        the date ranges of period_type_id or by months"""
+        self.ensure_one()
+        if self.period_type_id:
+            ranges = self.env["date.range"].search(
+                [
+                    ("type_id", "=", self.period_type_id.id),
+                    ("date_start", ">=", self.date_from),
+                    ("date_end", "<=", self.date_to),
+                    "|",
+                    ("company_id", "=", self.company_id.id),
+                    ("company_id", "=", False),
+                ],
+                order="date_start",
+            )
+            return [(r.date_start, r.date_end) for r in ranges]
+        periods = []
+        date_start = self.date_from
+        while date_start <= self.date_to:
+            date_end = min(date_start + relativedelta(day=31), self.date_to)
+            periods.append((date_start, date_end))
+            date_start = date_end + timedelta(days=1)
+        return periods
+
+    def print_report_periods(self):
+        """the journals of all the periods are computed with one data fetch
+        and stored as snapshots by a background job, then a job renders
+        every period"""
+        self.ensure_one()
+        periods = self._get_periods()
+        if not periods:
+            raise ValidationError(_("There is no period between the selected dates."))
+        [data] = self.read()
+        job = self.env["l10n.ro.account.report.journal.job"]._create_from_periods(
+            data, periods
+        )
+        action = self.env.ref(
+            "l10n_ro_account_report_journal.action_journal_job"
+        ).read()[0]
+        action["domain"] = ["|", ("id", "=", job.id), ("parent_id", "=", job.id)]
+        return action
+
+    def action_refresh_job(self):
+        return self._reopen_wizard()
+
+    def action_download_job(self):
+        return self.job_id.action_download()
+
+    def _reopen_wizard(self):
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+        }
+
+    def action_export(self):
+        """exports the journal rows as CSV/XLSX without QWeb rendering"""
+        self.ensure_one()
+        [data] = self.read()
+        datas = {"ids": [], "model": "l10n_ro_account_report_journal", "form": data}
+        attachment = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]._export_journal(datas, self.export_format or "xlsx")
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % attachment.id,
+            "target": "self",
+        }
+
+    def action_export_partner_summary(self):
+        """exports the journal columns summed by partner and VAT code"""
+        self.ensure_one()
+        [data] = self.read()
+        datas = {"ids": [], "model": "l10n_ro_account_report_journal", "form": data}
+        attachment = self.env[
+            "report.l10n_ro_account_report_journal.report_sale_purchase"
+        ]._export_partner_summary(datas, self.export_format or "xlsx")
+        return {
+            "type": "ir.actions.act_url",
+            "url": "/web/content/%s?download=true" % attachment.id,
+            "target": "self",
+        }
+
     def print_report(self, html=False):
         self.ensure_one()
         [data] = self.read()
@@ -91,3 +288,17 @@ class SalePurchaseJournalReport(models.TransientModel):
         ref = self.env.ref(report_action)
         res = ref.report_action(docids=[], data=datas, config=False)
         return res
+
+
+class SalePurchaseJournalIssue(models.TransientModel):
+    _name = "l10n.ro.account.report.journal.issue"
+    _description = "Sale Purchase Journal Validation Problem"
+    _order = "invoice_date, invoice_id"
+
+    wizard_id = fields.Many2one(
+        "l10n.ro.account.report.journal", required=True, ondelete="cascade"
+    )
+    invoice_id = fields.Many2one("account.move", required=True, readonly=True)
+    invoice_date = fields.Date(related="invoice_id.invoice_date", store=True)
+    partner_id = fields.Many2one(related="invoice_id.partner_id")
+    reason = fields.Char(readonly=True)